@@ -0,0 +1,476 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+# Typical use cases:
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/bench_stages.py -v
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/bench_stages.py -o stages.jsonl -d /tmp/universe.db
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/bench_stages.py -s 50 -y 3 -b duckdb
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/bench_stages.py -h
+
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#   run the same stages against a scratch MySQL database too?
+#
+##############################################################################
+
+
+# standard python library imports
+import argparse
+import collections
+from contextlib import contextmanager
+import datetime as dt
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+import warnings
+
+# third party python imports, each loaded on first use (see lazy.py)
+import lazy
+np = lazy.load("numpy")                        # conda install numpy
+pd = lazy.load("pandas")                       # conda install pandas
+
+# local imports
+home = "/home/mcollier/ONYX/wealth/portfolio"
+local_paths = [os.path.join(home, "scripts"), ]
+sys.path[:0] = [p for p in local_paths if p not in sys.path]
+from bench_startup import commit
+import common
+import get_timeseries
+import make_metrics
+import queries
+import scan_db
+import storage
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# GICS sectors, dealt out to the synthetic symbols
+SECTORS = ["Consumer Discretionary", "Consumer Staples", "Energy",
+           "Financials", "Health Care", "Industrials",
+           "Information Technology", "Materials", "Real Estate",
+           "Telecommunication Services", "Utilities"]
+
+# stages slower than this many seconds on both runs aren't compared
+FLOOR = 0.05
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def make_universe(con, symbols=500, years=20, seed=0):
+    """
+    INPUTS:
+        con (connection) - Empty database from storage.connect()
+        symbols (int) - Number of symbols
+        years (int) - Years of business days, from 2000-01-03
+        seed (int) - Seed of the random walk, so every run is the same
+    OUTPUT:
+        The last date of the universe (a Thursday), after filling symbols
+        and daily_data. Prices are random walks with splits of 2:1 and 3:1
+        (raw and adjusted columns both), some symbols list late or are
+        inactivated early, and one bar in 500 is missing.
+    """
+
+    rng = np.random.RandomState(seed)
+    dates = pd.bdate_range("2000-01-03", periods=252*years)
+    dates = dates[:len(dates) - (dates[-1].weekday() - 3) % 5]
+    days, n = dates.strftime("%Y-%m-%d"), len(dates)
+
+    # adjusted prices, then raw prices higher by every later split
+    drift = rng.normal(0.0003, 0.0003, symbols)
+    vol = rng.uniform(0.01, 0.03, symbols)
+    adj_close = rng.uniform(10, 200, symbols)*np.exp(np.cumsum(
+        rng.normal(drift, vol, (n, symbols)), axis=0))
+    adj_open = np.vstack([adj_close[:1], adj_close[:-1]])*np.exp(
+        rng.normal(0, vol/3, (n, symbols)))
+    adj_high = np.maximum(adj_open, adj_close)*np.exp(abs(
+        rng.normal(0, vol/2, (n, symbols))))
+    adj_low = np.minimum(adj_open, adj_close)*np.exp(-abs(
+        rng.normal(0, vol/2, (n, symbols))))
+    adj_volume = np.exp(rng.normal(14, 0.5, (n, symbols))).round()
+    split = np.where(rng.rand(n, symbols) < 1/2000.,
+                     rng.choice([2., 3.], (n, symbols)), 1.)
+    split[0] = 1.
+    after = np.cumprod(split[::-1], axis=0)[::-1]/split
+
+    # listings, inactivations, and missing bars
+    first = np.where(rng.rand(symbols) < 0.8, 0, rng.randint(0, n//2,
+                                                             symbols))
+    last = np.where(rng.rand(symbols) < 0.04,
+                    rng.randint(n//2, n, symbols), n)
+    row = np.arange(n)[:, None]
+    valid = (row >= first) & (row < last) & (rng.rand(n, symbols) >= 0.002)
+
+    now = "{} 17:00:00".format(days[-1])
+    with con.cursor() as cur:
+        cur.executemany("""INSERT INTO symbols (id, flag, ticker, instrument,
+                                                name, sector, currency,
+                                                inserted, last_update)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                        [(k + 1, "i" if last[k] < n else "a",
+                          "S{:04d}".format(k + 1),
+                          "EOD/S{:04d}".format(k + 1),
+                          "Synthetic {}".format(k + 1),
+                          SECTORS[k % len(SECTORS)], "USD",
+                          days[first[k]], now) for k in range(symbols)])
+    for k in range(symbols):
+        columns = np.column_stack([
+            adj_open[:, k]*after[:, k], adj_high[:, k]*after[:, k],
+            adj_low[:, k]*after[:, k], adj_close[:, k]*after[:, k],
+            adj_volume[:, k]/after[:, k], np.zeros(n), split[:, k],
+            adj_open[:, k], adj_high[:, k], adj_low[:, k], adj_close[:, k],
+            adj_volume[:, k]]).round(4)
+        rows = [(k + 1, day) + tuple(values) + (now, 1) for day, values
+                in zip(days[valid[:, k]], columns[valid[:, k]].tolist())]
+        get_timeseries.rows_replace(con, rows, "daily")
+
+    return days[-1]
+
+
+def next_day(con, seed=0):
+    """
+    INPUTS:
+        con (connection) - Database filled by make_universe()
+        seed (int) - Seed of the day's moves
+    OUTPUT:
+        The new date (a Friday), after adding a bar for it to every active
+        symbol, as get_timeseries.py would.
+    """
+
+    rng = np.random.RandomState(seed + 1)
+    with con.cursor() as cur:
+        cur.execute("SELECT max(price_date) FROM daily_data")
+        last = cur.fetchone()[0]
+        cur.execute("""SELECT d.symbol_id, d.close, d.adj_close
+                       FROM daily_data d INNER JOIN symbols s
+                       ON d.symbol_id = s.id
+                       WHERE s.flag <> 'i' AND d.price_date = %s""", (last,))
+        bars = cur.fetchall()
+    day = (last + dt.timedelta(1)).isoformat()
+    now = "{} 17:00:00".format(day)
+    rows = []
+    for symbol_id, close, adj_close in bars:
+        move = np.exp(rng.normal(0.0003, 0.02, 4))
+        o, c = close*move[0], close*move[1]
+        h, l = max(o, c)*move[2]**0.5, min(o, c)/move[3]**0.5
+        factor = adj_close/close
+        volume = float(round(np.exp(rng.normal(14, 0.5))))
+        values = [o, h, l, c, volume, 0., 1., o*factor, h*factor, l*factor,
+                  c*factor, volume]
+        rows.append((symbol_id, day) + tuple([round(float(v), 4)
+                                              for v in values]) + (now, 1))
+    get_timeseries.rows_replace(con, rows, "daily")
+
+    return day
+
+
+def load(backend, path, symbols, years, seed):
+    """
+    INPUTS:
+        backend (str) - Embedded backend to run on, "sqlite" or "duckdb"
+        path (str) - Database file caching the universe, or "" for none
+        symbols, years, seed - See make_universe()
+    OUTPUT:
+        Tuple of a connection to a fresh copy of the universe (in memory,
+        or a temporary copy of path), its last date, and the copy's file
+        name to remove after the run. The universe is built into path
+        only when it holds none of the same size and seed, as building it
+        takes longer than most stages.
+    """
+
+    params = json.dumps([symbols, years, seed])
+    if not path:
+        con = storage.connect({"backend": backend, "db": ":memory:"})
+        make_universe(con, symbols, years, seed)
+        return con, query_last(con), None
+
+    cached = storage.connect({"backend": backend, "db": path})
+    with cached.cursor() as cur:
+        cur.execute("CREATE TABLE IF NOT EXISTS universe (params TEXT)")
+        cur.execute("SELECT params FROM universe")
+        found = cur.fetchone()
+    if found is None or found[0] != params:
+        cached.close()
+        os.remove(path)
+        cached = storage.connect({"backend": backend, "db": path})
+        make_universe(cached, symbols, years, seed)
+        with cached.cursor() as cur:
+            cur.execute("CREATE TABLE universe (params TEXT)")
+            cur.execute("INSERT INTO universe VALUES (%s)", (params,))
+        cached.commit()
+    cached.close()
+
+    copy = tempfile.mkstemp(suffix=os.path.splitext(path)[1])[1]
+    shutil.copyfile(path, copy)
+    con = storage.connect({"backend": backend, "db": copy})
+
+    return con, query_last(con), copy
+
+
+def query_last(con):
+    """
+    OUTPUT:
+        The last price date in daily_data, ISO 8601.
+    """
+
+    with con.cursor() as cur:
+        cur.execute("SELECT max(price_date) FROM daily_data")
+        return cur.fetchone()[0].isoformat()
+
+
+def bench(con, last, seed=0, charts=10, vprint=lambda *a, **k: None):
+    """
+    INPUTS:
+        con (connection) - Fresh copy of the universe from load()
+        last (str) - Its last date
+        seed (int) - Seed of the new day's moves
+        charts (int) - Most chart pages per span and attitude
+        vprint (function) - Prints each stage's time as it finishes
+    OUTPUT:
+        Tuple of [seconds, rows] by stage name in run order, and a list of
+        notes. Weekly data and metrics are first built for the whole
+        history, then a day is added and brought up to date the way the
+        nightly run does, and that day is scanned.
+    """
+
+    results = collections.OrderedDict()
+    notes = []
+
+    @contextmanager
+    def stage(name):
+        # time the block, which fills in its row count
+        done = {"rows": None}
+        t0 = time()
+        yield done
+        results[name] = [round(time() - t0, 4), done["rows"]]
+        vprint("{:>22s}: {:8.3f}s {}".format(name, results[name][0],
+               "" if done["rows"] is None else
+               "{} rows".format(done["rows"])))
+
+    now = dt.datetime.strptime(last, "%Y-%m-%d") + dt.timedelta(hours=17)
+    lentickers, tickers = common.read_tickers(con)
+    ids = sorted([tickers[t_key][0] for t_key in tickers])
+
+    # full history: weekly aggregation and metrics from nothing
+    with stage("weekly_full") as s:
+        weekly = get_timeseries.make_weekly_data(con, ids, last)
+        rows = get_timeseries.weekly_rows(weekly, now)
+        s["rows"] = len(rows)
+    with stage("weekly_full_write"):
+        for n in range(0, len(rows), 5000):
+            get_timeseries.rows_replace(con, rows[n:n + 5000], "weekly")
+
+    with stage("metrics_full") as s:
+        panels = []
+        for span in ["daily", "weekly"]:
+            metrics, state = make_metrics.make_panel_metrics(con, span, ids,
+                                                             last)
+            panels.append((span, make_metrics.tuplefy(metrics), state))
+        s["rows"] = sum([len(metrics) for span, metrics, state in panels])
+    with stage("metrics_full_write"):
+        for span, metrics, state in panels:
+            make_metrics.data_replace(con, span, metrics)
+            make_metrics.state_replace(con, state)
+        con.commit()
+    del weekly, rows, panels
+
+    # one new day: incremental weekly aggregation and metrics
+    today = next_day(con, seed)
+    now += dt.timedelta(days=1)
+    lentickers, tickers = common.read_tickers(con)
+
+    with stage("weekly_incremental") as s:
+        weekly = get_timeseries.make_weekly_data(con, ids, today)
+        rows = get_timeseries.weekly_rows(weekly, now)
+        get_timeseries.rows_replace(con, rows, "weekly")
+        s["rows"] = len(rows)
+
+    with stage("metrics_incremental") as s:
+        states = dict([(span, make_metrics.read_states(con, span))
+                       for span in ["daily", "weekly"]])
+        opts = {"backfill": False, "chunk": 2500, "no_insert": False,
+                "batch_size": 5000, "load_infile": False, "replica": False,
+                "no_state": False}
+        make_metrics.init_worker((con, con), states, today, opts)
+        done = [make_metrics.work((t_key, tickers[t_key][0]))
+                for t_key in sorted(tickers)]
+        s["rows"] = sum([result[3] for result in done])
+    errors = [result[6] for result in done if result[6]]
+    if errors:
+        notes.append("{} metrics errors, i.e. {}".format(len(errors),
+                                                         errors[0]))
+
+    # scans of the new day: breadth, sectors, candidates, and charts
+    with stage("breadth") as s:
+        broads = [scan_db.get_broads(con, span, today)
+                  for span in ["daily", "weekly"]]
+        s["rows"] = len(broads)
+
+    with stage("sectors") as s:
+        sectors = scan_db.get_sectors(con)
+        s["rows"] = 0
+        for span in ["daily", "weekly"]:
+            for sector, values in sectors.items():
+                scan_db.get_broads(con, span, today, values)
+                s["rows"] += 1
+
+    with stage("candidates") as s:
+        attitudes = collections.OrderedDict()
+        for span in ["daily", "weekly"]:
+            attitudes[(span, "longs")] = scan_db.get_longs(con, span, today)
+            attitudes[(span, "shorts")] = scan_db.get_shorts(con, span, today)
+        found = attitudes[("daily", "longs")] + attitudes[("daily", "shorts")]
+        infos = [scan_db.get_ticker_info(con, tid) for tid in found]
+        scan_db.report_individuals(con, today, infos)
+        s["rows"] = len(found)
+
+    try:
+        import bokeh
+    except ImportError:
+        results["charts"] = [None, None]
+        notes.append("charts not timed, bokeh is not installed")
+        return results, notes
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, stage("charts") as s:
+        os.chdir(tmp)
+        s["rows"] = 0
+        for (span, att), found in attitudes.items():
+            pages = found[:charts]
+            scan_db.bokeh_pages(con, span, today, att, tickers=pages)
+            s["rows"] += len(pages)
+        os.chdir(cwd)
+
+    return results, notes
+
+
+def compare(path, record, threshold):
+    """
+    INPUTS:
+        path (str) - JSON lines file of earlier records
+        record (dict) - This run's record
+        threshold (float) - Fraction slower counted as a regression
+    OUTPUT:
+        Tuple of the last earlier record of the same universe (or None),
+        and the stages slower than it by more than threshold.
+    """
+
+    before = None
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                old = json.loads(line)
+                if old.get("universe") == record["universe"]: before = old
+    if before is None: return None, []
+
+    slower = []
+    for name, (seconds, rows) in record["stages"].items():
+        if name not in before["stages"] or seconds is None: continue
+        was = before["stages"][name][0]
+        if was is None or max(was, seconds) < FLOOR: continue
+        if seconds > was*(1 + threshold): slower.append(name)
+
+    return before, slower
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    # assign parsed commandline values to working objects
+    p = argparse.ArgumentParser()
+    p.add_argument("-s", "--symbols", default=500, type=int,
+        help="number of synthetic symbols... i.e. -s 50")
+    p.add_argument("-y", "--years", default=20, type=int,
+        help="years of daily bars... i.e. -y 3")
+    p.add_argument("-S", "--seed", default=0, type=int,
+        help="seed of the synthetic prices... i.e. -S 1")
+    p.add_argument("-d", "--db", default="",
+        help="database file caching the universe... i.e. -d /tmp/u.duckdb")
+    p.add_argument("-b", "--backend", default="sqlite",
+        choices=[b for b in storage.BACKENDS if b != "mysql"],
+        help="embedded storage backend to run on... i.e. -b duckdb")
+    p.add_argument("-n", "--runs", default=1, type=int,
+        help="runs of every stage, the median is kept... i.e. -n 3")
+    p.add_argument("-c", "--charts", default=10, type=int,
+        help="most chart pages per span and attitude... i.e. -c 50")
+    p.add_argument("-o", "--output", default="",
+        help="append the results as a JSON line... i.e. -o stages.jsonl")
+    p.add_argument("-t", "--threshold", default=0.2, type=float,
+        help="fraction slower than the last record that fails... i.e. -t 0.1")
+    p.add_argument("-v", "--verbose", action="store_true",
+        help="print extra information on stdout")
+    args = p.parse_args()
+
+    # set up functions and parameters
+    vprint = print if args.verbose else lambda *a, **k: None
+    warnings.filterwarnings("ignore")
+    runs = []
+    for n in range(args.runs):
+        t0 = time()
+        con, last, copy = load(args.backend, args.db, args.symbols,
+                               args.years, args.seed)
+        with con.cursor() as cur:
+            cur.execute("SELECT count(*) FROM daily_data")
+            bars = cur.fetchone()[0]
+        vprint("{:>22s}: {:8.3f}s {} rows".format("load", time() - t0, bars))
+        runs.append(bench(con, last, args.seed, args.charts, vprint))
+        con.close()
+        if copy: os.remove(copy)
+
+    # median of each stage over the runs
+    results = collections.OrderedDict()
+    for name, (seconds, rows) in runs[0][0].items():
+        times = sorted([r[name][0] for r, notes in runs
+                        if r[name][0] is not None])
+        results[name] = [times[len(times)//2] if times else None, rows]
+    notes = runs[0][1]
+
+
+    ##########################################################################
+    # reporting
+    ##########################################################################
+
+    record = {"date": dt.datetime.today().isoformat()[:19],
+              "commit": commit(), "runs": args.runs,
+              "universe": {"symbols": args.symbols, "years": args.years,
+                           "seed": args.seed, "bars": bars,
+                           "backend": args.backend},
+              "stages": results}
+    before, slower = compare(args.output, record, args.threshold)
+
+    msg = "{} symbols, {} years, seed {} ({} daily bars) on {}:\n".format(
+        args.symbols, args.years, args.seed, bars, args.backend)
+    for name, (seconds, rows) in results.items():
+        msg += " {:>20s}: ".format(name)
+        if seconds is None:
+            msg += "not timed\n"
+            continue
+        msg += "{:8.3f}s".format(seconds)
+        was = (before or {"stages": {}})["stages"].get(name, [None])[0]
+        if was:
+            msg += " ({:+6.1%} on {})".format(seconds/was - 1,
+                                               before["commit"] or "last")
+        msg += " SLOWER\n" if name in slower else "\n"
+    for note in notes:
+        msg += "NOTE: {}\n".format(note)
+    if args.verbose:
+        msg += "INFO: Statements (slowest first):\n" + queries.report()
+    print(msg, end="")
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,150 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+# Typical use cases:
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/bench_startup.py
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/bench_startup.py -v -n 20
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/bench_startup.py -h
+
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#   budgets for a single ticker run against a test database?
+#
+##############################################################################
+
+
+# standard python library imports
+import argparse
+import collections
+from datetime import datetime
+import json
+import os
+import re
+import subprocess
+import sys
+from time import time
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# directory holding the scripts, and the seconds each may take to start and
+# print its -h help; third party modules load on first use (see lazy.py),
+# so -h should cost little more than starting python itself
+scripts = os.path.dirname(os.path.abspath(__file__))
+BUDGETS = collections.OrderedDict([
+    ("get_tickers.py", 0.25),
+    ("get_timeseries.py", 0.25),
+    ("make_metrics.py", 0.25),
+    ("scan_db.py", 0.25),
+    ("ingest.py", 0.30),
+    ("run_daily.py", 0.35),
+])
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def startup(argv, runs=5):
+    """
+    INPUTS:
+        argv (list) - Arguments to python, i.e. ["get_tickers.py", "-h"]
+        runs (int) - Number of launches to time
+    OUTPUT:
+        Tuple of the median wall seconds to run python with argv, and the
+        exit status of the last launch.
+    """
+
+    times = []
+    for n in range(runs):
+        t0 = time()
+        done = subprocess.run([sys.executable] + argv, cwd=scripts,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        times.append(time() - t0)
+
+    return sorted(times)[len(times)//2], done.returncode
+
+
+def heaviest(argv, top=5, skip=()):
+    """
+    INPUTS:
+        argv (list) - Arguments to python, i.e. ["get_tickers.py", "-h"]
+        top (int) - Number of imports to list
+        skip (list) - Modules not to list, i.e. those python itself loads
+    OUTPUT:
+        List of (cumulative seconds, module) for the slowest top level
+        imports of python with argv, from python -X importtime.
+    """
+
+    done = subprocess.run([sys.executable, "-X", "importtime"] + argv,
+                          cwd=scripts, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    found = []
+    for line in done.stderr.splitlines():
+        m = re.match(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", line)
+        if m and len(m.group(2)) <= 1 and m.group(3) not in skip:
+            found.append((int(m.group(1))/1e6, m.group(3)))
+
+    return sorted(found, reverse=True)[:top]
+
+
+def commit():
+    """
+    OUTPUT:
+        Short hash of the checked out commit, or "" outside of git.
+    """
+
+    done = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                          cwd=scripts, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, universal_newlines=True)
+
+    return done.stdout.strip()
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    # assign parsed commandline values to working objects
+    p = argparse.ArgumentParser()
+    p.add_argument("-n", "--runs", default=5, type=int,
+        help="launches of each script to time... i.e. -n 20")
+    p.add_argument("-o", "--output", default="",
+        help="append the results as a JSON line... i.e. -o startup.jsonl")
+    p.add_argument("-v", "--verbose", action="store_true",
+        help="list the slowest imports of each script")
+    args = p.parse_args()
+
+    # time each script against its budget
+    baseline, _ = startup(["-c", "pass"], args.runs)
+    skip = [module for secs, module in heaviest(["-c", "pass"], None)]
+    results = collections.OrderedDict()
+    over = 0
+    print("python itself: {:.3f}s".format(baseline))
+    for script, budget in BUDGETS.items():
+        seconds, status = startup([script, "-h"], args.runs)
+        results[script] = round(seconds, 4)
+        late = seconds > budget or status != 0
+        over += late
+        print("{:>18s}: {:.3f}s of {:.2f}s {}".format(script, seconds, budget,
+              "exit {}".format(status) if status else
+              "OVER BUDGET" if late else "ok"))
+        if args.verbose or late:
+            for secs, module in heaviest([script, "-h"], skip=skip):
+                print(" {:>17s}  {:.3f}s {}".format("", secs, module))
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps({"date": datetime.today().isoformat()[:19],
+                                "commit": commit(), "python": baseline,
+                                "scripts": results}) + "\n")
+
+    sys.exit(1 if over else 0)
@@ -11,15 +11,22 @@
 ##############################################################################
 
 # standard python library imports
+import atexit
+import csv
 import datetime as dt
+import functools
 import json
+import os
+import queue
 import sys
+import tempfile
+import threading
 from time import sleep, time
 import traceback
 
-# third party library imports
-from pandas import DataFrame as DF               # conda install pandas
-from pymysql import connect                      # conda install pymysql
+# local imports
+import queries
+import storage
 
 
 ##############################################################################
@@ -48,6 +55,12 @@ date open high low close adj_close volume
 2017-09-25 78.92 80.10 78.86 79.15 79.15 8506800
 """
 
+# last price dates by table and symbol_id, see load_last_price_dates()
+last_price_dates = dict()
+
+# connection pools by (host, user, db), see get_pool()
+pools = dict()
+
 
 ##############################################################################
 # Local User Function Definitions
@@ -69,24 +82,178 @@ def get_config(s):
     return json.loads("".join([r for r in conf if r[0] != '#']))
 
 
-def get_connection(conf):
+def get_connection(conf, replica=False):
 
     """
     INPUTS:
         JSON configuration file as string. Comments consisting
         of whole lines may be inserted if first character is '#'.
+        replica (bool) - Connect to the read replica, if one is configured
     OUTPUT:
-        Mysql connection
+        Database connection, to MySQL or the db_backend chosen in hf.conf
     """
 
-    # Connect to the MySQL instance
-    con = connect(  host=conf["db_host"],
-                    user=conf["db_user"],
-                  passwd=conf["db_pass"],
-                      db=conf["db_name"])
+    # Connect to the MySQL instance, or open the embedded database
+    con = storage.connect(db_settings(conf, replica))
     return con
 
 
+def db_settings(conf, replica=False):
+    """
+    INPUTS:
+        conf (dict) - Configuration from hf.conf
+        replica (bool) - Settings for the read replica (db_replica_host,
+                         with db_replica_user and db_replica_pass falling
+                         back to the primary's), if db_replica_host is set
+    OUTPUT:
+        Settings for storage.connect(): the db_backend (default "mysql"),
+        then keyword arguments for pymysql.connect(), or for the embedded
+        backends the db_path of the database file. Those have no replica.
+    """
+
+    backend = conf.get("db_backend", "mysql")
+    if backend != "mysql":
+        return {"backend": backend, "host": "", "user": "",
+                "db": conf["db_path"]}
+    replica = replica and conf.get("db_replica_host")
+    prefix = "db_replica_" if replica else "db_"
+    return {"backend": backend, "host": conf[prefix + "host"],
+            "user": conf.get(prefix + "user", conf["db_user"]),
+            "passwd": conf.get(prefix + "pass", conf["db_pass"]),
+            "db": conf["db_name"],
+            "local_infile": conf.get("db_local_infile", False)}
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of up to `size` connections to one server (or one
+    embedded database file, see storage.py).
+    get() hands out an idle connection after pinging it, which reconnects
+    one the server dropped, or opens a new one while under size, or else
+    waits for one to come back through put(). Any cursor class may be
+    chosen per call, i.e. con.cursor(DictCursor), so one connection serves
+    both tuple and dict readers.
+    """
+
+    def __init__(self, settings, size=4):
+        self.settings = settings
+        self.size = size
+        self.opened = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    def get(self, timeout=None):
+        try:
+            con = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                grow = self.opened < self.size
+                if grow: self.opened += 1
+            if grow:
+                try:
+                    return storage.connect(self.settings)
+                except Exception:
+                    with self.lock: self.opened -= 1
+                    raise
+            con = self.idle.get(timeout=timeout)
+
+        try:
+            con.ping(reconnect=True)
+        except Exception:
+            with self.lock: self.opened -= 1
+            raise
+
+        return con
+
+    def put(self, con):
+        """
+        OUTPUT:
+            Side effect of rolling back anything uncommitted and returning
+            the connection to the pool, or forgetting it if it is closed.
+        """
+
+        try:
+            con.rollback()
+            self.idle.put(con)
+        except Exception:
+            with self.lock: self.opened -= 1
+
+    def cursor(self, cursorclass=None):
+        """
+        OUTPUT:
+            Context manager yielding a cursor, of cursorclass if given, on
+            a pooled connection that goes back to the pool afterwards.
+        """
+
+        return PooledCursor(self, cursorclass)
+
+    def close(self):
+        while True:
+            try:
+                con = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock: self.opened -= 1
+            try:
+                con.close()
+            except Exception:
+                pass
+
+
+class PooledCursor(object):
+    """
+    Context manager for ConnectionPool.cursor(). Commits if the block
+    finishes cleanly; the pool rolls back anything else.
+    """
+
+    def __init__(self, pool, cursorclass=None):
+        self.pool = pool
+        self.cursorclass = cursorclass
+
+    def __enter__(self):
+        self.con = self.pool.get()
+        self.cur = self.con.cursor(self.cursorclass)
+        return self.cur
+
+    def __exit__(self, kind, value, tb):
+        try:
+            self.cur.close()
+            if kind is None: self.con.commit()
+        finally:
+            self.pool.put(self.con)
+
+
+def get_pool(conf, replica=False):
+    """
+    INPUTS:
+        conf (dict) - Configuration from hf.conf
+        replica (bool) - Pool for the read replica, see db_settings()
+    OUTPUT:
+        The process' ConnectionPool for that server, created on first use
+        with db_pool_size connections at most (default 4). Without a
+        replica configured, both choices share the primary's pool.
+    """
+
+    settings = db_settings(conf, replica)
+    key = (settings["backend"], settings["host"], settings["user"],
+           settings["db"])
+    if key not in pools:
+        pools[key] = ConnectionPool(settings, conf.get("db_pool_size", 4))
+
+    return pools[key]
+
+
+@atexit.register
+def close_pools():
+    """
+    OUTPUT:
+        Side effect of closing every idle pooled connection, at exit.
+    """
+
+    for pool in pools.values():
+        pool.close()
+
+
 def read_tickers(con, ticker='', comparison='<>"i"'):
     """
     INPUTS:
@@ -100,37 +267,181 @@ def read_tickers(con, ticker='', comparison='<>"i"'):
     """
 
     data = dict()
-    sql = """SELECT ticker, id, flag, name, sector, last_update
-             FROM symbols WHERE flag{}""".format(comparison)
-    if ticker: sql += " AND ticker='{}'".format(ticker)
-    with con.cursor() as cur:
-        number = cur.execute(sql)
-        rows = cur.fetchall()
+    if ticker:
+        rows = queries.fetchall(con, "ticker", {"ticker": ticker},
+                                comparison=comparison)
+    else:
+        rows = queries.fetchall(con, "tickers", comparison=comparison)
 
     for row in rows:
         data[row[0]] = row[1:]
 
-    return (number, data)
+    return (len(rows), data)
 
 
-def update_tickers(con, flag, tickers, dt):
+def update_tickers(con, flag, tickers, dt, commit=True):
     """
     INPUTS:
         con (mysql) - pymysql database connection
         flag (str) - Ticker status ('a','i','n') -> (active, inactive, new)
         tickers (list) - List of ticker symbols on the S&P 500 to update.
         dt (str) - Date of last (this) update is iso8601 format.
+        commit (bool) - Commit now, or leave it to the caller's stage
+    OUTPUT:
+        Side effect of updating the symbols table in one statement.
+    """
+
+    update_symbols(con, dict([(ticker, (flag, dt)) for ticker in tickers]),
+                   commit)
+
+
+def update_symbols(con, changes, commit=True, batch_size=1000):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        changes (dict) - (flag, last_update) tuples keyed by ticker symbol,
+                         i.e. gathered over a whole stage of a run
+        commit (bool) - Commit now, or leave it to the caller's stage
+        batch_size (int) - Most tickers per statement
+    OUTPUT:
+        Side effect of updating the symbols table with one parameterized
+        UPDATE ... CASE ... WHERE ticker IN (...) per batch_size tickers.
+    """
+
+    items = sorted(changes.items())
+    with con.cursor() as cur:
+        for n in range(0, len(items), batch_size):
+            batch = items[n:n + batch_size]
+            whens = " ".join(["WHEN %s THEN %s"]*len(batch))
+            sql = """UPDATE symbols SET flag = CASE ticker {0} END,
+                                        last_update = CASE ticker {0} END
+                     WHERE ticker IN ({1})"""
+            sql = sql.format(whens, ",".join(["%s"]*len(batch)))
+            params = []
+            for col in [0, 1]:  # flag, then last_update
+                for ticker, change in batch: params += [ticker, change[col]]
+            params += [ticker for ticker, change in batch]
+            with queries.timed("update_symbols", len(batch)):
+                cur.execute(sql, params)
+    if commit: con.commit()
+
+
+def bulk_upsert(con, table, cols, rows, keys=2, batch_size=5000):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        table (str) - Database table to write into
+        cols (list) - Column names in the same order as each row
+        rows (list) - List of tuples of values, None for NULL
+        keys (int) - Number of leading columns forming the unique key
+        batch_size (int) - Number of rows sent per executemany() call
     OUTPUT:
-        Side effect of updating the symbols table.
+        Number of rows sent. Rows are written with one parameterized
+        INSERT ... ON DUPLICATE KEY UPDATE statement, which pymysql expands
+        into multi-row VALUES lists. The caller commits.
     """
 
-    sql = '''UPDATE symbols SET flag="{}", last_update="{}"
-             WHERE ticker="{}"'''
+    header = ",".join(["`{}`".format(c) for c in cols])
+    esses = ("%s,"*len(cols))[:-1]
+    update = ",".join(["`{0}`=VALUES(`{0}`)".format(c) for c in cols[keys:]])
+    sql = "INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}"
+    sql = sql.format(table, header, esses, update)
 
     with con.cursor() as cur:
-        for ticker in tickers:
-            cur.execute(sql.format(flag, dt, ticker))
-        con.commit()
+        for n in range(0, len(rows), batch_size):
+            with queries.timed("upsert " + table, len(rows[n:n+batch_size])):
+                cur.executemany(sql, rows[n:n+batch_size])
+
+    return len(rows)
+
+
+def load_infile(con, table, cols, rows, keys=2):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection, opened with local_infile
+        table (str) - Database table to write into
+        cols (list) - Column names in the same order as each row
+        rows (list) - List of tuples of values, None for NULL
+        keys (int) - Number of leading columns forming the unique key
+    OUTPUT:
+        Number of rows sent. Rows are staged in a temporary file, loaded
+        with LOAD DATA LOCAL INFILE into a temporary copy of the table, and
+        then merged with a single INSERT ... SELECT. Meant for full backfills.
+        The embedded backends have no LOAD DATA, and take bulk_upsert()'s
+        statement for all of the rows at once instead. The caller commits.
+    """
+
+    if storage.backend(con) != "mysql":
+        return bulk_upsert(con, table, cols, rows, keys, max(len(rows), 1))
+
+    header = ",".join(["`{}`".format(c) for c in cols])
+    update = ",".join(["`{0}`=VALUES(`{0}`)".format(c) for c in cols[keys:]])
+    stage = "stage_{}".format(table)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+        writer = csv.writer(f, lineterminator="\n")
+        for row in rows:
+            writer.writerow(["\\N" if v is None or v != v else v for v in row])
+
+    try:
+        with con.cursor() as cur, queries.timed("infile " + table, len(rows)):
+            cur.execute("DROP TEMPORARY TABLE IF EXISTS {}".format(stage))
+            cur.execute("CREATE TEMPORARY TABLE {} LIKE {}".format(stage,
+                                                                  table))
+            cur.execute("""LOAD DATA LOCAL INFILE '{}' INTO TABLE {}
+                           FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+                           LINES TERMINATED BY '\\n' ({})"""
+                        .format(f.name, stage, header))
+            cur.execute("""INSERT INTO {0} ({1}) SELECT {1} FROM {2}
+                           ON DUPLICATE KEY UPDATE {3}"""
+                        .format(table, header, stage, update))
+            cur.execute("DROP TEMPORARY TABLE {}".format(stage))
+    finally:
+        os.remove(f.name)
+
+    return len(rows)
+
+
+class Journal(object):
+    """
+    Append-only record of the (key, stage) pairs a run has finished, one
+    JSON line each, so a rerun with --resume can skip them. Each record()
+    is flushed and synced before returning, so the journal survives a
+    crash at any point; a torn last line is ignored when reading back.
+    """
+
+    def __init__(self, path, resume=False):
+        self.finished = set()
+        line = "\n"
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.finished.add((entry["key"], entry["stage"]))
+        self.f = open(path, "a" if resume else "w")
+        if not line.endswith("\n"): self.f.write("\n")  # end a torn line
+
+    def done(self, key, stage):
+        return (key, stage) in self.finished
+
+    def record(self, keys, stage):
+        """
+        INPUTS:
+            keys (list) - Keys (i.e. ticker symbols) just committed
+            stage (str) - Stage they finished, i.e. "daily"
+        """
+
+        for key in keys:
+            self.f.write(json.dumps({"key": key, "stage": stage}) + "\n")
+            self.finished.add((key, stage))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
 
 
 def handle(msg, epack):
@@ -155,13 +466,15 @@ def handle(msg, epack):
     return epack
 
 
+@functools.lru_cache(maxsize=4096)
 def get_next_day(date, encode="iso8601"):
     """
     INPUT:
         date (str) - A day encoded as an iso8601 formatted string: YYYY-MM-DD
         encode (str) - Options are either 'iso8601' or 'python date'.
     OUTPUT:
-        Return the next day's date (default iso8601 format)
+        Return the next day's date (default iso8601 format). Answers are
+        cached, as the same few dates are asked for ticker after ticker.
     """
     date = dt.datetime.strptime(date, "%Y-%m-%d")
     date = (date + dt.timedelta( days=1 ))
@@ -180,19 +493,57 @@ def get_last_price_date(con, table, ticker_id):
         table (str) - Database table to query
         ticker_id (int) - Ticker id number from symbols table
     OUTPUT:
-        Last price date in ticker's time series. Iso8601 standard format
+        Last price date in ticker's time series. Iso8601 standard format.
+        Answered from memory if load_last_price_dates() loaded the table.
     """
 
-    sql = "SELECT max(price_date) FROM {} WHERE symbol_id={}"
-    with con.cursor() as cur:
-        cur.execute(sql.format(table, ticker_id))
-        last_date = cur.fetchone()[0]
-        if not last_date: last_date = "2001-01-01"
-        else: last_date = last_date.isoformat()
+    if table in last_price_dates:
+        return last_price_dates[table].get(ticker_id, "2001-01-01")
+
+    last_date = queries.fetchone(con, "last_price_date",
+                                 {"symbol_id": ticker_id}, table=table)[0]
+    if not last_date: last_date = "2001-01-01"
+    else: last_date = last_date.isoformat()
 
     return last_date
 
 
+def load_last_price_dates(con, tables):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        tables (list) - Database tables to query, i.e. ["daily_data", ...]
+    OUTPUT:
+        Side effect of caching every symbol's last price date for each table
+        with one GROUP BY query per table, for the rest of the run. Returns
+        the cache as {table: {ticker_id: iso8601 date}}.
+    """
+
+    for table in tables:
+        rows = queries.fetchall(con, "last_price_dates", table=table)
+        last_price_dates[table] = dict([(row[0], row[1].isoformat())
+                                        for row in rows])
+
+    return last_price_dates
+
+
+def set_last_price_date(table, ticker_id, date):
+    """
+    INPUTS:
+        table (str) - Database table just written to
+        ticker_id (int) - Ticker id number from symbols table
+        date (str) - Last price date written. Iso8601 standard format
+    OUTPUT:
+        Side effect of moving the cached last price date forward, if the
+        table is cached and the date is later.
+    """
+
+    if table in last_price_dates:
+        dates = last_price_dates[table]
+        if date > dates.get(ticker_id, ""): dates[ticker_id] = date
+
+
+@functools.lru_cache(maxsize=4096)
 def get_dotw(sign, dotw, from_date="2000-01-01", encode="iso8601"):
     """
     INPUT:
@@ -205,7 +556,8 @@ def get_dotw(sign, dotw, from_date="2000-01-01", encode="iso8601"):
         you ask it to return the previous or next dotw and the from_date is
         the same dotw, then it returns itself. I.e. Give it a from_date that
         is a Monday, and ask it for the previous Monday, and you'll just get
-        back the date you gave it.
+        back the date you gave it. Answers are cached, see get_next_day().
+        For exchange sessions and holidays see sessions.py.
     """
     # sign, dotw, from_date = "prev", "Monday", "2017-11-15"
     # sign, dotw, from_date = "next", "Friday", "2017-11-15"
@@ -232,6 +584,7 @@ def get_dotw(sign, dotw, from_date="2000-01-01", encode="iso8601"):
 if __name__ == "__main__":
 
     # TEST: load data
+    from pandas import DataFrame as DF           # conda install pandas
     daily = DF.from_csv("wmt_daily_df.csv")
     df = DF(data=wmt, index=wmt["index"])
     df = df.drop("index", axis=1)
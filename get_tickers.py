@@ -26,15 +26,18 @@ import datetime
 import os
 import sys
 
-# third party python imports
-from bs4 import BeautifulSoup as miso        # conda install beautifulsoup4
-from requests import get                     # conda install requests
+# third party python imports, each loaded on first use (see lazy.py)
+import lazy
+bs4 = lazy.load("bs4")                       # conda install beautifulsoup4
+requests = lazy.load("requests")             # conda install requests
 
 # local imports
 home = "/home/mcollier/ONYX/wealth/portfolio"
 local_paths = [os.path.join(home, "scripts"), ]
-sys.path.insert(0, [p for p in local_paths if p not in sys.path])
+sys.path[:0] = [p for p in local_paths if p not in sys.path]
 import common
+import queries
+import telemetry
 
 
 ##############################################################################
@@ -56,8 +59,8 @@ def get_wiki_tickers(url, now, then, epack):
     try:
 
         # prepare the soup
-        response = get(url)
-        soup = miso(response.text, "lxml")  # conda install lxml
+        response = requests.get(url)
+        soup = bs4.BeautifulSoup(response.text, "lxml")  # conda install lxml
 
         # select first table, ignore header ([1:]), use CSS Selector syntax
         symbols_list = soup.select("table")[0].select("tr")[1:]
@@ -91,16 +94,10 @@ def insert_tickers(con, data, epack):
 
     try:
 
-        # Create the SQL statement
-        columns = """ticker, instrument, name, sector, currency,
-                     inserted, last_update"""
-        inserts = ("%s, " * 7)[:-2]
-        sql = "INSERT INTO symbols ({}) VALUES ({})".format(columns, inserts)
-
         # populate database table, and exit cleanly
-        with con.cursor() as cur:
-            cur.executemany(sql, data)
-            con.commit()
+        if data:
+            queries.execute(con, "insert_symbols", data, many=True)
+        con.commit()
 
     except Exception as err_msg:
 
@@ -110,13 +107,17 @@ def insert_tickers(con, data, epack):
 
 
 ##############################################################################
-# Treat this file as a script if invoked as __main__
+# Main, run as a script or as a stage of run_daily.py
 ##############################################################################
 
-if __name__ == "__main__":
-
-    # load configuration from commented JSON into dictionary
-    conf = common.get_config("/etc/local/hf.conf")
+def main(argv=None, conf=None):
+    """
+    INPUTS:
+        argv (list) - Command line arguments, sys.argv[1:] if None
+        conf (dict) - Configuration from hf.conf, loaded here if None
+    OUTPUT:
+        epack of any errors, after updating the symbols table.
+    """
 
     # parse the commandline for any goodies
     p = argparse.ArgumentParser()
@@ -126,7 +127,10 @@ if __name__ == "__main__":
         help="suppress insertion of data into db tables if True")
     p.add_argument("-R", "--no_report", action="store_true",
         help="suppress reporting at end if True")
-    args = p.parse_args()
+    args = p.parse_args(argv)
+
+    # load configuration from commented JSON into dictionary
+    if conf is None: conf = common.get_config("/etc/local/hf.conf")
 
 
     try:
@@ -139,7 +143,8 @@ if __name__ == "__main__":
         present = datetime.datetime.now()
         today = present.date().isoformat()
         BoT = "2000-01-03"  # Beginning of Time
-        con = common.get_connection(conf)
+        pool = common.get_pool(conf)
+        con = pool.get()
 
         # get current from web, read previous from db
         (current_active, epack) = get_wiki_tickers(url, present.date(),
@@ -167,9 +172,14 @@ if __name__ == "__main__":
 
         # update the MySQL database if not no_insert
         if not args.no_insert:
-            common.update_tickers(con, "i", new_inactive_keys, present.date())
             epack = insert_tickers(con, tuple(new_active.values()), epack )
-            common.update_tickers(con, "n", new_keys, BoT)
+            changes = dict([(key, ("i", present.date()))
+                            for key in new_inactive_keys])
+            changes.update([(key, ("n", BoT)) for key in new_keys])
+            common.update_symbols(con, changes)
+            telemetry.count("symbols_inserted_total", len(new_active))
+            telemetry.count("symbols_inactivated_total",
+                            len(new_inactive_keys))
 
 
     except Exception as err_msg:
@@ -224,6 +234,20 @@ if __name__ == "__main__":
 
 
     # finally
-    con.close()
+    telemetry.count("errors_total", epack[1])
+    telemetry.count("warnings_total", wpack[1])
+    telemetry.write("tickers", home + "/logs/{}_telemetry.jsonl".format(today),
+                    conf.get("telemetry_textfile_dir"))
+    pool.put(con)
     vprint(msg)
 
+    return epack
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    main()
@@ -16,74 +16,131 @@
 #   drop adjusted values?
 #   improve documentation
 #   add code snippet to inactivate a ticker manually
-#   develop adaptive-sleep-size function?
 #
 ##############################################################################
 
 
 # standard python library imports
 import argparse
+import collections
 from datetime import datetime
 from decimal import Decimal
 from decimal import ROUND_HALF_EVEN as RHE
 import os
+import queue
 import sys
-from time import sleep, time
+import threading
+from time import time
 import warnings
 
-# third party python imports
-from pandas import concat                        # conda install pandas
-#from pandas import DataFrame as DF
-from pandas import read_sql as read_db
-from numpy import nan                            # conda install numpy
-import quandl                                    # conda install quandl
+# third party python imports, each loaded on first use (see lazy.py)
+import lazy
+np = lazy.load("numpy")                        # conda install numpy
+pd = lazy.load("pandas")                       # conda install pandas
 
 # local imports
 home = "/home/mcollier/ONYX/wealth/portfolio"
 local_paths = [os.path.join(home, "scripts"), ]
-sys.path.insert(0, [p for p in local_paths if p not in sys.path])
+sys.path[:0] = [p for p in local_paths if p not in sys.path]
 import common
+import queries
+import sessions
+import telemetry
+import vendor
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# pipeline stages, in order, for throughput reporting
+STAGES = ["fetch", "transform", "write"]
+
+# how each daily column rolls up into its week, in weekly_data column order
+WEEKLY = collections.OrderedDict([
+    ("open", "first"), ("high", "max"), ("low", "min"), ("close", "last"),
+    ("volume", "sum"), ("ex_dividend", "sum"), ("split_ratio", "prod"),
+    ("adj_open", "first"), ("adj_high", "max"), ("adj_low", "min"),
+    ("adj_close", "last"), ("adj_volume", "sum")])
 
 
 ##############################################################################
 # Local User Function Definitions
 ##############################################################################
 
-def make_weekly_data(con, ticker_id, begin_date, today):
+def make_weekly_data(con, ticker_ids, today):
     """
     INPUTS:
         con (mysql) - pymysql database connection
-        ticker_id (int) - Ticker id number from symbols table
-        begin_date (str) - Last price date in series. Iso8601 standard format
+        ticker_ids (list) - Ticker id numbers from symbols table
         today (str) - Today's date in iso8601 standard format
     OUTPUT:
-        Returns a pandas dataframe resampled to weekly
+        Returns a pandas dataframe of weeks ending Friday, indexed by
+        (symbol_id, price_date). One query pulls each symbol's daily bars
+        from the start of its last stored week onward, so only the open
+        week and weeks touched by new days are re-aggregated, and every
+        column comes out of a single grouped aggregation.
     """
 
-    sql = """SELECT * FROM daily_data WHERE symbol_id="{}"
-             AND price_date BETWEEN "{}" AND "{}";"""
-    df = read_db(sql.format(ticker_id, begin_date, today), con,
-                 index_col="price_date", coerce_float=True,
-                 parse_dates=["price_date", ])
+    if not ticker_ids: return pd.DataFrame()
+
+    ids = tuple([int(ticker_id) for ticker_id in ticker_ids])
+    df = queries.frame(con, "weekly_source", {"ids": ids, "today": today},
+                       coerce_float=True, parse_dates=["price_date", ])
     df = df.drop("id", axis=1)
-    df.fillna(value=nan, inplace=True)
-    o = df.open.resample('1W-FRI').ohlc().open
-    h = df.high.resample('1W-FRI').max()
-    l = df.low.resample('1W-FRI').min()
-    c = df.close.resample('1W-FRI').ohlc().close
-    v = df.volume.resample('1W-FRI').sum()
-    ed = df.ex_dividend.resample('1W-FRI').sum()
-    sr = df.split_ratio.resample('1W-FRI').cumprod()
-    ao = df.adj_open.resample('1W-FRI').ohlc().open.rename("adj_open")
-    ah = df.adj_high.resample('1W-FRI').max()
-    al = df.adj_low.resample('1W-FRI').min()
-    ac = df.adj_close.resample('1W-FRI').ohlc().close.rename("adj_close")
-    av = df.adj_volume.resample('1W-FRI').sum()
-
-    data = [o, h, l, c, v, ed, sr, ao, ah, al, ac, av]
-    weekly = concat(data, axis=1)
-
-    return weekly
+    df.fillna(value=np.nan, inplace=True)
+
+    # label each day with the Friday ending its week
+    weekday = df.price_date.dt.weekday
+    df["price_date"] += pd.to_timedelta((4 - weekday) % 7, unit="D")
+
+    weekly = df.groupby(["symbol_id", "price_date"]).agg(WEEKLY)
+
+    return weekly[list(WEEKLY.keys())]
+
+
+def tuplefy(df):
+    """
+    INPUTS:
+        df (DataFrame) - Prices indexed by date
+    OUTPUT:
+        List of tuples, one per row, led by the ISO 8601 price date. Whole
+        columns are rounded half-to-even to 4 places at once, and missing
+        values become None. The few products landing exactly on a half are
+        ambiguous in binary, so those cells are rounded with Decimal to keep
+        the stored decimal(19,4) values identical.
+    """
+
+    values = df.values.astype(float)
+    rounded = values.round(4)
+    scaled = values*10000
+    for i, j in zip(*np.nonzero(abs(scaled - np.trunc(scaled)) == 0.5)):
+        d4 = Decimal(values[i, j]).quantize(Decimal('0.0000'), rounding=RHE)
+        rounded[i, j] = float(d4)
+
+    rows = rounded.astype(object)
+    rows[np.isnan(rounded)] = None
+    dates = df.index.strftime("%Y-%m-%d")
+
+    return [(date,) + tuple(row) for date, row in zip(dates, rows)]
+
+
+def weekly_rows(weekly, now, vendor_id='1'):
+    """
+    INPUTS:
+        weekly (DataFrame) - From make_weekly_data()
+        now (datetime) - Python datetime object in Central Time
+        vendor_id (str) - For example,'1' for Yahoo Finance
+    OUTPUT:
+        List of tuples for rows_replace(), ticker by ticker.
+    """
+
+    rows = []
+    for ticker_id, frame in weekly.groupby(level=0):
+        rows += [(int(ticker_id),) + d + (now, vendor_id)
+                 for d in tuplefy(frame.loc[ticker_id])]
+
+    return rows
 
 
 def data_replace(con, now, vendor_id, ticker_id, data, time_span):
@@ -103,6 +160,21 @@ def data_replace(con, now, vendor_id, ticker_id, data, time_span):
     # Amend the data to include the vendor ID and symbol ID
     data = [(ticker_id,) + d + (now, vendor_id) for d in data]
 
+    return rows_replace(con, data, time_span)
+
+
+def rows_replace(con, rows, time_span):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        rows (list) - Tuples already amended by symbol ID, last update and
+                      vendor ID, possibly for many tickers
+        time_span (str) - Specify "daily" or "weekly"
+    OUTPUT:
+        Adds rows to either daily_data or weekly_data table in one
+        transaction.
+    """
+
     # Create the insertion strings
     table = "{}_data".format(time_span)  # time_span = "daily"
     cols = ["symbol_id","price_date","open","high","low","close","volume",
@@ -114,20 +186,137 @@ def data_replace(con, now, vendor_id, ticker_id, data, time_span):
 
     # REPLACE the data into a MySQL database table
     with con.cursor() as cur:
-        cur.executemany(sql, data)
+        with queries.timed("replace " + table, len(rows)):
+            cur.executemany(sql, rows)
         results = con.commit()
 
     return results
 
 
+def put(q, item, stop):
+    """
+    INPUTS:
+        q (Queue) - Bounded queue to the next pipeline stage
+        item (obj) - Work item, exception, or None to mark the end
+        stop (Event) - Set when the pipeline is shutting down
+    OUTPUT:
+        True once the item is queued, or False if the pipeline stopped
+        while the queue was full.
+    """
+
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def take(q, stop):
+    """
+    INPUTS:
+        q (Queue) - Bounded queue from the previous pipeline stage
+        stop (Event) - Set when the pipeline is shutting down
+    OUTPUT:
+        Next item, or None if the pipeline stopped while the queue was empty.
+    """
+
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+
+    return None
+
+
+def fetch_stage(results, out, stop, stats):
+    """
+    INPUTS:
+        results (generator) - (t_key, dataframe, exception) tuples from
+                              vendor.fetch_many
+        out (Queue) - Bounded queue to the transform stage
+        stop (Event) - Set when the pipeline is shutting down
+        stats (list) - [items, busy seconds] for this stage
+    OUTPUT:
+        Side effect of queueing each fetch result, then None. A full queue
+        blocks this stage, which in turn stops new requests going out.
+    """
+
+    try:
+        while True:
+            t0 = time()
+            result = next(results, None)
+            stats[1] += time() - t0
+            if result is None or not put(out, result, stop): break
+            stats[0] += 1
+    except Exception as err_msg:
+        put(out, err_msg, stop)
+    finally:
+        results.close()
+        put(out, None, stop)
+
+
+def transform_stage(inq, out, stop, stats, tickers, now):
+    """
+    INPUTS:
+        inq (Queue) - Bounded queue from the fetch stage
+        out (Queue) - Bounded queue to the writer stage
+        stop (Event) - Set when the pipeline is shutting down
+        stats (list) - [items, busy seconds] for this stage
+        tickers (dict) - Ticker information keyed by t_key
+        now (datetime) - Python datetime object in Central Time
+    OUTPUT:
+        Side effect of queueing (t_key, rows, problem) tuples, then None.
+        Rows are ready for rows_replace(). Problem is None, or a
+        ("warning" or "error", message) pair for the writer to log.
+    """
+
+    try:
+        while True:
+            item = take(inq, stop)
+            if item is None: break
+            if isinstance(item, Exception):
+                put(out, item, stop)
+                break
+
+            t_key, daily, fetch_err = item
+            with telemetry.span("transform", t_key) as s:
+                ticker_id = tickers[t_key][0]
+                rows, problem = [], None
+                if fetch_err:
+                    problem = ("error", "Fetch failed for {}: {}".format(
+                               t_key, fetch_err))
+                elif daily is not None and daily.empty:
+                    problem = ("warning", "Data load aborted for {}\n"
+                               .format(t_key))
+                elif daily is not None:
+                    rows = [(ticker_id,) + d + (now, '1')
+                            for d in tuplefy(daily)]
+            stats[1] += s.seconds
+            stats[0] += 1
+
+            if not put(out, (t_key, rows, problem), stop): break
+    except Exception as err_msg:
+        put(out, err_msg, stop)
+    finally:
+        put(out, None, stop)
+
+
 ##############################################################################
-# Treat this file as a script if invoked as __main__
+# Main, run as a script or as a stage of run_daily.py
 ##############################################################################
 
-if __name__ == "__main__":
-
-    # load configuration from commented JSON into dictionary
-    conf = common.get_config("/etc/local/hf.conf")
+def main(argv=None, conf=None):
+    """
+    INPUTS:
+        argv (list) - Command line arguments, sys.argv[1:] if None
+        conf (dict) - Configuration from hf.conf, loaded here if None
+    OUTPUT:
+        epack of any errors, after writing daily and weekly data.
+    """
 
     # assign parsed commandline values to working objects
     p = argparse.ArgumentParser()
@@ -135,32 +324,57 @@ if __name__ == "__main__":
         help="pull a single ticker... i.e. -s WMT")
     p.add_argument("-v", "--verbose", action="store_true",
         help="print extra information on stdout")
+    p.add_argument("-b", "--batch_size", default=5000, type=int,
+        help="rows per daily write batch... i.e. -b 10000")
+    p.add_argument("-C", "--replay", action="store_true",
+        help="rebuild daily data from the response cache, without fetching")
     p.add_argument("-D", "--no_daily", action="store_true",
         help="suppress daily download if true")
     p.add_argument("-N", "--no_insert", action="store_true",
         help="suppress insertion of data into db tables if true")
+    p.add_argument("-Q", "--queue", default=16, type=int,
+        help="items held between pipeline stages... i.e. -Q 32")
+    p.add_argument("-r", "--resume", action="store_true",
+        help="skip tickers today's journal shows finished")
     p.add_argument("-R", "--no_report", action="store_true",
         help="option to suppress reporting at end")
+    p.add_argument("-T", "--threads", default=4, type=int,
+        help="number of daily requests in flight at once... i.e. -T 8")
     p.add_argument("-W", "--no_weekly", action="store_true",
         help="suppress weekly resampling if true")
-    args = p.parse_args()
+    args = p.parse_args(argv)
+
+    # load configuration from commented JSON into dictionary
+    if conf is None: conf = common.get_config("/etc/local/hf.conf")
+    if args.replay and not conf.get("quandl_cache"):
+        p.error("--replay needs quandl_cache set in hf.conf")
+
+    # set up functions, parameters, and the defaults reporting needs if
+    # the run fails before getting to them
+    vprint = print if args.verbose else lambda *a, **k: None
+    warnings.filterwarnings("ignore")  # ignore trunc from Decimal(19,4)
+    wpack = ["WARNING(S):\n", 0]
+    epack = ["ERROR(S):\n", 0]
+    stats = dict([(stage, [0, 0.0]) for stage in STAGES])
+    now = datetime.today()
+    today = now.date().isoformat()
+    count, lentickers, t_key, name = 0, 0, "setup", ""
+    tickers, t_keys, through, current = dict(), [], today, []
+    bucket = pool = con = journal = None
+    t00 = time()
 
 
     try:
 
-        # set up functions, parameters, and other needed objects
-        vprint = print if args.verbose else lambda *a, **k: None
-        warnings.filterwarnings("ignore")  # ignore trunc from Decimal(19,4)
-        wpack = ["WARNING(S):\n", 0]
-        epack = ["ERROR(S):\n", 0]
-        now = datetime.today()
-        today = now.date().isoformat()
-        dt = lambda i: i.date().isoformat()
-        d4 = lambda x: Decimal(x).quantize(Decimal('0.0000'), rounding=RHE)
-        tuplefy = lambda df: [ tuple([dt(i)] + [d4(c) for c in r])
-                               for i,r in df.iterrows()]
-        quandl.ApiConfig.api_key = conf["quandl_key"]
-        con = common.get_connection(conf)
+        # set up other needed objects
+        through = sessions.last_session(today)
+        vendor.configure(conf)
+        bucket = vendor.make_bucket(conf)
+        cache = vendor.make_cache(conf)
+        pool = common.get_pool(conf)
+        con = pool.get()
+        journal = common.Journal(home + "/logs/{}_timeseries.journal"
+                                 .format(today), args.resume)
 
         # obtain a list of tickers and it's length
         lentickers, tickers = common.read_tickers(con, args.single)
@@ -174,64 +388,141 @@ if __name__ == "__main__":
     #             "INDEXCBOE:VIX",       # Volatility Index
     #             "INDEXSP:.INX"]        # US S&P 500,              "WIKI/SPW"
 
-        # Loop over the tickers
+        # cache every ticker's last price date (one query in all)
+        common.load_last_price_dates(con, ["daily_data", ])
+
         t_keys = list(tickers.keys())
         t_keys.sort()
+        t_keys = [t_key for t_key in t_keys if tickers[t_key][1] != 'i']
+        pending = [t_key for t_key in t_keys
+                   if not journal.done(t_key, "daily")]
+
+        # plan a daily request for each active ticker not already holding
+        # the last session's bar, which on weekends, holidays, and reruns
+        # is most or all of them; the calendar only decides whether to ask,
+        # so the vendor's data still decides which days a request returns
+        jobs = []
+        if not (args.no_daily or args.replay):
+            last_dates = dict([(t_key, str(common.get_last_price_date(
+                                   con, "daily_data", tickers[t_key][0])))
+                               for t_key in pending])
+            current = [t_key for t_key in pending
+                       if last_dates[t_key] >= through]
+            behind = [t_key for t_key in pending
+                      if last_dates[t_key] < through]
+            for t_key in behind:  # t_key = "WMT"
+                instrument = "WIKI/" + t_key.replace('.', '_')
+                begin_date = common.get_next_day(last_dates[t_key])
+                jobs.append((t_key, instrument, begin_date, today))
+            telemetry.count("tickers_current_total", len(current))
+            vprint("{} ticker(s) already current through {}".format(
+                   len(current), through))
+
+        # fetch concurrently under the shared rate limit (Quandl allows
+        # 300/10min; a fixed sleep(1.3) per call averaged ~2.2s a ticker),
+        # or with --replay read every response from the cache instead
+        if args.replay and not args.no_daily:
+            codes = dict([("WIKI/" + t_key.replace('.', '_'), t_key)
+                          for t_key in pending])
+            results = ((codes[code], daily, None)
+                       for code, daily in cache.replay() if code in codes)
+        elif not args.no_daily:
+            results = vendor.fetch_many(bucket, jobs, args.threads,
+                                        cache=cache,
+                                        retries=conf.get("quandl_retries", 5))
+        else:
+            results = ((t_key, None, None) for t_key in t_keys
+                       if not journal.done(t_key, "weekly"))
+
+        # fetch and transform in threads, joined by bounded queues, while
+        # this thread writes whatever has arrived in batches
+        stop = threading.Event()
+        fetched = queue.Queue(args.queue)
+        transformed = queue.Queue(args.queue)
+        stages = [threading.Thread(target=fetch_stage,
+                                   args=(results, fetched, stop,
+                                         stats["fetch"])),
+                  threading.Thread(target=transform_stage,
+                                   args=(fetched, transformed, stop,
+                                         stats["transform"], tickers, now))]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        # resumed runs still owe weekly data for days already written
         count = 0
+        touched = [t_key for t_key in t_keys if journal.done(t_key, "daily")
+                   and not journal.done(t_key, "weekly")]
+        batch, keys = [], []
+        statuses = dict()
         t00 = time()
-        for t_key in t_keys:  # t_key = "WMT"
-            vprint("Working on {}".format(t_key))
-            t0 = time()
-
-            # get the ticker's information
-            if tickers[t_key][1] == 'i':  continue
-            ticker_id, flag, name, sector, last_update = tickers[t_key]
-
-            if not args.no_daily:  # pull daily data for Quandl with API
-                t1 = time()
-                sleep(1.3)  # throttling (Quandl allows rate of 300/10min)
-                # average 2.36s each on 20171020 with sleep(1.5)
-                # with sleep(1.3),
-                # ave(s) @ 2.18, 2.06, 2.23, 2.14, 2.19, 2.21, 2.29
-                instrument = "WIKI/" + t_key.replace('.', '_')
-                begin_date = common.get_last_price_date(con, "daily_data",
-                                                        ticker_id)
-                begin_date = common.get_next_day(begin_date)
-                daily = quandl.get(instrument, start_date=begin_date,
-                                   end_date=today, collapse="daily")
-
-                # if daily data not complete for ticker, warn and skip
-                if daily.empty:
-                    warn_msg = "Data load aborted for {}\n".format(t_key)
-                    wpack = common.handle(warn_msg, wpack)
-                    continue
-
-                daily = tuplefy(daily)
-                if not args.no_insert:
-                    data_replace(con, now, '1', ticker_id, daily, "daily")
-
-                vprint("daily data took {:.2f}s".format(time()-t1))
-
-            if not args.no_weekly:  # calculate custom weekly data
-                t2 = time()
-                begin_date = common.get_last_price_date(con, "weekly_data",
-                                                        ticker_id)
-                weekly = make_weekly_data(con, ticker_id,
-                                          common.get_dotw("prev", "Sunday",
-                                                          begin_date),
-                                          today)
-                weekly = tuplefy(weekly)
+        try:
+            while True:
+                item = transformed.get()
+                if isinstance(item, Exception): raise item
+
+                if item is not None:
+                    t_key, rows, problem = item
+                    ticker_id, flag, name, sector, last_update = tickers[t_key]
+                    if problem and problem[0] == "error":
+                        epack = common.handle(problem[1], epack)
+                    elif problem:
+                        wpack = common.handle(problem[1], wpack)
+                    else:
+                        batch += rows
+                        keys.append(t_key)
+
+                # write once the batch is full or nothing else is waiting
+                if keys and (item is None or len(batch) >= args.batch_size
+                             or transformed.empty()):
+                    s = telemetry.span("write", table="daily_data")
+                    if not args.no_insert and batch:
+                        with s:
+                            rows_replace(con, batch, "daily")
+                        telemetry.count("rows_written_total", len(batch),
+                                        table="daily_data")
+                        for row in batch:
+                            common.set_last_price_date("daily_data", row[0],
+                                                       row[1])
+                        if not args.no_daily: journal.record(keys, "daily")
+
+                    # "update" only if both were updated... must rethink!
+                    if not args.no_daily or not args.no_weekly:
+                        statuses.update([(key, ("a", now)) for key in keys])
+                    if not args.no_weekly:
+                        touched += keys
+
+                    count += len(keys)
+                    stats["write"][0] += len(keys)
+                    stats["write"][1] += s.seconds or 0
+                    vprint("({}/{}) Wrote {} rows for {} in {:.2f}s".format(
+                           count, lentickers, len(batch), ", ".join(keys),
+                           s.seconds or 0))
+                    batch, keys = [], []
+
+                if item is None: break
+        finally:
+            stop.set()
+
+        # apply the stage's symbol status changes at once
+        common.update_symbols(con, statuses)
+
+        if not args.no_weekly:  # calculate custom weekly data in one pass
+            touched = sorted(set(touched))
+            t_key, name = "weekly", "{} tickers".format(len(touched))
+            with telemetry.span("weekly", table="weekly_data") as s:
+                weekly = make_weekly_data(con, [tickers[key][0]
+                                                for key in touched], today)
+                rows = weekly_rows(weekly, now)
                 if not args.no_insert:
-                    data_replace(con, now, '1', ticker_id, weekly, "weekly")
-                vprint("weekly data took {:.2f}s".format(time()-t2))
-
-            # "update" only if both were updated... must rethink!
-            if not args.no_daily or not args.no_weekly:
-                common.update_tickers(con, "a", [t_key,], now)
-
-            count += 1
-            vprint("({}/{}) Finished {} in {:.2f}s".format(count, lentickers,
-                                                           t_key, time() - t0))
+                    for n in range(0, len(rows), args.batch_size):
+                        rows_replace(con, rows[n:n + args.batch_size],
+                                     "weekly")
+                    telemetry.count("rows_written_total", len(rows),
+                                    table="weekly_data")
+                    journal.record(touched, "weekly")
+            vprint("weekly data for {} tickers took {:.2f}s".format(
+                   len(touched), s.seconds))
 
     except Exception as err_msg:
 
@@ -251,9 +542,23 @@ if __name__ == "__main__":
         tf = time()
         msg  = "Total Time is {:.2f}m\n".format((tf-t00)/60)
         msg += "INFO: Ticker(s): {}\n".format("All" if len(tickers) > 1
-                                                    else t_keys[0])
+                                                    else ", ".join(t_keys))
         msg += "INFO: DB Insertion: {}\n".format(not args.no_insert)
         msg += "INFO: Through Date: {}\n".format(today)
+        msg += "INFO: Last Session: {}, {} ticker(s) already current\n".format(
+               through, len(current))
+        if bucket is not None:
+            msg += ("INFO: Vendor Rate: {:.3f}/s at end ({:.3f}/s quota), "
+                    "{} throttled, {} retried\n".format(bucket.rate,
+                                                        bucket.ceiling,
+                                                        bucket.throttles,
+                                                        bucket.retries))
+        msg += "INFO: Stage Throughput (tickers/busy second):\n"
+        for stage in STAGES:
+            n, busy = stats[stage]
+            msg += " {:>9s}: {} tickers, {:.2f}s busy ({:.1f}/s)\n".format(
+                   stage, n, busy, n/busy if busy else 0)
+        msg += "INFO: Statements (slowest first):\n" + queries.report()
 
         if not epack[1]: msg += "ERRORS: None\n"
         else: msg += "ERRORS:\n{}\n".format(epack)
@@ -271,6 +576,26 @@ if __name__ == "__main__":
 
 
     # finally
-    con.close()
+    for stage in STAGES:
+        telemetry.count("stage_items_total", stats[stage][0], stage=stage)
+        telemetry.count("stage_busy_seconds_total", stats[stage][1],
+                        stage=stage)
+    telemetry.count("errors_total", epack[1])
+    telemetry.count("warnings_total", wpack[1])
+    telemetry.write("timeseries",
+                    home + "/logs/{}_telemetry.jsonl".format(today),
+                    conf.get("telemetry_textfile_dir"))
+    if journal is not None: journal.close()
+    if con is not None: pool.put(con)
     vprint(msg)
 
+    return epack
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    main()
@@ -19,8 +19,16 @@ DELETE FROM daily_data WHERE price_date > @pd;
 DELETE FROM weekly_data WHERE price_date > @pd;
 DELETE FROM daily_metrics WHERE price_date > @pd;
 DELETE FROM weekly_metrics WHERE price_date > @pd;
+DELETE FROM metrics_state WHERE price_date > @pd;
 UPDATE symbols SET last_update = @pd WHERE flag='a';
 
+# rebuild ALL metrics after a schema change, then from the shell run
+#   make_metrics.py -v --backfill --workers 8
+# (chunks commit as they go, so rerun the same command to resume)
+TRUNCATE TABLE daily_metrics;
+TRUNCATE TABLE weekly_metrics;
+TRUNCATE TABLE metrics_state;
+
 SELECT dd.symbol_id, dd.price_date FROM daily_data dd
 INNER JOIN (SELECT symbol_id, MAX(price_date) AS last
             FROM daily_data GROUP BY symbol_id) AS grouped
@@ -151,3 +159,18 @@ CREATE TABLE `weekly_metrics` (
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 
 
+CREATE TABLE `metrics_state` (
+  `symbol_id`  int(11)           NOT NULL,
+  `span`       varchar(8)        NOT NULL,
+  `price_date` date              NOT NULL,
+  `close`      decimal(19,4) DEFAULT NULL,
+  `volume`     decimal(19,4) DEFAULT NULL,
+  `ema12`      decimal(19,4) DEFAULT NULL,
+  `ema26`      decimal(19,4) DEFAULT NULL,
+  `ema50`      decimal(19,4) DEFAULT NULL,
+  `force2`     bigint(20)    DEFAULT NULL,
+  `atr13`      decimal(19,4) DEFAULT NULL,
+  `macds`      decimal(19,4) DEFAULT NULL,
+  `updated`    date          DEFAULT NULL,
+  PRIMARY KEY (`symbol_id`,`span`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
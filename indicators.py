@@ -0,0 +1,192 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#
+##############################################################################
+
+# standard python library imports
+from math import log10
+from time import time
+
+# third party library imports, each loaded on first use (see lazy.py)
+import lazy
+np = lazy.load("numpy")                          # conda install numpy
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def ema(values, seed, N=22):
+    """
+    INPUTS:
+        values (ndarray) - New data following the seed, in date order. Either
+                           1-D for a single ticker, or 2-D (date x symbol).
+        seed (float or ndarray) - Last smoothed value(s) before values[0]
+        N (int) - Number of time periods for smoothing
+    OUTPUT:
+        Exponential Moving Average of values as an ndarray of the same shape.
+        The recurrence y[n] = K*x[n] + J*y[n-1] is unrolled in closed form
+        over blocks of rows, so no Python loop runs per element. The block
+        length keeps J**-block below 1e30 to stay clear of float overflow.
+    """
+
+    K = 2/(N + 1)    # coefficient for incoming datum
+    J = 1 - K        # coefficient for fading data
+
+    x = np.asarray(values, dtype=float)
+    smoothed = np.empty_like(x)
+    last = np.asarray(seed, dtype=float)
+    if not len(x): return smoothed
+    if J <= 0: return x.copy()  # N=1 means no smoothing at all
+
+    block = max(1, int(30/-log10(J)))
+    shape = (-1,) + (1,)*(x.ndim - 1)
+    powers = (J ** np.arange(1, block + 1)).reshape(shape)
+
+    for start in range(0, len(x), block):
+        chunk = x[start:start + block]
+        p = powers[:len(chunk)]
+        smoothed[start:start + block] = p*(last + K*np.cumsum(chunk/p, axis=0))
+        last = smoothed[start + len(chunk) - 1]
+
+    return smoothed
+
+
+def sign(values):
+    """
+    INPUTS:
+        values (ndarray or Series) - 1-D for a single ticker, or 2-D panel
+    OUTPUT:
+        1, -1, or 0 for positive, negative, or zero values as an ndarray,
+        with NaN left in place of missing values.
+    """
+
+    return np.sign(np.asarray(values, dtype=float))
+
+
+def force(closes, volumes):
+    """
+    INPUTS:
+        closes (ndarray or Series) - Closing prices, 1-D or 2-D (date x symbol)
+        volumes (ndarray or Series) - Volumes of the same shape
+    OUTPUT:
+        Force index as an ndarray of the same shape. Row 0 has no previous
+        close and is NaN.
+    """
+
+    c = np.asarray(closes, dtype=float)
+    v = np.asarray(volumes, dtype=float)
+    f = np.full_like(c, np.nan)
+    f[1:] = (c[1:] - c[:-1])*v[1:]
+
+    return f
+
+
+def true_range(highs, lows, closes):
+    """
+    INPUTS:
+        highs (ndarray or Series) - High prices, 1-D or 2-D (date x symbol)
+        lows (ndarray or Series) - Low prices of the same shape
+        closes (ndarray or Series) - Closing prices of the same shape
+    OUTPUT:
+        True Range as an ndarray of the same shape. Row 0 has no previous
+        close and is NaN.
+    """
+
+    h = np.asarray(highs, dtype=float)
+    l = np.asarray(lows, dtype=float)
+    c = np.asarray(closes, dtype=float)
+    tr = np.full_like(c, np.nan)
+    tr[1:] = np.maximum(np.maximum(np.abs(h[1:] - l[1:]),
+                                   np.abs(h[1:] - c[:-1])),
+                        np.abs(l[1:] - c[:-1]))
+
+    return tr
+
+
+def impulse(ema12, macdh):
+    """
+    INPUTS:
+        ema12 (ndarray or Series) - EMA12 values, 1-D or 2-D (date x symbol)
+        macdh (ndarray or Series) - MACD Histogram values of the same shape
+    OUTPUT:
+        Impulse as an ndarray of the same shape: 1 when both EMA12 and
+        MACD-H rose, -1 when both fell, 0 otherwise. Row 0 is NaN.
+    """
+
+    e = np.asarray(ema12, dtype=float)
+    m = np.asarray(macdh, dtype=float)
+    signs = np.sign(e[1:] - e[:-1]) + np.sign(m[1:] - m[:-1])
+    encoded = np.full_like(e, np.nan)
+    encoded[1:] = (signs > 1).astype(int) - (signs < -1).astype(int)
+
+    return encoded
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    # TEST: micro-benchmark of the kernels against the per-element versions
+    # they replaced in make_metrics.py, on synthetic bars
+    import pandas as pd                          # conda install pandas
+
+    def loop_force(closes, volumes):
+        force = pd.Series(dtype=float)
+        for n,index in enumerate(closes[1:].index, start=1):
+            force[index] = (closes.iloc[n] - closes.iloc[n-1])*volumes.iloc[n]
+        return force
+
+    def loop_tr(highs, lows, closes):
+        tr = pd.Series(dtype=float)
+        for n,index in enumerate(highs[1:].index, start=1):
+            tr[index] = max([abs(highs.iloc[n] - lows.iloc[n]),
+                             abs(highs.iloc[n] - closes.iloc[n-1]),
+                             abs(lows.iloc[n] - closes.iloc[n-1])])
+        return tr
+
+    def loop_impulse(ema12, macdh):
+        sign = lambda x: (1, -1)[x < 0] if x != 0 else 0
+        condense = lambda x: -1 if x == -2 else 1 if x == 2 else 0
+        signs = ((ema12 - ema12.shift(1))[1:].apply(sign) +
+                 (macdh - macdh.shift(1))[1:].apply(sign))
+        return signs.apply(condense)
+
+    def loop_sign(values):
+        sign = lambda x: (1, -1)[x < 0] if x != 0 else 0
+        return values.apply(sign)
+
+    def clock(f, *a):
+        t0 = time()
+        f(*a)
+        return time() - t0
+
+    bars, symbols = 5000, 500
+    rng = np.random.RandomState(0)
+    c = 100 + np.cumsum(rng.normal(0, 1, (bars, symbols)), axis=0)
+    h = c + rng.uniform(0, 2, c.shape)
+    l = c - rng.uniform(0, 2, c.shape)
+    v = rng.randint(10**5, 10**7, c.shape).astype(float)
+    e = ema(c[1:], c[0], 12)
+    m = e - ema(c[1:], c[0], 26)
+    index = pd.date_range("2000-01-03", periods=bars, freq="B")
+    S = lambda a: pd.Series(a[:, 0], index=index[:len(a)])
+
+    row = "{:>10s}: {:8.4f}s loop, {:8.4f}s kernel, {:8.4f}s kernel panel"
+    print("{} bars, panel of {} symbols".format(bars, symbols))
+    print(row.format("force", clock(loop_force, S(c), S(v)),
+                     clock(force, S(c), S(v)), clock(force, c, v)))
+    print(row.format("tr", clock(loop_tr, S(h), S(l), S(c)),
+                     clock(true_range, S(h), S(l), S(c)),
+                     clock(true_range, h, l, c)))
+    print(row.format("impulse", clock(loop_impulse, S(e), S(m)),
+                     clock(impulse, S(e), S(m)), clock(impulse, e, m)))
+    print(row.format("sign", clock(loop_sign, S(c - 100)),
+                     clock(sign, S(c - 100)), clock(sign, c - 100)))
@@ -0,0 +1,378 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+# Typical use cases:
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/ingest.py -v WIKI_PRICES.zip
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/ingest.py -N prices.csv.gz
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/ingest.py -h
+
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#   take vendor_id from the command line?
+#
+##############################################################################
+
+
+# standard python library imports
+import argparse
+import collections
+from datetime import datetime
+from multiprocessing import Pool
+import os
+import re
+import sys
+from time import time
+import warnings
+
+# third party python imports, each loaded on first use (see lazy.py)
+import lazy
+np = lazy.load("numpy")                          # conda install numpy
+pd = lazy.load("pandas")                         # conda install pandas
+
+# local imports
+home = "/home/mcollier/ONYX/wealth/portfolio"
+local_paths = [os.path.join(home, "scripts"), ]
+sys.path[:0] = [p for p in local_paths if p not in sys.path]
+import common
+import get_timeseries
+import make_metrics
+import queries
+import storage
+import telemetry
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# columns of a vendor dump, i.e. Quandl's WIKI_PRICES bulk download, in the
+# order assumed when a file has no header row
+DUMP = ["ticker", "date", "open", "high", "low", "close", "volume",
+        "ex_dividend", "split_ratio", "adj_open", "adj_high", "adj_low",
+        "adj_close", "adj_volume"]
+
+# beginning of time: weekly data (queries.weekly_source) and metrics are
+# never built from bars before it, so older rows are rejected
+BOT = "2000-01-03"
+
+# columns written to daily_data, the same as get_timeseries.rows_replace
+COLS = ["symbol_id", "price_date", "open", "high", "low", "close", "volume",
+        "ex_dividend", "split_ratio", "adj_open", "adj_high", "adj_low",
+        "adj_close", "adj_volume", "last_update", "vendor_id"]
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def read_dump(path, chunk):
+    """
+    INPUTS:
+        path (str) - CSV file, optionally compressed (.gz, .bz2, .zip, .xz)
+        chunk (int) - Most rows read at a time
+    OUTPUT:
+        Generator of dataframes with the DUMP columns. A header row, if
+        present, is matched by name (i.e. "Adj. Close" or "ex-dividend"),
+        and columns missing from the file are filled with NaN.
+    """
+
+    first = pd.read_csv(path, nrows=0).columns
+    names = [re.sub("[^a-z]+", "_", str(c).lower()).strip("_") for c in first]
+    if "date" in names:
+        reader = pd.read_csv(path, header=0, names=names, chunksize=chunk,
+                             dtype=str)
+    else:
+        reader = pd.read_csv(path, header=None, names=DUMP, chunksize=chunk,
+                             dtype=str)
+
+    for df in reader:
+        yield df.reindex(columns=DUMP)
+
+
+def validate(df, codes, today):
+    """
+    INPUTS:
+        df (DataFrame) - Raw rows from read_dump()
+        codes (dict) - symbol_id keyed by ticker, in both "BRK.B" and
+                       vendor "BRK_B" forms
+        today (str) - Today's date in iso8601 standard format
+    OUTPUT:
+        Tuple of (clean, rejects). Clean rows are indexed by price date,
+        led by symbol_id and followed by the price columns as floats, one
+        row per symbol and date, from BOT through today. Rejects counts
+        dropped rows by reason.
+    """
+
+    rejects = collections.Counter()
+    clean = pd.DataFrame({"symbol_id": df.ticker.str.strip().map(codes)})
+    clean["price_date"] = pd.to_datetime(df.date, errors="coerce")
+    for col in DUMP[2:]:
+        clean[col] = pd.to_numeric(df[col], errors="coerce")
+
+    checks = [("unknown ticker", clean.symbol_id.isnull()),
+              ("bad date", clean.price_date.isnull()),
+              ("future date", clean.price_date > today),
+              ("before BoT", clean.price_date < BOT),
+              ("no close", clean.close.isnull()),
+              ("high below low", clean.high < clean.low),
+              ("negative value", (clean[DUMP[2:]] < 0).any(axis=1))]
+    bad = np.zeros(len(clean.index), dtype=bool)
+    for reason, mask in checks:
+        mask = mask.values & ~bad
+        if mask.any(): rejects[reason] += int(mask.sum())
+        bad |= mask
+
+    clean = clean[~bad]
+    dupes = clean.duplicated(["symbol_id", "price_date"], keep="last")
+    if dupes.any(): rejects["duplicate"] += int(dupes.sum())
+    clean = clean[~dupes]
+    clean["symbol_id"] = clean.symbol_id.astype(int)
+
+    return clean.set_index("price_date"), rejects
+
+
+def make_rows(clean, now, vendor_id):
+    """
+    INPUTS:
+        clean (DataFrame) - Validated rows from validate()
+        now (datetime) - Python datetime object in Central Time
+        vendor_id (str) - For example,'1' for Quandl
+    OUTPUT:
+        List of tuples in COLS order, rounded as get_timeseries.tuplefy()
+        rounds them.
+    """
+
+    prices = get_timeseries.tuplefy(clean[DUMP[2:]])
+    return [(symbol_id,) + row + (now, vendor_id)
+            for symbol_id, row in zip(clean.symbol_id.tolist(), prices)]
+
+
+def clear_from(con, firsts):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        firsts (dict) - Earliest ingested price date keyed by symbol_id
+    OUTPUT:
+        Side effect of deleting each symbol's weekly data, metrics, and
+        metrics state from its earliest ingested date onward, so they are
+        rebuilt over the new history.
+    """
+
+    pairs = list(firsts.items())
+    for table in ["weekly_data", "daily_metrics", "weekly_metrics"]:
+        queries.execute(con, "clear_from", pairs, many=True, table=table)
+    queries.execute(con, "clear_state", list(firsts.keys()), many=True)
+    con.commit()
+
+
+def rebuild_weekly(con, ticker_ids, now, today, group=50, batch_size=5000):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        ticker_ids (list) - Ticker id numbers from symbols table
+        now (datetime) - Python datetime object in Central Time
+        today (str) - Today's date in iso8601 standard format
+        group (int) - Symbols aggregated together, to bound memory
+        batch_size (int) - Rows per REPLACE batch
+    OUTPUT:
+        Number of weekly rows written.
+    """
+
+    written = 0
+    for n in range(0, len(ticker_ids), group):
+        weekly = get_timeseries.make_weekly_data(con, ticker_ids[n:n + group],
+                                                 today)
+        rows = get_timeseries.weekly_rows(weekly, now)
+        for m in range(0, len(rows), batch_size):
+            get_timeseries.rows_replace(con, rows[m:m + batch_size],
+                                        "weekly")
+        written += len(rows)
+
+    return written
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    # assign parsed commandline values to working objects
+    p = argparse.ArgumentParser()
+    p.add_argument("files", nargs="+",
+        help="vendor dump files, CSV or compressed CSV")
+    p.add_argument("-v", "--verbose", action="store_true",
+        help="print extra information on stdout")
+    p.add_argument("-b", "--batch_size", default=5000, type=int,
+        help="number of rows per multi-row insert... i.e. -b 10000")
+    p.add_argument("-c", "--chunk", default=500000, type=int,
+        help="number of file rows read at a time... i.e. -c 100000")
+    p.add_argument("-L", "--load_infile", action="store_true",
+        help="stage writes through LOAD DATA LOCAL INFILE")
+    p.add_argument("-M", "--no_metrics", action="store_true",
+        help="suppress rebuilding metrics if true")
+    p.add_argument("-N", "--no_insert", action="store_true",
+        help="validate only, without writing to db tables, if true")
+    p.add_argument("-R", "--no_report", action="store_true",
+        help="option to suppress reporting at end")
+    p.add_argument("-w", "--workers", default=1, type=int,
+        help="number of processes rebuilding metrics... i.e. -w 8")
+    p.add_argument("-W", "--no_weekly", action="store_true",
+        help="suppress rebuilding weekly data if true")
+    args = p.parse_args()
+
+    # load configuration from commented JSON into dictionary
+    conf = common.get_config("/etc/local/hf.conf")
+    if not storage.processes(conf): args.workers = 1  # i.e. duckdb
+
+    # set up functions and parameters
+    vprint = print if args.verbose else lambda *a, **k: None
+    warnings.filterwarnings("ignore")  # ignore Decimal(19,4) truncation
+    epack = ["ERROR(S):\n", 0]
+    now = datetime.today()
+    today = now.date().isoformat()
+    pool = common.get_pool(conf)
+    con = pool.get()
+    read, written, weekly_rows = 0, 0, 0
+    rejects = collections.Counter()
+    firsts = dict()
+    times = collections.OrderedDict()
+    t00 = time()
+
+    try:
+
+        # map every known ticker, active or not, in both spellings
+        number, tickers = common.read_tickers(con, '', " IS NOT NULL")
+        codes = dict()
+        for t_key, info in tickers.items():
+            codes[t_key] = info[0]
+            codes[t_key.replace('.', '_')] = info[0]
+
+        # load the files chunk by chunk, committing each
+        with telemetry.span("ingest", stage="daily") as s:
+            for path in args.files:
+                for df in read_dump(path, args.chunk):
+                    read += len(df.index)
+                    clean, bad = validate(df, codes, today)
+                    rejects.update(bad)
+                    if not len(clean.index): continue
+
+                    dates = (clean.reset_index().groupby("symbol_id")
+                             .price_date)
+                    for ticker_id, first in dates.min().items():
+                        first = first.date().isoformat()
+                        ticker_id = int(ticker_id)
+                        firsts[ticker_id] = min(first, firsts.get(ticker_id,
+                                                                  first))
+
+                    rows = make_rows(clean, now, '1')
+                    if not args.no_insert:
+                        if args.load_infile:
+                            common.load_infile(con, "daily_data", COLS, rows)
+                        else:
+                            common.bulk_upsert(con, "daily_data", COLS, rows,
+                                               batch_size=args.batch_size)
+                        con.commit()
+                        written += len(rows)
+                    vprint("{}: read {}, loaded {} rows in {:.2f}s".format(
+                           os.path.basename(path), read, written,
+                           time() - s.start))
+        times["daily"] = s.seconds
+
+        # rebuild weekly data and metrics over the new history
+        if firsts and not args.no_insert:
+            ticker_ids = sorted(firsts.keys())
+            clear_from(con, firsts)
+
+            if not args.no_weekly:
+                with telemetry.span("ingest", stage="weekly") as s:
+                    weekly_rows = rebuild_weekly(con, ticker_ids, now, today,
+                                                 batch_size=args.batch_size)
+                telemetry.count("rows_written_total", weekly_rows,
+                                table="weekly_data")
+                times["weekly"] = s.seconds
+                vprint("weekly: {} rows in {:.2f}s".format(weekly_rows,
+                                                           times["weekly"]))
+
+            if not args.no_metrics:
+                with telemetry.span("ingest", stage="metrics") as s:
+                    names = dict([(info[0], t_key)
+                                  for t_key, info in tickers.items()])
+                    tasks = [(names[ticker_id], ticker_id)
+                             for ticker_id in ticker_ids]
+                    opts = {"no_insert": False, "batch_size": args.batch_size,
+                            "load_infile": args.load_infile, "backfill": True,
+                            "chunk": 2500, "no_state": True}
+                    setup = (dict(), today, opts)
+                    if args.workers > 1:
+                        procs = Pool(args.workers, make_metrics.init_worker,
+                                     (conf,) + setup)
+                        results = procs.imap_unordered(make_metrics.work,
+                                                       tasks)
+                    else:
+                        make_metrics.init_worker((con, con), *setup)
+                        results = map(make_metrics.work, tasks)
+                    for result in results:
+                        epack[0] += result[7][0]
+                        epack[1] += result[7][1]
+                        telemetry.merge(result[8])
+                        if result[6]: vprint(result[6])
+                    if args.workers > 1:
+                        procs.close()
+                        procs.join()
+                times["metrics"] = s.seconds
+                vprint("metrics: {} tickers in {:.2f}s".format(
+                       len(tasks), times["metrics"]))
+
+    except Exception as err_msg:
+
+        epack = common.handle(err_msg, epack)
+        con.rollback()
+
+
+    ##########################################################################
+    # reporting
+    ##########################################################################
+
+    if not args.no_report:
+
+        msg  = "Total Time is {:.2f}m\n".format((time() - t00)/60)
+        msg += "INFO: File(s): {}\n".format(", ".join(args.files))
+        msg += "INFO: DB Insertion: {}\n".format(not args.no_insert)
+        msg += "INFO: Rows read {}, written {}, rejected {}\n".format(
+               read, written, sum(rejects.values()))
+        for reason, n in sorted(rejects.items()):
+            msg += " {:>15s}: {}\n".format(reason, n)
+        msg += "INFO: Symbols loaded {}, weekly rows {}\n".format(
+               len(firsts), weekly_rows)
+        for stage, secs in times.items():
+            msg += " {:>15s}: {:.2f}s\n".format(stage, secs)
+        msg += "INFO: Statements (slowest first):\n" + queries.report()
+
+        if not epack[1]: msg += "ERRORS: None\n"
+        else: msg += "{}\n".format(epack[0])
+
+        f = open(home + "/logs/{}_ingest.log".format(today), "a")
+        f.write("#"*79 + '\n')
+        f.write(now.ctime() + '\n')
+        f.write(msg)
+        f.close()
+
+    else:
+
+        msg = "...reporting turned off!\n"
+
+
+    # finally
+    telemetry.count("rows_read_total", read)
+    telemetry.count("rows_written_total", written, table="daily_data")
+    for reason, n in rejects.items():
+        telemetry.count("rows_rejected_total", n, reason=reason)
+    telemetry.count("errors_total", epack[1])
+    telemetry.write("ingest", home + "/logs/{}_telemetry.jsonl".format(today),
+                    conf.get("telemetry_textfile_dir"))
+    pool.put(con)
+    vprint(msg)
@@ -0,0 +1,56 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#
+##############################################################################
+
+# standard python library imports
+import importlib
+import sys
+
+
+##############################################################################
+# Local Class Definitions
+##############################################################################
+
+class LazyModule(object):
+    """
+    Stand-in for a module which imports it on the first attribute looked up,
+    then copies its attributes in so later lookups cost no more than on the
+    module itself. importlib holds the import lock, so threads racing on the
+    first lookup all get the one module.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_lazy_name"] = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._lazy_name)
+        self.__dict__.update(vars(module))
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module {!r}>".format(self._lazy_name)
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def load(name):
+    """
+    INPUTS:
+        name (str) - Module to import, i.e. "pandas" or "bokeh.plotting"
+    OUTPUT:
+        The module if already imported, otherwise a LazyModule importing it
+        on first use, so -h and other paths that never touch it skip the
+        cost. A missing module raises ImportError at that first use.
+    """
+
+    if name in sys.modules: return sys.modules[name]
+
+    return LazyModule(name)
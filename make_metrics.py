@@ -26,21 +26,41 @@
 
 # standard python library imports
 import argparse
+import collections
 import datetime as dt
-from itertools import islice
+import multiprocessing
 import os
 import sys
 from time import time as t
 import warnings
 
-# third party python imports
-import pandas as pd                              # conda install panda
+# third party python imports, each loaded on first use (see lazy.py)
+import lazy
+np = lazy.load("numpy")                          # conda install numpy
+pd = lazy.load("pandas")                         # conda install pandas
 
 # local imports
 home = "/home/mcollier/ONYX/wealth/portfolio"
 local_paths = [os.path.join(home, "scripts"), ]
-sys.path.insert(0, [p for p in local_paths if p not in sys.path])
+sys.path[:0] = [p for p in local_paths if p not in sys.path]
 import common
+import indicators
+import queries
+import storage
+import telemetry
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# stored metrics which seed the next calculation
+SEEDS = ["ema12", "ema26", "ema50", "force", "force2", "tr", "atr13",
+         "macds", "impulse", "ad"]
+
+# columns of the metrics_state table, one row per (symbol, span)
+STATE = ["symbol_id", "span", "price_date", "close", "volume", "ema12",
+         "ema26", "ema50", "force2", "atr13", "macds", "updated"]
 
 
 ##############################################################################
@@ -57,17 +77,19 @@ def calc_ema(smoothed, new_data, N=22):
         Exponential Moving Average as a pandas Series
     """
 
-    K = 2/(N + 1)    # coefficient for incoming datum
-    J = 1 - K        # coefficient for fading data
+    if not len(new_data.index): return smoothed
 
-  # if first smoothed, use last data value
-    if not len(smoothed.index):
-        smoothed[new_data.index.values[0]] = new_data[0]
+  # if first smoothed (or last one is NULL), use last data value
+    values = new_data.values.astype(float)
+    if len(smoothed.index) and pd.notnull(smoothed.iloc[0]):
+        seed = float(smoothed.iloc[0])
+    else:
+        seed = values[0]
 
-    for n,index in enumerate(new_data[1:].index, start=1):
-        smoothed[index] = K*new_data[n] + J*smoothed[n-1]
+    ema = indicators.ema(values[1:], seed, N)
 
-    return smoothed
+    return pd.Series(np.append(seed, ema), index=new_data.index,
+                     name=smoothed.name)
 
 
 def calc_force(force, new_closes, new_volumes):
@@ -80,10 +102,8 @@ def calc_force(force, new_closes, new_volumes):
         Force index as a pandas Series.
     """
 
-    for n,index in enumerate(new_closes[1:].index, start=1):
-        force[index] = ( new_closes[n] - new_closes[n-1] )*new_volumes[n]
-
-    return force
+    return extend(force, new_closes,
+                  indicators.force(new_closes, new_volumes))
 
 
 def calc_tr(tr, new_highs, new_lows, new_closes):
@@ -96,11 +116,9 @@ def calc_tr(tr, new_highs, new_lows, new_closes):
     OUTPUT:
         True Range as a pandas Series
     """
-    for n,index in enumerate(new_highs[1:].index, start=1):
-        tr[index] = max(  [abs(new_highs[n] -   new_lows[n]  ),
-                           abs(new_highs[n] - new_closes[n-1]),
-                           abs( new_lows[n] - new_closes[n-1])]  )
-    return tr
+
+    return extend(tr, new_highs,
+                  indicators.true_range(new_highs, new_lows, new_closes))
 
 
 def calc_impulse(impulse, macdh, ema12):
@@ -113,24 +131,22 @@ def calc_impulse(impulse, macdh, ema12):
         Impulse as a pandas Series
     """
 
-    # take first order differences
-    ema12_diff = ema12 - ema12.shift(1)
-    macdh_diff = macdh - macdh.shift(1)
+    return extend(impulse, ema12, indicators.impulse(ema12, macdh))
 
-    # drop the first elements (NaN)
-    ema12_diff = ema12_diff.drop(ema12_diff.index[[0,]])
-    macdh_diff = macdh_diff.drop(macdh_diff.index[[0,]])
 
-    # get individual signs
-    sign = lambda x: (1, -1)[x < 0] if x != 0 else 0
-    ema12_diff = ema12_diff.apply(sign)
-    macdh_diff = macdh_diff.apply(sign)
-
-    # combine individual signs into single impulse encoding
-    condense = lambda x: -1 if x == -2 else 1 if x == 2 else 0
-    new = (ema12_diff + macdh_diff).apply(condense)
+def extend(last, new_data, values):
+    """
+    INPUTS:
+        last (Series) - A copy of last record's value (may be empty)
+        new_data (Series) - New values, prepended with last value
+        values (ndarray) - Kernel output aligned with new_data
+    OUTPUT:
+        The last record's value followed by values[1:] as a pandas Series
+    """
 
-    return impulse.append(new)
+    return pd.Series(np.append(last.values.astype(float), values[1:]),
+                     index=last.index.append(new_data.index[1:]),
+                     name=last.name)
 
 
 def make_metrics(con, span, ticker_id, today):
@@ -145,19 +161,16 @@ def make_metrics(con, span, ticker_id, today):
     """
 
     # get last record(s) from the time span's metrics table
-    sql = ("SELECT * FROM {}_metrics WHERE symbol_id={}"
-           " ORDER BY price_date DESC LIMIT 1;")
-    metrics = pd.read_sql_query(sql.format(span, ticker_id),
-                                con, index_col="price_date").drop('id', 1)
+    metrics = queries.frame(con, "last_metrics", {"symbol_id": ticker_id},
+                            span=span, index_col="price_date").drop('id',
+                                                                    axis=1)
     if not len(metrics.index): price_date = "2000-01-03"
     else: price_date = metrics.index[0]
 
     # pull necessary data from the span's data table
-    sql = """SELECT price_date, high, low, close, volume FROM {}_data
-             WHERE symbol_id={} AND price_date BETWEEN "{}" AND "{}"
-             ORDER BY price_date;"""
-    data = pd.read_sql_query(sql.format(span, ticker_id, price_date, today),
-                             con, index_col="price_date", coerce_float=True)
+    params = {"symbol_id": ticker_id, "begin": price_date, "today": today}
+    data = queries.frame(con, "data_between", params, span=span,
+                         index_col="price_date", coerce_float=True)
     #data = pd.DataFrame.from_csv("./data/wmt_daily_df.csv")
     #metrics = pd.DataFrame(columns=cols.split(", "))
     #pd.set_option('display.width', 180)
@@ -187,13 +200,16 @@ def make_metrics(con, span, ticker_id, today):
     impulse = calc_impulse(metrics.impulse[:], macdh, ema12).rename("impulse")
 
     # stock price is above or below the ema (1 or -1, default of 0)
-    sign = lambda x: (1, -1)[x < 0] if x != 0 else 0
-    gt12 = ( data.close - ema12 ).apply(sign).rename("gt12")
-    gt26 = ( data.close - ema26 ).apply(sign).rename("gt26")
-    gt50 = ( data.close - ema50 ).apply(sign).rename("gt50")
+    sign = lambda x, name: pd.Series(indicators.sign(x), index=data.index,
+                                     name=name)
+    gt12 = sign(data.close - ema12, "gt12")
+    gt26 = sign(data.close - ema26, "gt26")
+    gt50 = sign(data.close - ema50, "gt50")
 
     # stock price advances or declines (1 or -1, default of 0)
-    ad = (data.close - data.close.shift(1)).apply(sign).rename("ad")
+    closes = data.close.values
+    ad = extend(metrics.ad[:], data.close,
+                indicators.sign(closes - np.append(np.nan, closes[:-1])))
 
     # wrap up the results into a return dataframe
     metrics = pd.concat([ema12, ema26, ema50, force, force2, tr, atr13,
@@ -206,48 +222,422 @@ def make_metrics(con, span, ticker_id, today):
     return metrics
 
 
-def data_replace(con, span, metrics):
+def make_panel_metrics(con, span, ticker_ids, today):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        span (str) - Specify "daily" or "weekly"
+        ticker_ids (list) - Unique symbol ids from symbols table
+        today (str) - ISO 8601 date string of form YYYY-MM-DD
+    OUTPUT:
+        Tuple of all basic metrics for every ticker in one pandas dataframe
+        (see calc_panel), and the list of state rows to store for them.
+    """
+
+    if not len(ticker_ids): return (pd.DataFrame(), [])
+
+    # get every symbol's last record from the time span's metrics table
+    ids = tuple([int(ticker_id) for ticker_id in ticker_ids])
+    stored = queries.frame(con, "panel_metrics", {"ids": ids}, span=span,
+                           index_col="symbol_id")
+
+    # pull data for all symbols, each from its own last metrics date onward
+    data = queries.frame(con, "panel_data", {"ids": ids, "today": today},
+                         span=span, coerce_float=True)
+    if not len(data.index): return (pd.DataFrame(), [])
+
+    metrics = calc_panel(data, stored, today)
+
+    return (metrics, make_states(span, metrics, data))
+
+
+def make_incremental_metrics(con, span, ticker_id, state, today,
+                             limit=None):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        span (str) - Specify "daily" or "weekly"
+        ticker_id (int) - Unique symbol id from symbols table
+        state (Series) - The ticker's metrics_state row, or None to start
+                         from the beginning of the ticker's history
+        today (str) - ISO 8601 date string of form YYYY-MM-DD
+        limit (int) - Most bars to read, default is all of them
+    OUTPUT:
+        Tuple of metrics for bars newer than the state (see calc_panel), and
+        the list of state rows to store. Only the new bars are read.
+    """
+
+    # pull only the bars after the stored state
+    params = {"symbol_id": ticker_id, "today": today, "limit": limit,
+              "after": "2000-01-02" if state is None else state.price_date}
+    name = "data_after_limit" if limit else "data_after"
+    new = queries.frame(con, name, params, span=span, coerce_float=True)
+    if not len(new.index): return (pd.DataFrame(), [])
+    if state is None:
+        metrics = calc_panel(new, pd.DataFrame(), today)
+        return (metrics, make_states(span, metrics, new))
+
+    # prepend the state as the seed row, then drop it from the results
+    seed = pd.DataFrame({"symbol_id": [ticker_id],
+                         "price_date": [state.price_date],
+                         "high": [np.nan], "low": [np.nan],
+                         "close": [state.close], "volume": [state.volume]})
+    data = pd.concat([seed, new], ignore_index=True)
+    stored = pd.DataFrame([state]).set_index("symbol_id")
+    metrics = calc_panel(data, stored, today)
+    metrics = metrics[metrics.index != state.price_date]
+
+    return (metrics, make_states(span, metrics, data))
+
+
+def backfill_metrics(con, span, ticker_id, state, today, chunk=2500):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        span (str) - Specify "daily" or "weekly"
+        ticker_id (int) - Unique symbol id from symbols table
+        state (Series) - The ticker's metrics_state row, or None to seed
+                         from its last metrics row (if any)
+        today (str) - ISO 8601 date string of form YYYY-MM-DD
+        chunk (int) - Most bars read and calculated at a time
+    OUTPUT:
+        Generator of (metrics, state rows) tuples, one per chunk in date
+        order. The state is carried from one chunk to the next, so memory
+        stays flat however long the history is.
+    """
+
+    if state is None: state = read_seed_state(con, span, ticker_id)
+
+    while True:
+        metrics, states = make_incremental_metrics(con, span, ticker_id,
+                                                   state, today, chunk)
+        if not len(metrics.index): return
+        yield (metrics, states)
+        if len(metrics.index) < chunk: return
+        state = pd.Series(dict(zip(STATE, states[0])))
+
+
+def read_seed_state(con, span, ticker_id):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        span (str) - Specify "daily" or "weekly"
+        ticker_id (int) - Unique symbol id from symbols table
+    OUTPUT:
+        A metrics_state like row (Series) built from the ticker's last
+        metrics row and that day's bar, or None if it has no metrics yet.
+    """
+
+    seed = queries.frame(con, "seed_state", {"symbol_id": ticker_id},
+                         span=span, coerce_float=True)
+    if not len(seed.index): return None
+
+    return seed.iloc[0]
+
+
+def calc_panel(data, stored, today):
+    """
+    INPUTS:
+        data (DataFrame) - Rows of symbol_id, price_date, high, low, close,
+                           volume. Each symbol's first row is its seed row.
+        stored (DataFrame) - Seed metrics indexed by symbol_id (may be empty)
+        today (str) - ISO 8601 date string of form YYYY-MM-DD
+    OUTPUT:
+        All basic metrics for every symbol returned in one pandas dataframe,
+        grouped by symbol_id and in date order within each symbol. Same
+        columns as make_metrics(), computed in a single vectorized pass.
+    """
+
+    # pivot into date x symbol, then pack each symbol's bars to the top so
+    # that row 0 is every symbol's seed row and padding is only trailing
+    panel = data.pivot(index="price_date", columns="symbol_id")
+    symbols = panel["close"].columns
+    order = np.argsort(panel["close"].isnull().values, axis=0, kind="stable")
+    pack = lambda a: np.take_along_axis(np.asarray(a), order, axis=0)
+    h, l, c, v = [pack(panel[k].values.astype(float))
+                  for k in ["high", "low", "close", "volume"]]
+    dates = pack(np.repeat(panel.index.values[:, None], len(symbols), 1))
+    valid = np.logical_not(np.isnan(c))
+    stored = stored.reindex(index=symbols, columns=SEEDS)
+    seed = lambda col: stored[col].values.astype(float)
+
+    def smooth(x, last, N):
+        # seed from the stored value, else from the first datum available
+        first = x[0] if len(x) == 1 else np.where(np.isnan(x[0]), x[1], x[0])
+        start = np.where(np.isnan(last), first, last)
+        ema = np.empty_like(x)
+        ema[0] = np.where(np.isnan(x[0]) & np.isnan(last), np.nan, start)
+        ema[1:] = indicators.ema(x[1:], start, N)
+        return ema
+
+    def prepend(last, new):
+        # put the stored value on the seed row in front of new rows
+        return np.concatenate([last[None, :], new], axis=0)
+
+    # Exponential Moving Averages of the price data
+    ema12 = smooth(c, seed("ema12"), N=12)
+    ema26 = smooth(c, seed("ema26"), N=26)
+    ema50 = smooth(c, seed("ema50"), N=50)
+
+    # Force, and smoothed 2-day version
+    force = prepend(seed("force"), indicators.force(c, v)[1:])
+    force2 = smooth(force, seed("force2"), N=2)
+
+    # Average True Range, and smoothed 13-day version
+    tr = prepend(seed("tr"), indicators.true_range(h, l, c)[1:])
+    atr13 = smooth(tr, seed("atr13"), N=13)
+
+    # Moving Average Convergence Divergence family
+    macdf = ema12 - ema26                                # MACD Fast Line
+    macds = smooth(macdf, seed("macds"), N=9)            # MACD Slow (signal)
+    macdh = macdf - macds                                # MACD Histogram
+
+    # Impulse
+    impulse = prepend(seed("impulse"), indicators.impulse(ema12, macdh)[1:])
+
+    # stock price above or below the ema, advances or declines (1, -1, 0)
+    gt12 = indicators.sign(c - ema12)
+    gt26 = indicators.sign(c - ema26)
+    gt50 = indicators.sign(c - ema50)
+    ad = prepend(seed("ad"), indicators.sign(c[1:] - c[:-1]))
+
+    # unpack symbol by symbol into a return dataframe
+    unpack = lambda a: np.asarray(a).T[valid.T]
+    columns = [("ema12", ema12), ("ema26", ema26), ("ema50", ema50),
+               ("force", force), ("force2", force2), ("tr", tr),
+               ("atr13", atr13), ("macdf", macdf), ("macds", macds),
+               ("macdh", macdh), ("impulse", impulse), ("gt12", gt12),
+               ("gt26", gt26), ("gt50", gt50), ("ad", ad)]
+    metrics = pd.DataFrame(dict([(k, unpack(a)) for k, a in columns]),
+                           columns=[k for k, a in columns],
+                           index=pd.Index(unpack(dates), name="price_date"))
+    metrics.insert(0, "symbol_id",
+                   unpack(np.repeat(symbols.values[None, :], len(c), 0)))
+    metrics['last_update'] = today
+    metrics = metrics.where((pd.notnull(metrics)), None)
+
+    return metrics
+
+
+def make_states(span, metrics, data):
+    """
+    INPUTS:
+        span (str) - Specify "daily" or "weekly"
+        metrics (DataFrame) - Metrics as returned by calc_panel()
+        data (DataFrame) - The bars those metrics were calculated from
+    OUTPUT:
+        List of tuples for the metrics_state table, one per symbol, with its
+        last bar's close and volume next to the metrics that seed the next
+        run.
+    """
+
+    if not len(metrics.index): return []
+
+    last = metrics.reset_index().groupby("symbol_id").tail(1)
+    bars = data[["symbol_id", "price_date", "close", "volume"]]
+    last = last.astype({"symbol_id": bars.symbol_id.dtype})
+    last = last.merge(bars, how="left", on=["symbol_id", "price_date"])
+    last["span"] = span
+    last = last.rename(columns={"last_update": "updated"})[STATE]
+
+    # round as the database will, so carried state matches stored state
+    values = STATE[3:-1]
+    last[values] = last[values].astype(float).round(4)
+    last["force2"] = last["force2"].round(0)
+    last = last.astype(object).where(pd.notnull(last), None)
+
+    return [tuple(row) for row in last.values]
+
+
+def read_states(con, span):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        span (str) - Specify "daily" or "weekly"
+    OUTPUT:
+        Dictionary of metrics_state rows (Series) keyed by symbol_id. Only
+        states dated the same as the symbol's last metrics row are returned,
+        so any mismatch falls back to recomputing that symbol.
+    """
+
+    states = queries.frame(con, "states", {"span": span}, span=span,
+                           coerce_float=True)
+
+    return dict([(row.symbol_id, row) for i, row in states.iterrows()])
+
+
+def ticker_metrics(con, span, ticker_id, states, today):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        span (str) - Specify "daily" or "weekly"
+        ticker_id (int) - Unique symbol id from symbols table
+        states (dict) - From read_states(), or None to ignore the state table
+        today (str) - ISO 8601 date string of form YYYY-MM-DD
+    OUTPUT:
+        Tuple of the ticker's metrics dataframe and its state rows. With a
+        matching state only the new bars are read, otherwise the ticker is
+        recomputed from its last metrics row.
+    """
+
+    if states is None:
+        return (make_metrics(con, span, ticker_id, today), [])
+    elif ticker_id in states:
+        return make_incremental_metrics(con, span, ticker_id,
+                                        states[ticker_id], today)
+    else:
+        return make_panel_metrics(con, span, [ticker_id], today)
+
+
+def data_replace(con, span, metrics, batch_size=5000, infile=False):
     """
     INPUTS:
         con (mysql) - pymysql database connection
         span (str) - Specify "daily" or "weekly"
         metrics (list) - List of tuples of metrics
+        batch_size (int) - Number of rows per multi-row INSERT
+        infile (bool) - Stage through LOAD DATA LOCAL INFILE (backfills)
     OUTPUT:
-        Data replacement with homebrew method. A discussion on mysql 'replace'
-        is at code.openark.org/blog/mysql/replace-into-think-twice.
+        Number of rows written with INSERT ... ON DUPLICATE KEY UPDATE. A
+        discussion on mysql 'replace' is at
+        code.openark.org/blog/mysql/replace-into-think-twice.
     """
 
-    # pre-loop sql/data preparation
     table = "{}_metrics".format(span)
     cols = ["price_date", "symbol_id", "ema12", "ema26", "ema50",
             "force", "force2", "tr", "atr13", "macdf", "macds",
             "macdh", "impulse", "gt12", "gt26", "gt50", "ad", "updated"]
-    cols = ["`{}`".format(s) for s in cols]
-    header = ",".join(cols)
-    esses = ("%s,"*len(cols))[:-1]
-    insert = "INSERT INTO {} ({}) VALUES ({})".format(table, header, esses)
 
-    with con.cursor() as cur:  # cur = con.cursor()
+    if infile:
+        return common.load_infile(con, table, cols, metrics)
+    else:
+        return common.bulk_upsert(con, table, cols, metrics,
+                                  batch_size=batch_size)
 
-        # loop over rows, finish the sql and execute it
-        for row in metrics:
-            update = "UPDATE " + ",".join(["{}={}".format(r[0], r[1])
-                                     for r in islice(zip(cols, row), 2, None)])
-            sql = "{} ON DUPLICATE KEY {}".format(insert, update)
-            sql = sql[:-10] + "'" + sql[-10:] + "';"
-            results = cur.execute(sql.replace("None", "NULL"), row)
 
-    return results
+def state_replace(con, states):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        states (list) - List of tuples from make_states()
+    OUTPUT:
+        Number of rows written to the metrics_state table. The caller commits
+        them in the same transaction as the metrics.
+    """
+
+    return common.bulk_upsert(con, "metrics_state", STATE, states)
+
+
+def tuplefy(df):
+    """
+    INPUTS:
+        df (DataFrame) - Metrics indexed by price_date
+    OUTPUT:
+        List of tuples, one per row, led by the ISO 8601 price date.
+    """
+
+    return [tuple(["{}".format(i.isoformat()), *list(r.values)])
+            for i,r in df.iterrows()]
+
+
+def init_worker(conf, states, today, opts):
+    """
+    INPUTS:
+        conf (dict) - Configuration from hf.conf, or a pair of open
+                      connections for writing and for reading
+        states (dict) - read_states() by span, empty to ignore the state table
+        today (str) - ISO 8601 date string of form YYYY-MM-DD
+        opts (dict) - Command line options (no_insert, no_state, ...)
+    OUTPUT:
+        Side effect of setting up this process' own connections and working
+        objects for work(). Called once per process in the pool. Reads go
+        to the read replica if opts["replica"] is set and one is configured.
+    """
+
+    global worker
+    if isinstance(conf, dict):
+        telemetry.drain()  # in case it was forked with the parent's
+        con = common.get_connection(conf)
+        if opts.get("replica"): rcon = common.get_connection(conf, True)
+        else: rcon = con
+    else:
+        con, rcon = conf
+    worker = {"con": con, "rcon": rcon, "states": states, "today": today,
+              "opts": opts}
+
+
+def work(task):
+    """
+    INPUTS:
+        task (tuple) - (t_key, ticker_id) of one ticker to process
+    OUTPUT:
+        Tuple of t_key, process id, seconds elapsed, metrics rows written,
+        seconds spent writing, per-span times, error note, an epack of any
+        errors, and a telemetry.drain() snapshot for the caller to merge.
+        The ticker is committed or rolled back on its own, or chunk by
+        chunk when backfilling.
+    """
+
+    t_key, ticker_id = task
+    con, opts, today = worker["con"], worker["opts"], worker["today"]
+    rcon = worker["rcon"]
+    t0 = t()
+    written, t_write, times, err = 0, 0.0, '', ''
+    epack = ['', 0]
+
+    try:
+
+        for span in ["daily",                              # span = "daily"
+                     "weekly"]:                            # span = "weekly"
+            with telemetry.span("metrics", t_key, span=span) as s1:
+                states = worker["states"].get(span)
+                if opts["backfill"]:
+                    chunks = backfill_metrics(rcon, span, ticker_id,
+                                              (states or {}).get(ticker_id),
+                                              today, opts["chunk"])
+                else:
+                    chunks = [ticker_metrics(rcon, span, ticker_id, states,
+                                             today)]
+
+                for metrics, state in chunks:
+                    metrics = tuplefy(metrics)
+                    if opts["no_insert"]: continue
+                    with telemetry.span("metrics_write", span=span) as s2:
+                        rows = data_replace(con, span, metrics,
+                                            opts["batch_size"],
+                                            opts["load_infile"])
+                        if not opts["no_state"]: state_replace(con, state)
+                        if opts["backfill"]: con.commit()
+                    telemetry.count("rows_written_total", rows,
+                                    table=span + "_metrics")
+                    written += rows
+                    t_write += s2.seconds
+            times += ", {}: {:6.2f}".format(span, s1.seconds)
+
+        con.commit()
+
+    except Exception as err_msg:
+
+        err = "ERROR on {} {}".format(span, t_key)
+        epack = common.handle(err_msg, epack)
+        con.rollback()
+
+    return (t_key, os.getpid(), t()-t0, written, t_write, times, err, epack,
+            telemetry.drain())
 
 
 ##############################################################################
-# Treat this file as a script if invoked as __main__
+# Main, run as a script or as a stage of run_daily.py
 ##############################################################################
 
-if __name__ == "__main__":
-
-    # load configuration from commented JSON into dictionary
-    conf = common.get_config("/etc/local/hf.conf")
+def main(argv=None, conf=None):
+    """
+    INPUTS:
+        argv (list) - Command line arguments, sys.argv[1:] if None
+        conf (dict) - Configuration from hf.conf, loaded here if None
+    OUTPUT:
+        epack of any errors, after writing daily and weekly metrics.
+    """
 
     # assign parsed commandline values to working objects
     p = argparse.ArgumentParser()
@@ -255,11 +645,33 @@ if __name__ == "__main__":
         help="pull a single ticker... i.e. -s WMT")
     p.add_argument("-v", "--verbose", action="store_true",
         help="print extra information on stdout")
+    p.add_argument("-w", "--workers", default=1, type=int,
+        help="number of processes sharing the tickers... i.e. -w 8")
+    p.add_argument("-b", "--batch_size", default=5000, type=int,
+        help="number of metrics rows per multi-row insert... i.e. -b 10000")
+    p.add_argument("-B", "--backfill", action="store_true",
+        help="stream history in chunks, committing each (resumable)")
+    p.add_argument("-c", "--chunk", default=2500, type=int,
+        help="number of bars per backfill chunk... i.e. -c 1000")
+    p.add_argument("-L", "--load_infile", action="store_true",
+        help="stage writes through LOAD DATA LOCAL INFILE (full backfills)")
     p.add_argument("-N", "--no_insert", action="store_true",
         help="suppress insertion of data into db tables if true")
+    p.add_argument("-P", "--panel", action="store_true",
+        help="calculate all tickers together in one vectorized pass")
+    p.add_argument("-r", "--resume", action="store_true",
+        help="skip tickers today's journal shows finished")
     p.add_argument("-R", "--no_report", action="store_true",
         help="option to suppress reporting at end")
-    args = p.parse_args()
+    p.add_argument("-X", "--replica", action="store_true",
+        help="read from the db_replica_host replica (must be caught up)")
+    p.add_argument("-S", "--no_state", action="store_true",
+        help="ignore the metrics_state table and reread the last metrics")
+    args = p.parse_args(argv)
+
+    # load configuration from commented JSON into dictionary
+    if conf is None: conf = common.get_config("/etc/local/hf.conf")
+    if not storage.processes(conf): args.workers = 1  # i.e. duckdb
 
     # set up functions and parameters
     vprint = print if args.verbose else lambda *a, **k: None
@@ -269,48 +681,111 @@ if __name__ == "__main__":
     now = dt.datetime.today()
     today = now.date().isoformat()
     warnings.filterwarnings("ignore")  # ignore Decimal(19,4) truncation
-    con = common.get_connection(conf)
-    tuplefy = lambda df: [ tuple(["{}".format(i.isoformat()),
-                                  *list(r.values)]) for i,r in df.iterrows()]
+    pool = common.get_pool(conf)
+    con = pool.get()
+    rpool = common.get_pool(conf, replica=args.replica)
+    rcon = rpool.get() if rpool is not pool else con
+    journal = common.Journal(home + "/logs/{}_metrics.journal".format(today),
+                             args.resume)
     lentickers, tickers = common.read_tickers(con, args.single)
     t_keys = list(tickers.keys())
     t_keys.sort()
+    t_keys = [t_key for t_key in t_keys if not journal.done(t_key, "metrics")]
     count, t00 = 0, t()
+    written, t_write = 0, 0.0
+    pids = collections.defaultdict(lambda: [0, 0.0])
 
-    # calculate metrics for each ticker symbol
-    vprint("Calculating metrics for each ticker symbol...")
-    for t_key in t_keys:
+    # read the stored states, matched against the metrics tables; without
+    # a metrics_state table (older installs, see README) run as with -S
+    states = dict()
+    if not args.no_state:
+        try:
+            for span in ["daily", "weekly"]:
+                states[span] = read_states(rcon, span)
+        except Exception as err_msg:
+            wpack = common.handle("metrics_state unreadable, running as with "
+                                  "-S: {}".format(err_msg), wpack)
+            rcon.rollback()
+            states, args.no_state = dict(), True
+
+    # calculate metrics for all ticker symbols at once
+    if args.panel and not args.backfill:
 
-        ticker_id = tickers[t_key][0]        # t_key, ticker_id = "TPR", 507
-        t0 = t()
+        vprint("Calculating metrics for all ticker symbols at once...")
+        ticker_ids = [tickers[t_key][0] for t_key in t_keys]
         err = ''
-        times = "({}/{}) {:>5s} Total: {:6.2f}"
+        times = "(panel) {:>5d} tickers".format(len(t_keys))
 
         try:
 
-            for span in ["daily",                          # span = "daily"
-                         "weekly"]:                        # span = "weekly"
-                t1 = t()
-                metrics = make_metrics(con, span, ticker_id, today)
-                metrics = tuplefy(metrics)
-                if not args.no_insert:
-                    data_replace(con, span, metrics)
-                times += ", {}: {:6.2f}".format(span, t()-t1)
+            for span in ["daily", "weekly"]:
+                with telemetry.span("metrics_panel", span=span) as s1:
+                    metrics, state = make_panel_metrics(rcon, span,
+                                                        ticker_ids, today)
+                    metrics = tuplefy(metrics)
+                    if not args.no_insert:
+                        with telemetry.span("metrics_write", span=span) as s2:
+                            rows = data_replace(con, span, metrics,
+                                                args.batch_size,
+                                                args.load_infile)
+                            if not args.no_state: state_replace(con, state)
+                        telemetry.count("rows_written_total", rows,
+                                        table=span + "_metrics")
+                        written += rows
+                        t_write += s2.seconds
+                times += ", {}: {:6.2f}".format(span, s1.seconds)
 
             con.commit()
+            if not args.no_insert: journal.record(t_keys, "metrics")
 
         except Exception as err_msg:
 
-            err = "ERROR on {} {}".format(span, t_key)
+            err = "ERROR on {} panel".format(span)
             epack = common.handle(err_msg, epack)
             con.rollback()
 
         finally:
 
+            vprint(times + ", Total: {:6.2f}  ".format(t()-t00) + err)
+
+    else:
+
+        # calculate metrics for each ticker symbol, optionally in a pool
+        vprint("Calculating metrics for each ticker symbol...")
+        tasks = [(t_key, tickers[t_key][0]) for t_key in t_keys]
+        setup = (states, today, vars(args))
+        if args.workers > 1:
+            # forkserver, as run_daily.py calls this from a thread, and a
+            # fork then could copy a lock some other thread holds
+            context = multiprocessing.get_context("forkserver")
+            procs = context.Pool(args.workers, init_worker, (conf,) + setup)
+            results = procs.imap_unordered(work, tasks)
+        else:
+            init_worker((con, rcon), *setup)
+            results = map(work, tasks)
+
+        for result in results:
+
+            t_key, pid, elapsed, rows, secs, spans, err, pack, seen = result
+            telemetry.merge(seen)
+            written += rows
+            t_write += secs
+            epack[0] += pack[0]
+            epack[1] += pack[1]
+            pids[pid][0] += 1
+            pids[pid][1] += elapsed
             count += 1
-            vprint(times.format(count, lentickers, t_key, t()-t0) + "  " + err)
+            if not err and not args.no_insert:
+                journal.record([t_key, ], "metrics")
+            times = "({}/{}) {:>5s} Total: {:6.2f}{}"
+            vprint(times.format(count, lentickers, t_key, elapsed, spans)
+                   + "  " + err)
             # first run took 11.6hrs
 
+        if args.workers > 1:
+            procs.close()
+            procs.join()
+
 
     ##########################################################################
     # reporting
@@ -321,10 +796,23 @@ if __name__ == "__main__":
         vprint("Reporting...\n")
         msg = "OPTIONS:\n"
         msg += " single: {}\n verbose: {}\n no_insert: {}\n no_report: {}\n"
+        msg += " panel: {}\n batch_size: {}\n load_infile: {}\n"
+        msg += " no_state: {}\n workers: {}\n backfill: {}\n chunk: {}\n"
+        msg += " resume: {}\n replica: {}\n"
         msg = msg.format(args.single if args.single else False, args.verbose,
-                         args.no_insert, args.no_report)
+                         args.no_insert, args.no_report, args.panel,
+                         args.batch_size, args.load_infile, args.no_state,
+                         args.workers, args.backfill, args.chunk, args.resume,
+                         args.replica)
         msg += "TIME ELAPSED:\n"
         msg += " Processing all span-key pairs took: {:.2f}\n".format(t()-t00)
+        rate = written/t_write if t_write else 0
+        msg += (" Writing {} metrics rows took: {:.2f} ({:.0f} rows/s)\n"
+                .format(written, t_write, rate))
+        for pid, (n, secs) in sorted(pids.items()):
+            msg += " Worker {}: {} tickers took {:.2f}\n".format(pid, n, secs)
+        msg += "QUERIES (this process):\n" + queries.report()
+        if wpack[1]: msg += "{}\n".format(wpack[0])
         if not epack[1]: msg += "ERRORS: None\n"
         else: msg += "{}\n".format(epack[0])
 
@@ -338,7 +826,24 @@ if __name__ == "__main__":
         msg = "reporting turned off!\n"
 
     # finally
+    telemetry.count("tickers_total", len(t_keys))
+    telemetry.count("errors_total", epack[1])
+    telemetry.count("warnings_total", wpack[1])
+    telemetry.write("metrics", home + "/logs/{}_telemetry.jsonl".format(today),
+                    conf.get("telemetry_textfile_dir"))
     vprint(msg)
     vprint(epack[0])
-    con.close()
+    journal.close()
+    if rcon is not con: rpool.put(rcon)
+    pool.put(con)
+
+    return epack
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
 
+    main()
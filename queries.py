@@ -0,0 +1,338 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#   move the generated multi-row statements (bulk_upsert, ...) in here?
+#
+##############################################################################
+
+# standard python library imports
+import collections
+from contextlib import contextmanager
+import threading
+from time import time
+
+# third party library imports, each loaded on first use (see lazy.py)
+import lazy
+pd = lazy.load("pandas")                         # conda install pandas
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# identifiers which can't be bound as parameters, and their allowed values
+IDENTS = {"span": ["daily", "weekly"],
+          "table": ["daily_data", "weekly_data", "daily_metrics",
+                    "weekly_metrics", "metrics_state", "symbols"],
+          "comparison": ['<>"i"', '="i"', '="a"', '="n"', " IS NOT NULL"]}
+
+# named statements; {identifiers} are filled in once by statement(), and
+# values are always %(name)s (or positional %s for executemany) parameters
+STATEMENTS = {
+
+    # common
+    "tickers": """SELECT ticker, id, flag, name, sector, last_update
+                  FROM symbols WHERE flag{comparison}""",
+    "ticker": """SELECT ticker, id, flag, name, sector, last_update
+                 FROM symbols WHERE flag{comparison} AND ticker=%(ticker)s""",
+    "last_price_date": """SELECT max(price_date) FROM {table}
+                          WHERE symbol_id=%(symbol_id)s""",
+    "last_price_dates": """SELECT symbol_id, max(price_date) FROM {table}
+                           GROUP BY symbol_id""",
+
+    # get_tickers
+    "insert_symbols": """INSERT INTO symbols (ticker, instrument, name,
+                                              sector, currency, inserted,
+                                              last_update)
+                         VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+
+    # get_timeseries
+    "weekly_source": """SELECT daily_data.* FROM daily_data
+                        LEFT JOIN (SELECT symbol_id, max(price_date) AS last
+                                   FROM weekly_data GROUP BY symbol_id)
+                                  AS grouped
+                        ON daily_data.symbol_id = grouped.symbol_id
+                        WHERE daily_data.symbol_id IN %(ids)s
+                        AND daily_data.price_date >
+                            DATE_SUB(COALESCE(grouped.last, "2000-01-07"),
+                                     INTERVAL 7 DAY)
+                        AND daily_data.price_date <= %(today)s
+                        ORDER BY daily_data.symbol_id,
+                                 daily_data.price_date""",
+
+    # make_metrics
+    "last_metrics": """SELECT * FROM {span}_metrics
+                       WHERE symbol_id=%(symbol_id)s
+                       ORDER BY price_date DESC LIMIT 1""",
+    "data_between": """SELECT price_date, high, low, close, volume
+                       FROM {span}_data WHERE symbol_id=%(symbol_id)s
+                       AND price_date BETWEEN %(begin)s AND %(today)s
+                       ORDER BY price_date""",
+    "panel_metrics": """SELECT m.* FROM {span}_metrics m
+                        INNER JOIN (SELECT symbol_id, MAX(price_date) AS last
+                                    FROM {span}_metrics
+                                    WHERE symbol_id IN %(ids)s
+                                    GROUP BY symbol_id) AS grouped
+                        ON m.symbol_id=grouped.symbol_id
+                        AND m.price_date=grouped.last""",
+    "panel_data": """SELECT d.symbol_id, d.price_date, d.high, d.low,
+                            d.close, d.volume
+                     FROM {span}_data d
+                     LEFT JOIN (SELECT symbol_id, MAX(price_date) AS last
+                                FROM {span}_metrics
+                                WHERE symbol_id IN %(ids)s
+                                GROUP BY symbol_id) AS grouped
+                     ON d.symbol_id=grouped.symbol_id
+                     WHERE d.symbol_id IN %(ids)s
+                     AND d.price_date BETWEEN
+                         COALESCE(grouped.last, "2000-01-03") AND %(today)s""",
+    "data_after": """SELECT symbol_id, price_date, high, low, close, volume
+                     FROM {span}_data WHERE symbol_id=%(symbol_id)s
+                     AND price_date > %(after)s AND price_date <= %(today)s
+                     ORDER BY price_date""",
+    "data_after_limit": """SELECT symbol_id, price_date, high, low, close,
+                                  volume
+                           FROM {span}_data WHERE symbol_id=%(symbol_id)s
+                           AND price_date > %(after)s
+                           AND price_date <= %(today)s
+                           ORDER BY price_date LIMIT %(limit)s""",
+    "seed_state": """SELECT m.symbol_id, m.price_date, d.close, d.volume,
+                            m.ema12, m.ema26, m.ema50, m.force2, m.atr13,
+                            m.macds
+                     FROM {span}_metrics m INNER JOIN {span}_data d
+                     ON d.symbol_id=m.symbol_id AND d.price_date=m.price_date
+                     WHERE m.symbol_id=%(symbol_id)s
+                     ORDER BY m.price_date DESC LIMIT 1""",
+    "states": """SELECT s.* FROM metrics_state s
+                 INNER JOIN (SELECT symbol_id, MAX(price_date) AS last
+                             FROM {span}_metrics GROUP BY symbol_id)
+                            AS grouped
+                 ON s.symbol_id=grouped.symbol_id
+                 WHERE s.span=%(span)s AND s.price_date=grouped.last""",
+
+    # ingest
+    "clear_from": """DELETE FROM {table}
+                     WHERE symbol_id=%s AND price_date>=%s""",
+    "clear_state": "DELETE FROM metrics_state WHERE symbol_id=%s",
+
+    # scan_db
+    "broads": """SELECT SUM(gt12) AS gt12, SUM(gt26) AS gt26,
+                        SUM(gt50) AS gt50, SUM(ad) AS ad
+                 FROM {span}_metrics WHERE price_date=%(price_date)s""",
+    "broads_among": """SELECT SUM(gt12) AS gt12, SUM(gt26) AS gt26,
+                              SUM(gt50) AS gt50, SUM(ad) AS ad
+                       FROM {span}_metrics WHERE price_date=%(price_date)s
+                       AND symbol_id IN %(ids)s""",
+    "sectors": "SELECT sector, id FROM symbols WHERE flag='a'",
+    "longs": """SELECT symbol_id FROM {span}_metrics
+                WHERE price_date=%(price_date)s
+                AND impulse>0 AND gt26<0""",
+    "shorts": """SELECT symbol_id FROM {span}_metrics
+                 WHERE price_date=%(price_date)s
+                 AND impulse<0 AND gt26>0""",
+    "ticker_info": """SELECT id, ticker, name, sector FROM symbols
+                      WHERE id=%(id)s""",
+    "bar_count": "SELECT count(*) FROM daily_data WHERE symbol_id=%(id)s",
+    "atr13_on": """SELECT atr13 FROM daily_metrics
+                   WHERE symbol_id=%(id)s AND price_date=%(price_date)s""",
+    "close_on": """SELECT close FROM daily_data
+                   WHERE symbol_id=%(id)s AND price_date=%(price_date)s""",
+    "chart_data": """SELECT d.price_date AS price_date, d.open AS open,
+                            d.high AS high, d.low AS low,
+                            d.close AS close, d.volume AS volume
+                     FROM {span}_data d
+                     INNER JOIN symbols sym ON d.symbol_id = sym.id
+                     WHERE sym.ticker=%(ticker)s AND d.price_date>%(start)s
+                     ORDER BY d.price_date ASC""",
+    "chart_metrics": """SELECT price_date, ema12, ema26, atr13,
+                               macdf, macds, macdh, force2
+                        FROM {span}_metrics m
+                        INNER JOIN symbols sym ON m.symbol_id = sym.id
+                        WHERE sym.ticker=%(ticker)s AND m.price_date>%(start)s
+                        ORDER BY m.price_date ASC""",
+}
+
+# statement texts already filled in, by (name, identifiers)
+prepared = dict()
+
+# callables run as hook(name, seconds, rows, failed) after every statement,
+# whether or not it raised
+hooks = []
+
+# [calls, seconds, rows, failures] by statement name, kept by the default
+# hook
+timings = collections.defaultdict(lambda: [0, 0.0, 0, 0])
+lock = threading.Lock()
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def statement(name, **idents):
+    """
+    INPUTS:
+        name (str) - Key of STATEMENTS
+        idents (str) - Identifiers for the statement, i.e. span="daily"
+    OUTPUT:
+        Statement text, filled in once per name and identifiers, so every
+        call sends the same text. pymysql has no server-side prepared
+        statements; this is the reuse it allows.
+    """
+
+    key = (name,) + tuple(sorted(idents.items()))
+    if key not in prepared:
+        for ident, value in idents.items():
+            if value not in IDENTS[ident]:
+                raise ValueError("bad {} for {}: {}".format(ident, name,
+                                                            value))
+        prepared[key] = STATEMENTS[name].format(**idents)
+
+    return prepared[key]
+
+
+def record(name, seconds, rows, failed=False):
+    """
+    OUTPUT:
+        Side effect of adding one call to the timings, the default hook.
+        Rows sent by a failed statement are not counted.
+    """
+
+    with lock:
+        timing = timings[name]
+        timing[0] += 1
+        timing[1] += seconds
+        if failed: timing[3] += 1
+        else: timing[2] += rows or 0
+
+
+hooks.append(record)
+
+
+@contextmanager
+def timed(name, rows=None):
+    """
+    INPUTS:
+        name (str) - Name reported to the hooks
+        rows (int) - Rows sent, if known before the statement runs
+    OUTPUT:
+        Context manager timing its block for the hooks. Statements built
+        elsewhere, i.e. common.bulk_upsert, are timed with it too. A block
+        that raises still reaches the hooks, flagged as failed, and the
+        exception carries on to the caller.
+    """
+
+    t0 = time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        seconds = time() - t0
+        for hook in hooks:
+            hook(name, seconds, rows, failed)
+
+
+def split(kwargs):
+    """
+    OUTPUT:
+        Tuple of (identifiers, other keyword arguments) from kwargs.
+    """
+
+    idents = dict([(k, v) for k, v in kwargs.items() if k in IDENTS])
+    others = dict([(k, v) for k, v in kwargs.items() if k not in IDENTS])
+
+    return idents, others
+
+
+def execute(con, name, params=None, many=False, **idents):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        name (str) - Key of STATEMENTS
+        params (dict or list) - Parameters, or a list of them if many
+        many (bool) - Run through executemany()
+        idents (str) - Identifiers for the statement, i.e. table="symbols"
+    OUTPUT:
+        Number of rows affected. The caller commits.
+    """
+
+    sql = statement(name, **idents)
+    with con.cursor() as cur:
+        with timed(name, len(params) if many else None):
+            if many: return cur.executemany(sql, params)
+            return cur.execute(sql, params)
+
+
+def fetchall(con, name, params=None, cursorclass=None, **idents):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        name (str) - Key of STATEMENTS
+        params (dict) - Parameters by name
+        cursorclass (class) - i.e. pymysql.cursors.DictCursor
+        idents (str) - Identifiers for the statement, i.e. span="daily"
+    OUTPUT:
+        All result rows.
+    """
+
+    sql = statement(name, **idents)
+    with con.cursor(cursorclass) as cur:
+        with timed(name):
+            cur.execute(sql, params)
+            return cur.fetchall()
+
+
+def fetchone(con, name, params=None, cursorclass=None, **idents):
+    """
+    OUTPUT:
+        First result row, or None. See fetchall() for the inputs.
+    """
+
+    sql = statement(name, **idents)
+    with con.cursor(cursorclass) as cur:
+        with timed(name):
+            cur.execute(sql, params)
+            return cur.fetchone()
+
+
+def frame(con, name, params=None, **kwargs):
+    """
+    INPUTS:
+        con (mysql) - pymysql database connection
+        name (str) - Key of STATEMENTS
+        params (dict) - Parameters by name
+        kwargs - Identifiers for the statement (span, table, comparison),
+                 and the rest for pandas.read_sql_query, i.e. index_col
+    OUTPUT:
+        Results as a pandas dataframe. A connection with its own frame(),
+        i.e. storage.DuckDBConnection, reads them itself.
+    """
+
+    idents, kwargs = split(kwargs)
+    sql = statement(name, **idents)
+    with timed(name):
+        if hasattr(con, "frame"): return con.frame(sql, params, **kwargs)
+        return pd.read_sql_query(sql, con, params=params, **kwargs)
+
+
+def report():
+    """
+    OUTPUT:
+        Timings of this process' statements as lines for a log, slowest
+        first.
+    """
+
+    msg = ""
+    with lock:
+        rows = sorted(timings.items(), key=lambda item: -item[1][1])
+    for name, (calls, seconds, n, failures) in rows:
+        msg += " {:>17s}: {:6d} calls, {:8.2f}s".format(name, calls, seconds)
+        if n: msg += ", {} rows".format(n)
+        msg += ", {} failed\n".format(failures) if failures else "\n"
+
+    return msg
@@ -0,0 +1,225 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+# Typical use cases:
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/run_daily.py -v
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/run_daily.py -vr
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/run_daily.py -v --metrics=-P
+#hf> /media/mcollier/ONYX/ONYX/W/portfolio/scripts/run_daily.py -h
+
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#   wait for the vendor's end of day data instead of a fixed cron time?
+#
+##############################################################################
+
+
+# standard python library imports
+import argparse
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import fcntl
+import os
+import shlex
+import sys
+from time import time
+
+# local imports
+home = "/home/mcollier/ONYX/wealth/portfolio"
+local_paths = [os.path.join(home, "scripts"), ]
+sys.path[:0] = [p for p in local_paths if p not in sys.path]
+import common
+import get_tickers
+import get_timeseries
+import make_metrics
+import scan_db
+import telemetry
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# each stage's script and the stages whose output it reads, in run order
+STAGES = collections.OrderedDict([
+    ("tickers", (get_tickers, [])),
+    ("timeseries", (get_timeseries, ["tickers"])),
+    ("metrics", (make_metrics, ["timeseries"])),
+    ("scan", (scan_db, ["metrics"])),
+])
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def lock(path):
+    """
+    INPUTS:
+        path (str) - Lock file, created if missing
+    OUTPUT:
+        Open file holding an exclusive lock for the life of this process, or
+        None if another run already holds it. The lock is released by the
+        system however the process ends, so a crash leaves nothing stale.
+    """
+
+    f = open(path, "a+")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    f.truncate(0)
+    f.write("{}\n".format(os.getpid()))
+    f.flush()
+
+    return f
+
+
+def run(stages, call, workers=2):
+    """
+    INPUTS:
+        stages (dict) - (module, dependencies) by stage name
+        call (function) - call(name, module) runs one stage
+        workers (int) - Most stages running at once
+    OUTPUT:
+        Dictionary of (status, result or error, start, end) by stage name,
+        with times in seconds from the start of the run. Each stage starts
+        as soon as all of its dependencies have finished, and is skipped
+        if any of them failed.
+    """
+
+    done = collections.OrderedDict()
+    running = dict()
+    t00 = time()
+    with ThreadPoolExecutor(workers) as executor:
+        while len(done) < len(stages):
+
+            # start or skip whatever is no longer waiting on a dependency
+            for name, (module, deps) in stages.items():
+                if name in done or name in running.values(): continue
+                if any([done.get(dep, ("",))[0] in ["failed", "skipped"]
+                        for dep in deps]):
+                    done[name] = ("skipped", None, None, None)
+                elif all([dep in done for dep in deps]):
+                    future = executor.submit(call, name, module)
+                    future.start = time() - t00
+                    running[future] = name
+
+            if not running: continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    done[name] = ("ok", future.result(), future.start,
+                                  time() - t00)
+                except BaseException as err_msg:
+                    done[name] = ("failed", err_msg, future.start,
+                                  time() - t00)
+
+    return done
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    # assign parsed commandline values to working objects
+    p = argparse.ArgumentParser()
+    p.add_argument("-v", "--verbose", action="store_true",
+        help="print extra information on stdout")
+    p.add_argument("-N", "--no_insert", action="store_true",
+        help="suppress insertion of data into db tables if true")
+    p.add_argument("-r", "--resume", action="store_true",
+        help="skip tickers today's journals show finished")
+    p.add_argument("-S", "--skip", default="",
+        help="stages not to run... i.e. -S tickers,scan")
+    for name, (module, deps) in STAGES.items():
+        p.add_argument("--" + name, default="",
+            help="more options for {}.py... i.e. --{}=\"-h\"".format(
+                 module.__name__, name))
+    args = p.parse_args()
+
+    # load configuration from commented JSON into dictionary
+    conf = common.get_config("/etc/local/hf.conf")
+
+    # set up functions and parameters
+    vprint = print if args.verbose else lambda *a, **k: None
+    now = datetime.today()
+    today = now.date().isoformat()
+    held = lock(home + "/logs/run_daily.lock")
+    if held is None:
+        print("{}: another run holds the lock, exiting".format(now.ctime()))
+        sys.exit(1)
+
+    # the stages share this process, so one configuration, one connection
+    # pool per server, and the cached last price dates serve them all
+    skips = [s for s in args.skip.split(",") if s]
+    stages = collections.OrderedDict([
+        (name, (module, [dep for dep in deps if dep not in skips]))
+        for name, (module, deps) in STAGES.items() if name not in skips])
+
+    def call(name, module):
+        argv = shlex.split(getattr(args, name))
+        if args.verbose: argv.append("-v")
+        if args.no_insert and name != "scan": argv.append("-N")
+        if args.resume and name in ["timeseries", "metrics"]:
+            argv.append("-r")
+        vprint("{}: starting {} {}".format(datetime.today().ctime(), name,
+                                           " ".join(argv)))
+        with telemetry.span("stage", stage=name):
+            result = module.main(argv, conf)
+
+        # the stages catch their own errors and return them in an epack,
+        # so a stage with any is failed here, and its dependents skipped
+        if isinstance(result, list) and result[1]:
+            raise RuntimeError("{} error(s), see {}.py's log".format(
+                               result[1], module.__name__))
+        return result
+
+    done = run(stages, call)
+
+
+    ##########################################################################
+    # reporting
+    ##########################################################################
+
+    msg = "INFO: Stages (seconds from start):\n"
+    for name in STAGES:
+        if name not in done:
+            msg += " {:>10s}: not run\n".format(name)
+            continue
+        status, result, start, end = done[name]
+        msg += " {:>10s}: {}".format(name, status)
+        if start is not None:
+            msg += ", {:.1f}s to {:.1f}s".format(start, end)
+        if status == "failed":
+            msg += ", {!r}".format(result)
+        elif isinstance(result, list):
+            msg += ", {} error(s)".format(result[1])
+        elif result:
+            msg += ", {}".format(result)
+        msg += "\n"
+    report = done.get("scan", (None, None))
+    if report[0] == "ok":
+        msg += "INFO: Report ready at {}\n".format(report[1])
+
+    f = open(home + "/logs/{}_daily.log".format(today), "a")
+    f.write("#"*79 + '\n')
+    f.write(now.ctime() + '\n')
+    f.write(msg)
+    f.close()
+
+    # finally
+    for name, (status, result, start, end) in done.items():
+        telemetry.count("stages_total", status=status)
+    telemetry.write("daily", home + "/logs/{}_telemetry.jsonl".format(today),
+                    conf.get("telemetry_textfile_dir"))
+    held.close()
+    vprint(msg)
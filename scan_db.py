@@ -25,32 +25,30 @@ import datetime as dt
 from math import pi
 import os
 
-# third party python imports
-from bs4 import BeautifulSoup                   # conda install beautifulsoup4
-from bokeh.embed import file_html               # conda install bokeh
-from bokeh.io import output_file, save
-from bokeh.layouts import column
-from bokeh.models import Legend
-from bokeh.plotting import figure, show
-from bokeh.resources import CDN, INLINE
-from pymysql import connect                     # conda install pymysql
-from pymysql.cursors import DictCursor
-from pandas import read_sql_query as rsql       # conda install pandas
+# third party python imports, each loaded on first use (see lazy.py)
+import lazy
+bs4 = lazy.load("bs4")                          # conda install beautifulsoup4
+embed = lazy.load("bokeh.embed")                # conda install bokeh
+layouts = lazy.load("bokeh.layouts")
+plotting = lazy.load("bokeh.plotting")
+bokeh_resources = lazy.load("bokeh.resources")
+cursors = lazy.load("pymysql.cursors")          # conda install pymysql
 
 # overriding with local imports
 home = "/home/mcollier/ONYX/wealth/portfolio"
-os.chdir(os.path.join(home, "scripts"))
 import common
+import queries
+import telemetry
 
 
 ##############################################################################
 # Local User Function Definitions
 ##############################################################################
 
-def get_broads(d_con, span, price_date, tids=[]):
+def get_broads(con, span, price_date, tids=[]):
     """
     INPUTS:
-        d_con (mysql) - A pymysql database connection with dict() return
+        con (mysql) - A pymysql database connection
         span (str) - 'daily' or 'weekly'
         price_date (str) - Data in ISO 8601 standard as YYYY-MM-DD
         tids [list] - id's of tickers to include with default of all
@@ -61,102 +59,81 @@ def get_broads(d_con, span, price_date, tids=[]):
     #price_date = "2017-10-31",
     #tids = [1, 2, 5, 10, 20, 50, 100]
 
-    tids = [str(tid) for tid in tids]
-    cols = ["gt12", "gt26", "gt50", "ad"]  # which metrics to sum()
-    sql = ["SELECT " + ("SUM({}) AS ##,"*len(cols)).format(*cols)[:-1],
-           "FROM {}_metrics".format(span),
-           "WHERE price_date='{}'".format(price_date),
-           "" if not tids else "AND symbol_id in {}".format(tuple(tids)),
-           ';']
-    sql = " ".join(sql)
-    sql = sql.replace("##", "{}").format(*cols)
-    with d_con.cursor() as cur:
-        cur.execute(sql)
-        broads = cur.fetchone()
+    # sums gt12, gt26, gt50, and ad
+    params = {"price_date": price_date, "ids": tuple(tids)}
+    name = "broads_among" if tids else "broads"
+    broads = queries.fetchone(con, name, params, cursors.DictCursor,
+                              span=span)
 
     return broads
 
 
-def get_sectors(n_con):
+def get_sectors(con):
     """
     INPUTS:
-        n_con (mysql) - A "normal" pymysql database connection
+        con (mysql) - A pymysql database connection
     OUTPUT:
         Dictionary with sectors as keys, and lists of ticker_id's as values
     """
     sectors = collections.defaultdict(list)
-    with n_con.cursor() as n_cur:
-        n_cur.execute("SELECT sector,id FROM symbols where flag='a';")
-        results = n_cur.fetchall()
+    results = queries.fetchall(con, "sectors")
     for result in results:
         sectors[result[0]].append(result[1])
 
     return sectors
 
 
-def get_longs(n_con, span, price_date):
+def get_longs(con, span, price_date):
     """
     INPUTS:
-        n_con (mysql) - A "normal" pymysql database connection
+        con (mysql) - A pymysql database connection
         span (str) - 'daily' or 'weekly'
         price_date (str) - Data in ISO 8601 standard as YYYY-MM-DD
     OUTPUT:
         Returns a list of potential long candidates.
     """
-    sql = ["SELECT symbol_id FROM {}_metrics".format(span),
-           "WHERE price_date='{}'".format(price_date),
-           "AND impulse>0",                                # positive impulse
-           "AND gt26<0"]                                   # below value zone
-    with n_con.cursor() as n_cur:
-        n_cur.execute(" ".join(sql))
-        results = n_cur.fetchall()
+    # positive impulse, below value zone
+    results = queries.fetchall(con, "longs", {"price_date": price_date},
+                               span=span)
 
     return [result[0] for result in results]
 
 
-def get_shorts(n_con, span, price_date):
+def get_shorts(con, span, price_date):
     """
     INPUTS:
-        n_con (mysql) - A "normal" pymysql database connection
+        con (mysql) - A pymysql database connection
         span (str) - 'daily' or 'weekly'
         price_date (str) - Data in ISO 8601 standard as YYYY-MM-DD
     OUTPUT:
         Returns a list of potential short candidates.
     """
-    sql = ["SELECT symbol_id FROM {}_metrics".format(span),
-           "WHERE price_date='{}'".format(price_date),
-           "AND impulse<0",                                # negative impulse
-           "AND gt26>0"]                                   # above value zone
-    with n_con.cursor() as n_cur:
-        n_cur.execute(" ".join(sql))
-        results = n_cur.fetchall()
+    # negative impulse, above value zone
+    results = queries.fetchall(con, "shorts", {"price_date": price_date},
+                               span=span)
 
     return [result[0] for result in results]
 
 
-def get_ticker_info(d_con, tid):
+def get_ticker_info(con, tid):
     """
     INPUTS:
-        d_con (mysql) - A pymysql database connection with dict() return
+        con (mysql) - A pymysql database connection
         tid (int) - id of ticker
     OUTPUT:
         Dictionary with information about a ticker.
     """
 
-    sql = ["SELECT id,ticker,name,sector FROM symbols",
-           "WHERE id={}".format(tid),
-           ";"]
-    with d_con.cursor() as d_cur:
-        d_cur.execute(" ".join(sql))
-        info = d_cur.fetchone()
+    info = queries.fetchone(con, "ticker_info", {"id": tid},
+                            cursors.DictCursor)
 
     return info
 
 
-def report_individuals(n_con, price_date, tickers=[]):  # tickers=singles
+def report_individuals(con, price_date, tickers=[]):  # tickers=singles
     """
     INPUTS:
-        n_con (mysql) - A "normal" pymysql database connection
+        con (mysql) - A pymysql database connection
         price_date (str) - Data in ISO 8601 standard as YYYY-MM-DD
         tickers () - A list of dictionaries, one per ticker.
     OUTPUT:
@@ -164,19 +141,13 @@ def report_individuals(n_con, price_date, tickers=[]):  # tickers=singles
     """
     msg = "{:>3s}, {:>8s}, {:>7s}, {:>6s}, {:5d}, {:5.3f}, {:8.3f}, {:<s}\n"
     url = "<a href='./{}/{}{}.html'> {:s} </a>"
-    n_cur = n_con.cursor()
     html = ""
     for t in tickers:
         #t={'id': 7,'name':'Abbott Laboratories','sector':'Health Care','ticker': 'ABT'}
-        n_cur.execute( ("SELECT count(*) FROM daily_data "
-                        "WHERE symbol_id={}").format(t['id']) )
-        count = n_cur.fetchone()[0]
-        n_cur.execute( ("SELECT atr13 FROM daily_metrics WHERE symbol_id={} "
-                        "AND price_date='{}';").format(t['id'], price_date) )
-        atr13 = n_cur.fetchone()[0]
-        n_cur.execute( ("SELECT close FROM daily_data WHERE symbol_id={} "
-                        "AND price_date='{}'").format(t['id'], price_date) )
-        close = n_cur.fetchone()[0]
+        params = {"id": t['id'], "price_date": price_date}
+        count = queries.fetchone(con, "bar_count", params)[0]
+        atr13 = queries.fetchone(con, "atr13_on", params)[0]
+        close = queries.fetchone(con, "close_on", params)[0]
         ticker_id = str(t['id']).zfill(3)
         weekly_url = url.format(price_date, 'w', t["ticker"], "weekly")
         daily_url = url.format(price_date, 'd', t["ticker"], "daily")
@@ -185,10 +156,10 @@ def report_individuals(n_con, price_date, tickers=[]):  # tickers=singles
     return html
 
 
-def bokeh_pages(d_con, span, price_date, att, tickers=[]):
+def bokeh_pages(con, span, price_date, att, tickers=[]):
     """
     INPUTS:
-        d_con (pymysql) - MySQL connection returning a dictionary
+        con (pymysql) - MySQL connection
         span (str) -
         price_date (str) -
         att (str) -
@@ -200,19 +171,6 @@ def bokeh_pages(d_con, span, price_date, att, tickers=[]):
     w = 12*60*60*1000  # half day in ms
     if span == "weekly": w *= 7
     TOOLS = "crosshair,hover,pan,wheel_zoom,box_zoom,reset,save"
-    data_sql = """SELECT d.price_date AS price_date, d.open AS open,
-                d.high AS high, d.low AS low,
-                d.close AS close, d.volume AS volume
-             FROM {}_data d
-             INNER JOIN symbols sym ON d.symbol_id = sym.id
-             WHERE sym.ticker='{}' AND d.price_date>"{}"
-             ORDER BY d.price_date ASC;"""
-    metrics_sql = """SELECT price_date, ema12, ema26, atr13,
-                            macdf, macds, macdh, force2
-                     FROM {}_metrics m
-                     INNER JOIN symbols sym ON m.symbol_id = sym.id
-                     WHERE sym.ticker='{}' AND m.price_date>"{}"
-                     ORDER BY m.price_date ASC;"""
 
     if span == "weekly":
         price_date = common.get_dotw("next", "Friday", from_date=price_date)
@@ -225,21 +183,23 @@ def bokeh_pages(d_con, span, price_date, att, tickers=[]):
     for ticker in tickers:  # tickers = longs  # tickers = shorts
 
         # set up in-loop variables
-        info = get_ticker_info(d_con, ticker)  # ticker = 69
+        info = get_ticker_info(con, ticker)  # ticker = 69
         t = info["ticker"]
-        D = rsql(data_sql.format(span, t, start_date),
-                       con=n_con, index_col="price_date")
+        params = {"ticker": t, "start": start_date}
+        D = queries.frame(con, "chart_data", params, span=span,
+                          index_col="price_date")
         D["date"] = D.index.to_series()
         inc = D.close > D.open
         dec = D.open > D.close
-        M = rsql(metrics_sql.format(span, t, start_date),
-                       con=n_con, index_col="price_date")
+        M = queries.frame(con, "chart_metrics", params, span=span,
+                          index_col="price_date")
         M["date"] = M.index.to_series()
 
         # candlestick plot
         title = "{}, {} {}".format(price_date, span, t)
-        p1 = figure(x_axis_type="datetime", tools=TOOLS, plot_height=618,
-                    plot_width=1000, title = title+" Candlestick")
+        p1 = plotting.figure(x_axis_type="datetime", tools=TOOLS,
+                             plot_height=618, plot_width=1000,
+                             title = title+" Candlestick")
         p1.xaxis.major_label_orientation = pi/4
         p1.grid.grid_line_alpha = 0.3
         p1.segment(D.date, D.high, D.date,
@@ -265,8 +225,9 @@ def bokeh_pages(d_con, span, price_date, att, tickers=[]):
         p1.legend.background_fill_color = "aliceblue"
 
         # second plot for macX family
-        p2 = figure(x_axis_type="datetime", tools=TOOLS, plot_height=250,
-                    plot_width=1000, title = title+" MACDx")
+        p2 = plotting.figure(x_axis_type="datetime", tools=TOOLS,
+                             plot_height=250, plot_width=1000,
+                             title = title+" MACDx")
         p2.vbar(x=M.date, width=w, top=M.macdh, color="#CAB2D6")
         p2.line(M.date, M.macds, legend="macds", color="black", line_width=2)
         p2.line(M.date, M.macdf, legend="macdf", color="black", line_width=1)
@@ -275,7 +236,8 @@ def bokeh_pages(d_con, span, price_date, att, tickers=[]):
         p2.legend.background_fill_color = "aliceblue"
 
         # work with html
-        report = file_html(column(p1,p2), resources=CDN, title=title)
+        report = embed.file_html(layouts.column(p1,p2),
+                                 resources=bokeh_resources.CDN, title=title)
         t_slash = t.replace('.', '/')
         url1 = "https://www.bloomberg.com/quote/{}:US".format(t_slash)
         url2 = "https://finance.google.com/finance?q={}".format(t)
@@ -287,20 +249,24 @@ def bokeh_pages(d_con, span, price_date, att, tickers=[]):
                    "<li><a href='{}'> Reuters </a>"
                    "<li><a href='{}'> ShortSqueeze </a>"
                "</ul>").format(url1, url2, url3, url4)
-        miso = BeautifulSoup(report, "html.parser")
-        miso.body.insert(0, BeautifulSoup(new, "html.parser"))
+        miso = bs4.BeautifulSoup(report, "html.parser")
+        miso.body.insert(0, bs4.BeautifulSoup(new, "html.parser"))
         with open("{}{}.html".format(span[0], ticker), "w") as f:
             f.write(str(miso))
 
 
 ##############################################################################
-# Treat this file as a script if invoked as __main__
+# Main, run as a script or as a stage of run_daily.py
 ##############################################################################
 
-if __name__ == "__main__":
-
-    # load configuration from commented JSON into dictionary
-    conf = common.get_config("/etc/local/hf.conf")
+def main(argv=None, conf=None):
+    """
+    INPUTS:
+        argv (list) - Command line arguments, sys.argv[1:] if None
+        conf (dict) - Configuration from hf.conf, loaded here if None
+    OUTPUT:
+        Path of the day's html report, after writing it and its pages.
+    """
 
     # assign parsed commandline values to working objects
     p = argparse.ArgumentParser()
@@ -310,18 +276,25 @@ if __name__ == "__main__":
         help="pull select ticker(s)... i.e. -s 69,488")
     p.add_argument("-v", "--verbose", action="store_true",
         help="print extra information on stdout")
+    p.add_argument("-X", "--replica", action="store_true",
+        help="read from the db_replica_host replica (must be caught up)")
 #    p.add_argument("-N", "--no_insert", action="store_true",
 #        help="suppress db insertion if true")
 #    p.add_argument("-R", "--no_report", action="store_true",
 #        help="option to suppress reporting at end")
-    args = p.parse_args()
+    args = p.parse_args(argv)
+
+    # load configuration from commented JSON into dictionary
+    if conf is None: conf = common.get_config("/etc/local/hf.conf")
+
     vprint = print if args.verbose else lambda *a, **k: None
+    cwd = os.getcwd()
+    os.chdir(os.path.join(home, "scripts"))
 
-    d_con = connect(host=conf["db_host"],     db=conf["db_name"],
-                    user=conf["db_user"], passwd=conf["db_pass"],
-                    cursorclass=DictCursor)
-    n_con =  connect(host=conf["db_host"],     db=conf["db_name"],
-                    user=conf["db_user"], passwd=conf["db_pass"])
+    # one connection, to the read replica with -X, serves both tuple and
+    # dict readers by choosing the cursor class per call
+    pool = common.get_pool(conf, replica=args.replica)
+    con = pool.get()
 
     if args.date == "today": price_date=dt.datetime.today().date().isoformat()
     else: price_date = args.date  # price_date = "2017-11-10"
@@ -351,7 +324,7 @@ if __name__ == "__main__":
     html += head + "<br>"
     row = "{:>6s}: {:4d}, {:4d}, {:4d}, {:4d}<br>"
     for span in ["daily", "weekly"]:
-        pop = get_broads(d_con, span, price_date)
+        pop = get_broads(con, span, price_date)
         html += row.format(span, int(pop['gt50']), int(pop['gt26']),
                            int(pop['gt12']), int(pop['ad']))
 
@@ -360,9 +333,9 @@ if __name__ == "__main__":
     html += (head + ", {:>3s}, sector<br>".format("n"))
     row = "{:>6s}: {:4d}, {:4d}, {:4d}, {:4d}, {:3d}, {}<br>"
     for span in ["daily", "weekly"]:
-        sectors = get_sectors(n_con)
+        sectors = get_sectors(con)
         for sector, values in sectors.items():
-            m = get_broads(d_con, span, price_date, values)
+            m = get_broads(con, span, price_date, values)
             html += row.format(span, int(m['gt50']), int(m['gt26']),
                                int(m['gt12']), int(m['ad']),
                                len(values), sector)
@@ -380,30 +353,31 @@ if __name__ == "__main__":
     if not args.select:
 
         # work with shorts
-        shorts = get_shorts(n_con, "daily", price_date)
-        esses = [get_ticker_info(d_con, short) for short in shorts]
+        shorts = get_shorts(con, "daily", price_date)
+        esses = [get_ticker_info(con, short) for short in shorts]
         html += ("<h2> Daily Shorts </h2><pre>")
         html += head
-        html += report_individuals(n_con, price_date, esses)
+        html += report_individuals(con, price_date, esses)
 
         # work with longs
-        longs = get_longs(n_con, "daily", price_date)
-        elles = [get_ticker_info(d_con, long) for long in longs]
+        longs = get_longs(con, "daily", price_date)
+        elles = [get_ticker_info(con, long) for long in longs]
         html += ("</pre><h2> Daily Longs </h2><pre>")
         html += head
-        html += report_individuals(n_con, price_date, elles)
+        html += report_individuals(con, price_date, elles)
 
     else:
 
         # work with singles
         select = args.select.split(',')
         select = [int(s) for s in select]
-        singles = [get_ticker_info(d_con, s) for s in select]
+        singles = [get_ticker_info(con, s) for s in select]
         html += ("</pre><h2> Daily Single(s) </h2><pre>")
         html += head
-        html += report_individuals(n_con, price_date, singles)
+        html += report_individuals(con, price_date, singles)
 
-    with open("inspection/{}.html".format(price_date), "w") as f:
+    page = os.path.abspath("inspection/{}.html".format(price_date))
+    with open(page, "w") as f:
         f.write(html + "<br><br></pre></body></html>")
 
 
@@ -421,10 +395,25 @@ if __name__ == "__main__":
         if not args.select: attitudes = {"longs": longs, "shorts": shorts}
         else: attitudes = {"select": select}
         for att in attitudes.keys():
-            bokeh_pages(d_con, span, price_date, att, tickers=attitudes[att])
+            with telemetry.span("scan_pages", span=span, attitude=att):
+                bokeh_pages(con, span, price_date, att, tickers=attitudes[att])
+            telemetry.count("pages_total", len(attitudes[att]), span=span)
 
 
     # finally...
-    d_con.close()
-    n_con.close()
+    os.chdir(cwd)
+    telemetry.write("scan", home + "/logs/{}_telemetry.jsonl".format(
+                    dt.date.today().isoformat()),
+                    conf.get("telemetry_textfile_dir"))
+    pool.put(con)
+
+    return page
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
 
+    main()
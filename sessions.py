@@ -0,0 +1,244 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#   early closes (day after Thanksgiving, Christmas Eve)?
+#
+##############################################################################
+
+# standard python library imports
+import datetime as dt
+import functools
+
+# third party library imports, each loaded on first use (see lazy.py)
+import lazy
+np = lazy.load("numpy")                          # conda install numpy
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# first year of the calendar; earlier dates see weekends only
+FIRST = 1990
+
+# days the exchange closed outside of its holiday rules
+CLOSINGS = ["1994-04-27",                                  # Nixon funeral
+            "2001-09-11", "2001-09-12", "2001-09-13", "2001-09-14",
+            "2004-06-11",                                  # Reagan funeral
+            "2007-01-02",                                  # Ford funeral
+            "2012-10-29", "2012-10-30",                    # Hurricane Sandy
+            "2018-12-05",                                  # Bush funeral
+            "2025-01-09"]                                  # Carter funeral
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def nth_weekday(year, month, weekday, n):
+    """
+    INPUTS:
+        year (int), month (int) - Month to look in
+        weekday (int) - Monday is 0... Sunday is 6
+        n (int) - 1 for the first, 2 for the second..., -1 for the last
+    OUTPUT:
+        Python date of the month's nth weekday.
+    """
+
+    if n > 0:
+        day = dt.date(year, month, 1)
+        return day + dt.timedelta((weekday - day.weekday()) % 7 + 7*(n - 1))
+    day = dt.date(year + month//12, month % 12 + 1, 1) - dt.timedelta(1)
+
+    return day - dt.timedelta((day.weekday() - weekday) % 7 + 7*(-n - 1))
+
+
+def easter(year):
+    """
+    OUTPUT:
+        Python date of Easter Sunday in the given year (Gregorian).
+    """
+
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    g = (8*b + 13) // 25
+    h = (19*a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2*e + 2*i - h - k) % 7
+    m = (a + 11*h + 19*l) // 433
+    month = (h + l - 7*m + 90) // 25
+
+    return dt.date(year, month, (h + l - 7*m + 33*month + 19) % 32)
+
+
+def observed(day, saturday=True):
+    """
+    OUTPUT:
+        Weekday the holiday on day is observed: the Friday before for a
+        Saturday (unless saturday is False), and the Monday after for a
+        Sunday.
+    """
+
+    if day.weekday() == 5: return day - dt.timedelta(1) if saturday else None
+    if day.weekday() == 6: return day + dt.timedelta(1)
+
+    return day
+
+
+@functools.lru_cache(maxsize=None)
+def holidays(year):
+    """
+    INPUTS:
+        year (int) - Calendar year
+    OUTPUT:
+        Sorted tuple of the weekdays the NYSE is closed in the year, from
+        its holiday rules and the one-off CLOSINGS. A New Year's Day on a
+        Saturday is not observed on the Friday before.
+    """
+
+    days = [observed(dt.date(year, 1, 1), saturday=False),
+            nth_weekday(year, 2, 0, 3),                    # Washington
+            easter(year) - dt.timedelta(2),                # Good Friday
+            nth_weekday(year, 5, 0, -1),                   # Memorial Day
+            observed(dt.date(year, 7, 4)),
+            nth_weekday(year, 9, 0, 1),                    # Labor Day
+            nth_weekday(year, 11, 3, 4),                   # Thanksgiving
+            observed(dt.date(year, 12, 25))]
+    if year >= 1998: days.append(nth_weekday(year, 1, 0, 3))   # MLK
+    if year >= 2022: days.append(observed(dt.date(year, 6, 19)))
+    days += [dt.date.fromisoformat(d) for d in CLOSINGS
+             if d.startswith(str(year))]
+
+    return tuple(sorted([d for d in days if d is not None]))
+
+
+@functools.lru_cache(maxsize=None)
+def calendar(last):
+    """
+    INPUTS:
+        last (int) - Last year the calendar must cover
+    OUTPUT:
+        numpy busdaycalendar of the sessions from FIRST through last, built
+        once per last year asked for.
+    """
+
+    days = [d for year in range(FIRST, last + 1) for d in holidays(year)]
+
+    return np.busdaycalendar(holidays=np.array(days, dtype="datetime64[D]"))
+
+
+def lookup(function, dates, *args, **kwargs):
+    """
+    INPUTS:
+        function (function) - numpy busday function to apply
+        dates (str, date or list) - iso8601 string, python date, or a list
+                                    or array of either
+    OUTPUT:
+        function over the dates, with the calendar covering them. A single
+        date gives back an iso8601 string (or bool), and a list or array
+        gives back a numpy array.
+    """
+
+    days = np.asarray(dates, dtype="datetime64[D]")
+    last = max(dt.date.today().year + 1, days.max().astype(object).year
+               if days.size else 0)
+    result = function(days, *args, busdaycal=calendar(last), **kwargs)
+    if days.ndim: return result
+
+    return bool(result) if result.dtype == bool else str(result)
+
+
+def day_of_week(days):
+    """
+    OUTPUT:
+        Day of the week of datetime64 days, Monday 0... Sunday 6.
+    """
+
+    return (days.astype("int64") + 3) % 7  # 1970-01-01 was a Thursday
+
+
+def is_session(dates):
+    """
+    OUTPUT:
+        True where the exchange trades on the date(s).
+    """
+
+    return lookup(np.is_busday, dates)
+
+
+def is_holiday(dates):
+    """
+    OUTPUT:
+        True where the date(s) fall on a weekday the exchange is closed.
+    """
+
+    closed = day_of_week(np.asarray(dates, dtype="datetime64[D]")) < 5
+
+    return closed & ~is_session(dates) if closed.ndim \
+        else bool(closed) and not is_session(dates)
+
+
+def last_session(dates):
+    """
+    OUTPUT:
+        Session on or before the date(s), i.e. the last day a vendor can
+        have a closing price for as of the date.
+    """
+
+    return lookup(np.busday_offset, dates, 0, roll="preceding")
+
+
+def next_session(dates):
+    """
+    OUTPUT:
+        First session after the date(s).
+    """
+
+    return lookup(np.busday_offset, dates, 1, roll="preceding")
+
+
+def prev_session(dates):
+    """
+    OUTPUT:
+        Last session before the date(s).
+    """
+
+    return lookup(np.busday_offset, dates, -1, roll="following")
+
+
+def week_end(dates):
+    """
+    OUTPUT:
+        Last session of the week ending Friday that holds the date(s), i.e.
+        the Thursday before a Good Friday. Weekends belong to the week after,
+        as in get_timeseries.make_weekly_data().
+    """
+
+    days = np.asarray(dates, dtype="datetime64[D]")
+    friday = days + (4 - day_of_week(days)) % 7
+
+    return last_session(friday if days.ndim else friday.item())
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    # TEST: a few known closings and their neighbouring sessions
+    assert holidays(2024) == tuple(dt.date.fromisoformat(d) for d in [
+        "2024-01-01", "2024-01-15", "2024-02-19", "2024-03-29", "2024-05-27",
+        "2024-06-19", "2024-07-04", "2024-09-02", "2024-11-28", "2024-12-25"])
+    assert dt.date(2022, 12, 31) not in holidays(2022)
+    assert next_session("2024-03-28") == "2024-04-01"
+    assert prev_session("2024-04-01") == "2024-03-28"
+    assert last_session("2024-03-31") == "2024-03-28"
+    assert week_end("2024-03-26") == "2024-03-28"
+    assert week_end("2024-03-30") == "2024-04-05"
+    assert is_holiday("2001-09-12") and not is_holiday("2024-03-30")
+    print(next_session(["2024-12-24", "2024-12-31", "2025-01-08"]))
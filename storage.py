@@ -0,0 +1,497 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#   Parquet export of the embedded tables for other tools?
+#
+##############################################################################
+
+# standard python library imports
+import collections
+import datetime as dt
+from decimal import Decimal
+import functools
+import re
+import sqlite3
+
+# third party library imports, each loaded on first use (see lazy.py)
+import lazy
+duckdb = lazy.load("duckdb")                     # conda install python-duckdb
+np = lazy.load("numpy")                          # conda install numpy
+pd = lazy.load("pandas")                         # conda install pandas
+pymysql = lazy.load("pymysql")                   # conda install pymysql
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# backends selectable with db_backend in hf.conf, and whether several
+# processes may write to one database at once (make_metrics.py -w)
+BACKENDS = {"mysql": True, "sqlite": True, "duckdb": False}
+
+# the tables of hundredfold.sql for the embedded backends; {real}, {date},
+# {datetime} and {key} are filled in with each backend's types
+PRICES = """id {key}, symbol_id INTEGER NOT NULL, price_date {date} NOT NULL,
+            open {real}, high {real}, low {real}, close {real},
+            volume {real}, ex_dividend {real}, split_ratio {real},
+            adj_open {real}, adj_high {real}, adj_low {real},
+            adj_close {real}, adj_volume {real}, last_update {datetime},
+            vendor_id INTEGER, {unique} (symbol_id, price_date)"""
+METRICS = """id {key}, symbol_id INTEGER NOT NULL, price_date {date} NOT NULL,
+             ema12 {real}, ema26 {real}, ema50 {real}, force BIGINT,
+             force2 BIGINT, tr {real}, atr13 {real}, macdf {real},
+             macds {real}, macdh {real}, impulse INTEGER, gt12 INTEGER,
+             gt26 INTEGER, gt50 INTEGER, ad INTEGER, updated {date},
+             {unique} (symbol_id, price_date)"""
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS symbols (
+    id {symbols_key}, exchange_id INTEGER, flag TEXT, ticker TEXT NOT NULL,
+    instrument TEXT NOT NULL, name TEXT, sector TEXT, currency TEXT,
+    inserted {datetime} NOT NULL, last_update {datetime} NOT NULL);
+CREATE TABLE IF NOT EXISTS daily_data ({daily_data});
+CREATE TABLE IF NOT EXISTS weekly_data ({weekly_data});
+CREATE TABLE IF NOT EXISTS daily_metrics ({daily_metrics});
+CREATE TABLE IF NOT EXISTS weekly_metrics ({weekly_metrics});
+CREATE TABLE IF NOT EXISTS metrics_state (
+    symbol_id INTEGER NOT NULL, span TEXT NOT NULL,
+    price_date {date} NOT NULL, close {real}, volume {real}, ema12 {real},
+    ema26 {real}, ema50 {real}, force2 BIGINT, atr13 {real}, macds {real},
+    updated {date}, PRIMARY KEY (symbol_id, span));
+"""
+TYPES = {
+    # lower case date and datetime are the names of the converters below
+    "sqlite": {"real": "REAL", "date": "date", "datetime": "datetime",
+               "key": "INTEGER PRIMARY KEY", "unique": "UNIQUE",
+               "symbols_key": "INTEGER PRIMARY KEY"},
+    # ids come from sequences; (symbol_id, price_date) is the one key, as
+    # ON CONFLICT and INSERT OR REPLACE need
+    "duckdb": {"real": "DOUBLE", "date": "DATE", "datetime": "TIMESTAMP",
+               "key": "BIGINT DEFAULT nextval('{table}_id')",
+               "unique": "PRIMARY KEY",
+               "symbols_key": ("INTEGER PRIMARY KEY "
+                               "DEFAULT nextval('symbols_id')")},
+}
+TABLES = ["symbols", "daily_data", "weekly_data", "daily_metrics",
+          "weekly_metrics"]
+
+# MySQL placeholders, in the %(name)s, %s, and %% forms pymysql fills in
+PARAM = re.compile(r"%\((\w+)\)s|%s|%%")
+
+# ISO 8601 dates and datetimes, bound as such rather than as text
+ISODATE = re.compile(r"\d{4}-\d\d-\d\d$")
+ISOTIME = re.compile(r"\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d$")
+
+# multi-row inserts, which DuckDB takes as one columnar insert when they
+# are more than SMALL rows
+INSERT = re.compile(r"\s*(INSERT(?: OR REPLACE)? INTO \w+)\s*\(([^)]*)\)\s*"
+                    r"VALUES\s*\(\s*\?(?:\s*,\s*\?)*\s*\)(.*)$", re.S)
+SMALL = 10
+
+
+##############################################################################
+# Local Class Definitions
+##############################################################################
+
+class SQLiteCursor(sqlite3.Cursor):
+    """
+    Cursor taking pymysql's statements and parameters. Execute returns the
+    row count, as pymysql's does, and the cursor closes on leaving a with
+    block.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        self.close()
+
+    def execute(self, sql, params=None):
+        sql, args = translate(sql, params, "sqlite")
+        super().execute(sql, args)
+        return self.rowcount
+
+    def executemany(self, sql, seq):
+        sql, args = translate(sql, None, "sqlite")
+        super().executemany(sql, seq)
+        return self.rowcount
+
+
+class SQLiteConnection(sqlite3.Connection):
+    """
+    SQLite database in place of the MySQL one. cursor() takes pymysql's
+    cursor class, and a DictCursor returns rows as dictionaries. A real
+    sqlite3 connection otherwise, so pandas reads it directly.
+    """
+
+    backend = "sqlite"
+
+    def cursor(self, cursorclass=None):
+        cur = super().cursor(SQLiteCursor)
+        if dict_rows(cursorclass):
+            cur.row_factory = lambda c, row: dict(zip(
+                [d[0] for d in c.description], row))
+        return cur
+
+    def ping(self, reconnect=True):
+        pass
+
+
+class DuckDBCursor(object):
+    """
+    Cursor over a DuckDBConnection, with pymysql's execute(), executemany()
+    and fetch methods. Rows are tuples, or dictionaries for a DictCursor.
+    """
+
+    def __init__(self, con, as_dict=False):
+        self.con = con
+        self.as_dict = as_dict
+        self.description = None
+        self.rows = collections.deque()
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        self.close()
+
+    def execute(self, sql, params=None):
+        sql, args = translate(sql, params, "duckdb")
+        self.con.begin()
+        result = self.con.db.execute(sql, [adapt(v) for v in args])
+        self.description = result.description
+        self.rows = collections.deque(result.fetchall())
+        self.rowcount = len(self.rows)
+        if self.rows and self.description[0][0] == "Count":
+            self.rowcount = self.rows[0][0]
+        return self.rowcount
+
+    def executemany(self, sql, seq):
+        sql, args = translate(sql, None, "duckdb")
+        seq = list(seq)
+        self.con.begin()
+        self.description = None
+        self.rows.clear()
+        self.rowcount = len(seq)
+        m = INSERT.match(sql)
+        if not seq:
+            return self.rowcount
+        elif not m or len(seq) < SMALL:
+            self.con.db.executemany(sql, [[adapt(v) for v in row]
+                                          for row in seq])
+            return self.rowcount
+
+        # insert all of the rows at once from a dataframe, which the insert
+        # casts to the table's types
+        cols = [c.strip() for c in m.group(2).split(",")]
+        staged = pd.DataFrame(seq, columns=[c.strip('"') for c in cols])
+        self.con.db.register("staged_rows", staged)
+        try:
+            self.con.db.execute("{} ({}) SELECT {} FROM staged_rows {}".format(
+                m.group(1), ",".join(cols), ",".join(cols), m.group(3)))
+        finally:
+            self.con.db.unregister("staged_rows")
+        return self.rowcount
+
+    def fetchone(self):
+        return self.row(self.rows.popleft()) if self.rows else None
+
+    def fetchmany(self, size=1):
+        return [self.fetchone() for n in range(min(size, len(self.rows)))]
+
+    def fetchall(self):
+        rows = [self.row(row) for row in self.rows]
+        self.rows.clear()
+        return rows
+
+    def row(self, row):
+        if not self.as_dict: return row
+        return dict(zip([d[0] for d in self.description], row))
+
+    def close(self):
+        pass
+
+
+class DuckDBConnection(object):
+    """
+    DuckDB database in place of the MySQL one, for columnar scans of the
+    price and metrics tables. Like pymysql, a transaction opens with the
+    first statement and lasts until commit() or rollback(). frame() reads
+    straight into a dataframe, see queries.frame().
+    """
+
+    backend = "duckdb"
+
+    def __init__(self, path):
+        self.db = duckdb.connect(path)
+        self.open = False
+
+    def begin(self):
+        if not self.open:
+            self.db.begin()
+            self.open = True
+
+    def cursor(self, cursorclass=None):
+        return DuckDBCursor(self, dict_rows(cursorclass))
+
+    def commit(self):
+        if self.open: self.db.commit()
+        self.open = False
+
+    def rollback(self):
+        if self.open: self.db.rollback()
+        self.open = False
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        self.db.close()
+
+    def frame(self, sql, params=None, index_col=None, coerce_float=True,
+              parse_dates=None):
+        """
+        OUTPUT:
+            Results as a pandas dataframe, as pandas.read_sql_query would
+            read them from pymysql: dates as python dates, unless in
+            parse_dates.
+        """
+
+        sql, args = translate(sql, params, "duckdb")
+        self.begin()
+        result = self.db.execute(sql, [adapt(v) for v in args])
+        dates = [d[0] for d in result.description if str(d[1]) == "DATE"]
+        df = result.df()
+        for col in dates:
+            if col in (parse_dates or []): continue
+            df[col] = df[col].dt.date.astype(object).where(df[col].notnull(),
+                                                           None)
+        for col in parse_dates or []:
+            df[col] = pd.to_datetime(df[col])
+        if index_col is not None: df = df.set_index(index_col)
+
+        return df
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def dict_rows(cursorclass):
+    """
+    OUTPUT:
+        True if cursorclass is pymysql's DictCursor, or one like it.
+    """
+
+    return cursorclass is not None and "Dict" in cursorclass.__name__
+
+
+def adapt(value):
+    """
+    OUTPUT:
+        A value DuckDB binds as MySQL would take it: numpy scalars as python
+        ones, Decimal as float, and ISO 8601 text as a date or datetime.
+    """
+
+    if isinstance(value, str):
+        if ISODATE.match(value): return dt.date.fromisoformat(value)
+        if ISOTIME.match(value): return dt.datetime.fromisoformat(value)
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, Decimal):
+        return float(value)
+    elif isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+
+    return value
+
+
+def as_sqlite_datetime(value):
+    """
+    OUTPUT:
+        A datetime as SQLite text. MySQL stores a datetime into a date
+        column as the date alone, which is how midnight values arrive.
+    """
+
+    if value.time() == dt.time(0) and value.tzinfo is None:
+        return value.date().isoformat()
+
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+@functools.lru_cache(maxsize=None)
+def dialect(sql, backend):
+    """
+    INPUTS:
+        sql (str) - Statement in the MySQL dialect, placeholders already ?
+        backend (str) - "sqlite" or "duckdb"
+    OUTPUT:
+        The statement in the backend's dialect. Only the MySQL the scripts
+        use is rewritten: double quoted strings, backquoted names,
+        DATE_SUB, REPLACE INTO, and ON DUPLICATE KEY UPDATE.
+    """
+
+    sql = re.sub(r'"([^"]*)"', r"'\1'", sql)
+    sql = sql.replace("`", '"')
+    if backend == "sqlite":
+        sql = re.sub(r"DATE_SUB\((.*?),\s*INTERVAL\s+(\d+)\s+DAY\)",
+                     r"date(\1, '-\2 day')", sql, flags=re.S)
+        # an aggregate loses the column's type, so name the converter
+        sql = re.sub(r"(max\(price_date\))(?!\s+AS)",
+                     r'\1 AS "\1 [date]"', sql, flags=re.I)
+    else:
+        sql = re.sub(r"DATE_SUB\((.*?),\s*INTERVAL\s+(\d+)\s+DAY\)",
+                     r"(CAST(\1 AS DATE) - INTERVAL \2 DAY)", sql,
+                     flags=re.S)
+    sql = re.sub(r"^\s*REPLACE INTO", "INSERT OR REPLACE INTO", sql)
+    sql = sql.replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT DO UPDATE SET")
+    sql = re.sub(r'VALUES\(("?\w+"?)\)', r"excluded.\1", sql)
+
+    return sql
+
+
+def translate(sql, params, backend):
+    """
+    INPUTS:
+        sql (str) - Statement with pymysql placeholders
+        params (dict or tuple) - Parameters as pymysql takes them, or None
+                                 to convert the placeholders alone
+        backend (str) - "sqlite" or "duckdb"
+    OUTPUT:
+        Tuple of the statement in the backend's dialect and its positional
+        parameters. Like pymysql, a tuple value expands into a parenthesized
+        list for IN. Statements already using ? pass through.
+    """
+
+    if params is None:
+        sql = PARAM.sub(lambda m: "%" if m.group(0) == "%%" else "?", sql)
+        return dialect(sql, backend), ()
+    if not PARAM.search(sql): return dialect(sql, backend), params
+    values = iter(params) if not isinstance(params, dict) else None
+    args = []
+
+    def bind(m):
+        if m.group(0) == "%%": return "%"
+        value = params[m.group(1)] if m.group(1) else next(values)
+        if isinstance(value, (tuple, list)):
+            args.extend(value)
+            return "(" + ",".join("?"*len(value)) + ")"
+        args.append(value)
+        return "?"
+
+    return dialect(PARAM.sub(bind, sql), backend), args
+
+
+def create(con, backend):
+    """
+    INPUTS:
+        con - Open sqlite3 or duckdb connection
+        backend (str) - "sqlite" or "duckdb"
+    OUTPUT:
+        Side effect of creating any of the hundredfold tables missing.
+    """
+
+    types = dict(TYPES[backend])
+    for table in TABLES[1:]:
+        key = types["key"].format(table=table)
+        columns = PRICES if table.endswith("_data") else METRICS
+        types[table] = columns.format(**dict(types, key=key))
+    sql = SCHEMA.format(**types)
+    if backend == "duckdb":
+        sql = "".join(["CREATE SEQUENCE IF NOT EXISTS {}_id;\n".format(t)
+                       for t in TABLES]) + sql
+        for statement in sql.split(";"):
+            if statement.strip(): con.execute(statement)
+    else:
+        con.executescript(sql)
+
+
+def connect_sqlite(path):
+    """
+    INPUTS:
+        path (str) - SQLite database file, or ":memory:"
+    OUTPUT:
+        An open SQLiteConnection, with the tables created if missing. The
+        adapters registered here turn the numpy, pandas, Decimal and date
+        values the scripts bind into SQLite values, and NaN is stored as
+        NULL, as it is by SQLite itself.
+    """
+
+    for kind in [np.int8, np.int16, np.int32, np.int64, np.bool_]:
+        sqlite3.register_adapter(kind, int)
+    for kind in [np.float32, np.float64, Decimal]:
+        sqlite3.register_adapter(kind, float)
+    for kind in [dt.datetime, pd.Timestamp]:
+        sqlite3.register_adapter(kind, as_sqlite_datetime)
+    sqlite3.register_adapter(dt.date, lambda d: d.isoformat())
+    sqlite3.register_converter("date", lambda b: dt.date.fromisoformat(
+        b[:10].decode()))
+    sqlite3.register_converter("datetime", lambda b: dt.datetime.fromisoformat(
+        b.decode()))
+
+    con = sqlite3.connect(path, factory=SQLiteConnection, timeout=60,
+                          detect_types=(sqlite3.PARSE_DECLTYPES |
+                                        sqlite3.PARSE_COLNAMES),
+                          check_same_thread=False)
+    create(con, "sqlite")
+
+    return con
+
+
+def connect_duckdb(path):
+    """
+    INPUTS:
+        path (str) - DuckDB database file, or ":memory:"
+    OUTPUT:
+        An open DuckDBConnection, with the tables created if missing.
+    """
+
+    con = DuckDBConnection(path)
+    create(con.db, "duckdb")
+
+    return con
+
+
+def connect(settings):
+    """
+    INPUTS:
+        settings (dict) - From common.db_settings(): the backend, and then
+                          pymysql.connect() keywords for mysql, or the
+                          database file as db for sqlite and duckdb
+    OUTPUT:
+        An open connection with pymysql's cursor(), commit(), rollback(),
+        ping() and close(), so the scripts run the same on any backend.
+    """
+
+    settings = dict(settings)
+    backend = settings.pop("backend", "mysql")
+    if backend == "mysql":
+        return pymysql.connect(**settings)
+    elif backend == "sqlite":
+        return connect_sqlite(settings["db"])
+    elif backend == "duckdb":
+        return connect_duckdb(settings["db"])
+
+    raise ValueError("unknown db_backend: {}".format(backend))
+
+
+def backend(con):
+    """
+    OUTPUT:
+        Name of the backend of connection con, i.e. "mysql".
+    """
+
+    return getattr(con, "backend", "mysql")
+
+
+def processes(conf):
+    """
+    OUTPUT:
+        True if several processes may write to conf's database at once.
+    """
+
+    return BACKENDS[conf.get("db_backend", "mysql")]
@@ -0,0 +1,272 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#   push to a Prometheus pushgateway instead of the textfile collector?
+#
+##############################################################################
+
+# standard python library imports
+import collections
+import json
+import os
+import threading
+from time import time
+
+# local imports
+import queries
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# prefix of every exported metric name
+PREFIX = "hf_"
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, 300.0, 1800.0)
+
+# counter values, and histograms as [bucket counts..., sum, count], keyed
+# by (name, sorted label pairs); and span records for the JSON lines file
+counters = collections.defaultdict(float)
+histograms = dict()
+events = []
+lock = threading.Lock()
+
+
+##############################################################################
+# Local Class Definitions
+##############################################################################
+
+class Span(object):
+    """
+    Times a block as a named span: with span("write", table="daily") as s.
+    On exit the seconds go to the <name>_seconds histogram, and a record of
+    the span, with its ticker and any error, goes to the JSON lines file.
+    The ticker is kept out of the histogram labels, so that the exported
+    series stay one per stage rather than one per ticker.
+    """
+
+    def __init__(self, name, ticker=None, **labels):
+        self.name = name
+        self.ticker = ticker
+        self.labels = labels
+        self.seconds = None
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, kind, value, tb):
+        self.seconds = time() - self.start
+        observe(self.name + "_seconds", self.seconds, **self.labels)
+        event = dict(self.labels)
+        event.update({"name": self.name, "start": round(self.start, 3),
+                      "seconds": round(self.seconds, 4)})
+        if self.ticker is not None: event["ticker"] = self.ticker
+        if value is not None: event["error"] = repr(value)
+        with lock:
+            events.append(event)
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+def labelled(labels):
+    """
+    OUTPUT:
+        Labels as sorted (name, str value) pairs, for keys that sort and
+        pickle whatever the value types, i.e. status=None or status=429.
+    """
+
+    return tuple(sorted([(k, str(v)) for k, v in labels.items()]))
+
+
+def span(name, ticker=None, **labels):
+    """
+    OUTPUT:
+        A Span context manager, see Span.
+    """
+
+    return Span(name, ticker, **labels)
+
+
+def count(name, n=1, **labels):
+    """
+    INPUTS:
+        name (str) - Counter name, ending in _total by convention
+        n (float) - Amount to add
+        labels (str) - Low cardinality labels, i.e. table="daily_data"
+    OUTPUT:
+        Side effect of adding n to the counter.
+    """
+
+    key = (name, labelled(labels))
+    with lock:
+        counters[key] += n
+
+
+def observe(name, value, **labels):
+    """
+    INPUTS:
+        name (str) - Histogram name, ending in _seconds for latencies
+        value (float) - Observed value
+        labels (str) - Low cardinality labels, i.e. statement="tickers"
+    OUTPUT:
+        Side effect of adding value to the histogram.
+    """
+
+    key = (name, labelled(labels))
+    with lock:
+        if key not in histograms: histograms[key] = [0]*(len(BUCKETS) + 2)
+        histogram = histograms[key]
+        for n, bound in enumerate(BUCKETS):
+            if value <= bound: histogram[n] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def query_hook(name, seconds, rows, failed=False):
+    """
+    OUTPUT:
+        Side effect of counting one statement run through queries, see
+        queries.hooks. Failed statements are also counted in
+        query_errors_total, and their rows are left out.
+    """
+
+    count("queries_total", statement=name)
+    observe("query_seconds", seconds, statement=name)
+    if failed: count("query_errors_total", statement=name)
+    elif rows: count("query_rows_total", rows, statement=name)
+
+
+queries.hooks.append(query_hook)
+
+
+def drain():
+    """
+    OUTPUT:
+        Snapshot of the counters, histograms, and span records collected so
+        far, as plain lists that pickle, leaving them empty. Worker
+        processes return this for their parent to merge().
+    """
+
+    with lock:
+        snapshot = (list(counters.items()), list(histograms.items()),
+                    list(events))
+        counters.clear()
+        histograms.clear()
+        del events[:]
+
+    return snapshot
+
+
+def merge(snapshot):
+    """
+    INPUTS:
+        snapshot (tuple) - From drain(), possibly in another process
+    OUTPUT:
+        Side effect of adding the snapshot to this process' collection.
+    """
+
+    counted, observed, spans = snapshot
+    with lock:
+        for key, n in counted:
+            counters[key] += n
+        for key, values in observed:
+            if key not in histograms: histograms[key] = [0]*len(values)
+            histograms[key] = [a + b for a, b in zip(histograms[key],
+                                                     values)]
+        events.extend(spans)
+
+
+def series(name, labels, extra=()):
+    """
+    OUTPUT:
+        Metric name with its labels in Prometheus text format, i.e.
+        hf_rows_written_total{script="timeseries",table="daily_data"}
+    """
+
+    pairs = list(labels) + list(extra)
+    escape = lambda v: (str(v).replace("\\", "\\\\").replace('"', '\\"')
+                        .replace("\n", "\\n"))
+    text = ",".join(['{}="{}"'.format(k, escape(v)) for k, v in pairs])
+
+    return PREFIX + name + ("{" + text + "}" if text else "")
+
+
+def prometheus(job, counted, observed, now):
+    """
+    OUTPUT:
+        Text in the Prometheus exposition format for the counters and
+        histograms of one run of job, for node_exporter's textfile collector.
+        The job goes in a "script" label, as Prometheus keeps "job" for the
+        scrape target's own and would rename ours to exported_job.
+    """
+
+    run = (("script", job),)
+    lines, typed = [], set()
+    for (name, labels), n in sorted(counted):
+        if name not in typed:
+            lines.append("# TYPE {}{} counter".format(PREFIX, name))
+            typed.add(name)
+        lines.append("{} {}".format(series(name, run + labels), n))
+    for (name, labels), values in sorted(observed):
+        if name not in typed:
+            lines.append("# TYPE {}{} histogram".format(PREFIX, name))
+            typed.add(name)
+        for bound, n in zip(BUCKETS, values):
+            lines.append("{} {}".format(series(name + "_bucket", run + labels,
+                                               [("le", bound)]), n))
+        lines.append("{} {}".format(series(name + "_bucket", run + labels,
+                                           [("le", "+Inf")]), values[-1]))
+        lines.append("{} {}".format(series(name + "_sum", run + labels),
+                                    values[-2]))
+        lines.append("{} {}".format(series(name + "_count", run + labels),
+                                    values[-1]))
+    lines.append("# TYPE {}last_run_timestamp_seconds gauge".format(PREFIX))
+    lines.append("{} {:.0f}".format(series("last_run_timestamp_seconds",
+                                           run), now))
+
+    return "\n".join(lines) + "\n"
+
+
+def write(job, jsonl, textfile_dir=None):
+    """
+    INPUTS:
+        job (str) - Name of the run, i.e. "timeseries"
+        jsonl (str) - JSON lines file to append the span records and a
+                      summary of the counters and histograms to
+        textfile_dir (str) - Optional node_exporter textfile directory, to
+                             write hundredfold_<job>.prom into
+    OUTPUT:
+        Side effect of writing out, then clearing, everything collected.
+        The .prom file is replaced by a rename, so the collector never
+        reads half of one.
+    """
+
+    now = time()
+    counted, observed, spans = drain()
+    with open(jsonl, "a") as f:
+        for event in spans:
+            event["job"] = job
+            f.write(json.dumps(event) + "\n")
+        summary = {"job": job, "time": round(now, 3),
+                   "counters": [[name, dict(labels), n]
+                                for (name, labels), n in counted],
+                   "histograms": [[name, dict(labels), values[-1],
+                                   round(values[-2], 4)]
+                                  for (name, labels), values in observed]}
+        f.write(json.dumps(summary) + "\n")
+
+    if textfile_dir:
+        path = os.path.join(textfile_dir, "hundredfold_{}.prom".format(job))
+        with open(path + ".tmp", "w") as f:
+            f.write(prometheus(job, counted, observed, now))
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,433 @@
+#!/home/mcollier/miniconda3/bin/python
+# -*- coding: utf-8 -*-
+
+##############################################################################
+# TBD:
+#
+#   improve documentation
+#
+##############################################################################
+
+# standard python library imports
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import datetime as dt
+from itertools import islice
+import hashlib
+import os
+import random
+import threading
+from time import monotonic, sleep
+
+# third party library imports, each loaded on first use (see lazy.py)
+import lazy
+np = lazy.load("numpy")                          # conda install numpy
+pd = lazy.load("pandas")                         # conda install pandas
+quandl = lazy.load("quandl")                     # conda install quandl
+quandl_errors = lazy.load("quandl.errors.quandl_error")
+requests = lazy.load("requests")                 # conda install requests
+
+# local imports
+import telemetry
+
+
+##############################################################################
+# Local Definitions
+##############################################################################
+
+# HTTP statuses worth retrying; 429 also halves the request rate
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+##############################################################################
+# Local User Function Definitions
+##############################################################################
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket shared by every fetch thread. It holds at most
+    `burst` tokens and refills at `rate` tokens per second. Callers reserve
+    a token in take() and sleep outside the lock until it is theirs, so at
+    most burst + rate*T requests start in any window of T seconds.
+
+    The rate adapts to the vendor: throttled() halves it (down to 1/16 of
+    the starting rate) and empties the bucket, and every `streak` successes
+    in a row win back a twentieth of the starting rate, which is never
+    exceeded.
+    """
+
+    def __init__(self, rate, burst=1, streak=20):
+        self.ceiling = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.streak = streak
+        self.successes = 0
+        self.throttles = 0
+        self.retries = 0
+        self.stamp = monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        OUTPUT:
+            Seconds spent waiting for a token.
+        """
+
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp)*self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            wait = -self.tokens/self.rate if self.tokens < 0 else 0.0
+
+        if wait: sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.ceiling/16, self.rate/2)
+            self.tokens = min(self.tokens, 0.0)
+            self.successes = 0
+            self.throttles += 1
+
+    def succeeded(self):
+        with self.lock:
+            self.successes += 1
+            if self.successes >= self.streak:
+                self.rate = min(self.ceiling, self.rate + self.ceiling/20)
+                self.successes = 0
+
+    def retried(self):
+        with self.lock:
+            self.retries += 1
+
+
+def make_bucket(conf):
+    """
+    INPUTS:
+        conf (dict) - Configuration from hf.conf
+    OUTPUT:
+        TokenBucket sized to the vendor quota. The quota is quandl_calls
+        requests per quandl_period seconds (default 300 per 600s, less a
+        small safety margin), of which quandl_burst may start at once.
+    """
+
+    calls = conf.get("quandl_calls", 300)
+    period = conf.get("quandl_period", 600)
+    burst = conf.get("quandl_burst", 5)
+
+    return TokenBucket(0.95*(calls - burst)/period, burst)
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of raw daily responses, one compressed columnar .npz file
+    per (instrument, begin_date, end_date) named by the SHA-1 of that key.
+    Each file also records its key, so replay() can rebuild data without
+    the network. A hit refreshes the file's mtime, and put() evicts the
+    least recently used files once the cache is larger than max_bytes.
+    A response whose range reached the day it was fetched may predate that
+    day's bar, so it is kept for replay() but never served by get().
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, instrument, begin_date, end_date):
+        key = "|".join([instrument, begin_date, end_date]).encode()
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.path, digest + ".npz")
+
+    def get(self, instrument, begin_date, end_date):
+        """
+        OUTPUT:
+            Cached dataframe for the request, or None on a miss.
+        """
+
+        name = self.filename(instrument, begin_date, end_date)
+        try:
+            instrument, df, fetched = self.load(name)
+            if end_date >= fetched: return None
+            os.utime(name)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+        return df
+
+    def put(self, instrument, begin_date, end_date, df):
+        """
+        OUTPUT:
+            Side effect of writing df under the request key, then evicting
+            old files if the cache is over size.
+        """
+
+        name = self.filename(instrument, begin_date, end_date)
+        temp = "{}.{}.tmp".format(name, threading.get_ident())
+        with open(temp, "wb") as f:
+            np.savez_compressed(f,
+                key=np.array([instrument, begin_date, end_date]),
+                fetched=np.array([dt.date.today().isoformat()]),
+                dates=df.index.values.astype("datetime64[D]"),
+                index=np.array([df.index.name or ""]),
+                columns=np.array(df.columns, dtype=str),
+                values=df.values.astype(float))
+        os.replace(temp, name)
+        self.evict()
+
+    def load(self, name):
+        """
+        OUTPUT:
+            (instrument, dataframe, date fetched) read from one cache file.
+        """
+
+        with np.load(name) as npz:
+            index = pd.DatetimeIndex(npz["dates"],
+                                     name=npz["index"][0] or None)
+            df = pd.DataFrame(npz["values"], index=index,
+                              columns=list(npz["columns"]))
+            instrument = str(npz["key"][0])
+            fetched = str(npz["fetched"][0]) if "fetched" in npz else ""
+
+        return instrument, df, fetched
+
+    def evict(self):
+        """
+        OUTPUT:
+            Side effect of removing least recently used files until the
+            cache fits in max_bytes.
+        """
+
+        with self.lock:
+            files = [os.path.join(self.path, f) for f in os.listdir(self.path)
+                     if f.endswith(".npz")]
+            stats = [(os.stat(f), f) for f in files]
+            stats.sort(key=lambda s: s[0].st_mtime)
+            size = sum([stat.st_size for stat, f in stats])
+            for stat, f in stats:
+                if size <= self.max_bytes: break
+                os.remove(f)
+                size -= stat.st_size
+
+    def replay(self):
+        """
+        OUTPUT:
+            Generator of (instrument, dataframe) pairs, one per instrument,
+            merging every cached response for it. Where responses overlap,
+            the one fetched last wins.
+        """
+
+        groups = dict()
+        names = [os.path.join(self.path, f) for f in os.listdir(self.path)
+                 if f.endswith(".npz")]
+        names.sort(key=os.path.getmtime)
+        for name in names:
+            with np.load(name) as npz:
+                groups.setdefault(str(npz["key"][0]), []).append(name)
+
+        for instrument, names in groups.items():
+            df = pd.concat([self.load(name)[1] for name in names])
+            df = df[~df.index.duplicated(keep="last")].sort_index()
+            yield instrument, df
+
+
+def make_cache(conf):
+    """
+    INPUTS:
+        conf (dict) - Configuration from hf.conf
+    OUTPUT:
+        ResponseCache at quandl_cache holding up to quandl_cache_mb
+        megabytes (default 512), or None if no cache is configured.
+    """
+
+    if not conf.get("quandl_cache"): return None
+
+    return ResponseCache(conf["quandl_cache"],
+                         conf.get("quandl_cache_mb", 512)*2**20)
+
+
+def configure(conf):
+    """
+    INPUTS:
+        conf (dict) - Configuration from hf.conf
+    OUTPUT:
+        Side effect of setting the Quandl key, and the API base URL if
+        quandl_base is given (e.g. a local stand-in server for tests).
+        Quandl's own retries are turned off so throttling reaches the
+        shared limiter.
+    """
+
+    quandl.ApiConfig.api_key = conf["quandl_key"]
+    quandl.ApiConfig.use_retries = False  # fetch_daily retries, adaptively
+    if conf.get("quandl_base"):
+        quandl.ApiConfig.api_base = conf["quandl_base"]
+
+
+def backoff(attempt, base=1.0, cap=60.0):
+    """
+    INPUTS:
+        attempt (int) - Number of failed attempts so far, less one
+        base (float) - Seconds to wait, at most, after the first failure
+        cap (float) - Most seconds to wait after any failure
+    OUTPUT:
+        Seconds to wait before retrying: exponential backoff with full
+        jitter, so threads that failed together don't retry together.
+    """
+
+    return random.uniform(0, min(cap, base*2**attempt))
+
+
+def fetch_daily(bucket, instrument, begin_date, end_date, cache=None,
+                retries=5):
+    """
+    INPUTS:
+        bucket (TokenBucket) - Shared rate limiter
+        instrument (str) - Quandl code, i.e. "WIKI/WMT"
+        begin_date (str) - First date wanted, iso8601 format
+        end_date (str) - Last date wanted, iso8601 format
+        cache (ResponseCache) - Optional; a hit costs no request
+        retries (int) - Most retries after throttling, server, or
+                        connection errors, each after a backoff()
+    OUTPUT:
+        Daily prices as a pandas dataframe indexed by date.
+    """
+
+    if cache:
+        df = cache.get(instrument, begin_date, end_date)
+        if df is not None:
+            telemetry.count("vendor_requests_total", source="cache")
+            telemetry.count("rows_fetched_total", len(df.index))
+            return df
+
+    for attempt in range(retries + 1):
+        bucket.take()
+        try:
+            with telemetry.span("vendor_request", instrument):
+                df = quandl.get(instrument, start_date=begin_date,
+                                end_date=end_date, collapse="daily")
+            break
+        except (quandl_errors.QuandlError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as err_msg:
+            status = getattr(err_msg, "http_status", None)
+            telemetry.count("vendor_failures_total", status=status)
+            if (isinstance(err_msg, quandl_errors.QuandlError)
+                    and status not in RETRY_STATUS):
+                raise
+            if status == 429: bucket.throttled()
+            if attempt == retries: raise
+            bucket.retried()
+            telemetry.count("vendor_retries_total")
+            sleep(backoff(attempt))
+
+    bucket.succeeded()
+    telemetry.count("vendor_requests_total", source="vendor")
+    telemetry.count("rows_fetched_total", len(df.index))
+    if cache and not df.empty:
+        cache.put(instrument, begin_date, end_date, df)
+
+    return df
+
+
+def fetch_many(bucket, jobs, workers=4, window=None, cache=None,
+               retries=5):
+    """
+    INPUTS:
+        bucket (TokenBucket) - Shared rate limiter
+        jobs (iterable) - Tuples of (key, instrument, begin_date, end_date)
+        workers (int) - Number of requests in flight at once
+        window (int) - Most requests submitted but not yet consumed by the
+                       caller, 2*workers by default
+        cache (ResponseCache) - Optional raw response cache
+        retries (int) - Most retries per request, see fetch_daily()
+    OUTPUT:
+        Generator of (key, dataframe, exception) tuples in completion order.
+        Exactly one of dataframe and exception is None. New requests are
+        only submitted as results are consumed, so a slow consumer holds
+        memory to the window. Requests not yet started are cancelled if the
+        caller stops early.
+    """
+
+    window = window or 2*workers
+    jobs = iter(jobs)
+    pending = dict()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                for job in islice(jobs, window - len(pending)):
+                    future = pool.submit(fetch_daily, bucket, *job[1:],
+                                         cache=cache, retries=retries)
+                    pending[future] = job[0]
+                if not pending: break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    try:
+                        result = (key, future.result(), None)
+                    except Exception as err_msg:
+                        result = (key, None, err_msg)
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+##############################################################################
+# Treat this file as a script if invoked as __main__
+##############################################################################
+
+if __name__ == "__main__":
+
+    # TEST: fetch from a local stand-in for the vendor, at 2 requests/s,
+    # which throttles every third request
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import json
+    from time import time
+
+    class StandIn(BaseHTTPRequestHandler):
+        calls = 0
+        def do_GET(self):
+            StandIn.calls += 1
+            if StandIn.calls % 3 == 0:
+                body = {"quandl_error": {"code": "QELx01",
+                                         "message": "too many requests"}}
+                self.send_response(429)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+                return
+            ticker = self.path.split("/")[3]
+            body = {"dataset_data": {
+                "column_names": ["Date", "Open", "High", "Low", "Close"],
+                "data": [["2017-09-18", 80.21, 81.12, 79.95, 80.00]],
+                "frequency": "daily", "start_date": "2017-09-18",
+                "end_date": "2017-09-18", "column_index": None,
+                "limit": None, "transform": None, "collapse": "daily",
+                "order": None, "name": ticker}}
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode())
+        def log_message(self, *a):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    configure({"quandl_key": "test", "quandl_base":
+               "http://127.0.0.1:{}/api/v3".format(server.server_port)})
+
+    bucket = TokenBucket(rate=2, burst=1, streak=2)
+    jobs = [(t, "WIKI/" + t, "2017-09-18", "2017-09-18")
+            for t in ["A", "B", "C", "D", "E", "F", "G", "H"]]
+    t0 = time()
+    for key, daily, err in fetch_many(bucket, jobs, workers=4):
+        print("{:>2s} at {:5.2f}s: {}".format(key, time() - t0,
+              err if err else daily.Close.tolist()))
+    print("rate {:.2f}/s of {:.2f}/s, {} throttles, {} retries".format(
+          bucket.rate, bucket.ceiling, bucket.throttles, bucket.retries))
+    server.shutdown()